@@ -1,6 +1,8 @@
 from django.contrib import admin
 
-from .models import Income, Expense, FinancialInstitution, Account
+from .models import (Income, Expense, FinancialInstitution, Account, SyncState, Upload, IngestionJob, OFXResponse,
+                     Transfer)
+from .tasks import discover_accounts
 
 @admin.register(Income)
 class IncomeAdmin(admin.ModelAdmin):
@@ -10,6 +12,7 @@ class IncomeAdmin(admin.ModelAdmin):
         'formatted_carry_over',
         'formatted_total_expenses'
     ]
+    list_select_related = ['ledger']
 
     def formatted_income(self, obj):
         if obj.income:
@@ -63,7 +66,18 @@ class ExpenseAdmin(admin.ModelAdmin):
 
 @admin.register(FinancialInstitution)
 class FinancialInstitutionAdmin(admin.ModelAdmin):
-    list_display = ['name']
+    list_display = ['name', 'discovery_status', 'discovery_message', 'discovered_at']
+    readonly_fields = ['discovery_status', 'discovery_message', 'discovered_at']
+    actions = ['discover_accounts']
+
+    def discover_accounts(self, request, queryset):
+        banks = queryset.exclude(ofx_endpoint__isnull=True).exclude(ofx_endpoint='')
+
+        for bank in banks:
+            discover_accounts.delay(bank.id)
+
+        self.message_user(request, 'Looking for accounts at {} banks'.format(len(banks)))
+    discover_accounts.short_description = 'Look for new accounts'
 
 @admin.register(Account)
 class AccountAdmin(admin.ModelAdmin):
@@ -71,3 +85,32 @@ class AccountAdmin(admin.ModelAdmin):
 
     def formatted_name(self, obj):
         return '{} - {}'.format(obj.bank.name, obj.account_type)
+
+
+@admin.register(SyncState)
+class SyncStateAdmin(admin.ModelAdmin):
+    list_display = ['account', 'window_start', 'window_end', 'server_end', 'overlap', 'synced_at']
+
+
+@admin.register(Upload)
+class UploadAdmin(admin.ModelAdmin):
+    list_display = ['name', 'account', 'uploaded_at', 'ingested_at', 'first_posted', 'last_posted', 'rows']
+
+
+@admin.register(IngestionJob)
+class IngestionJobAdmin(admin.ModelAdmin):
+    list_display = ['__str__', 'bank', 'account', 'rows_read', 'inserted', 'duplicates', 'errors', 'created_at']
+    list_filter = ['kind', 'status']
+
+
+@admin.register(OFXResponse)
+class OFXResponseAdmin(admin.ModelAdmin):
+    list_display = ['bank', 'window_start', 'window_end', 'fetched_at', 'size']
+    exclude = ['data']
+
+
+@admin.register(Transfer)
+class TransferAdmin(admin.ModelAdmin):
+    list_display = ['__str__', 'reason']
+    list_select_related = ['transaction_from__account__bank', 'transaction_to__account__bank']
+    raw_id_fields = ['transaction_from', 'transaction_to']
@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class CashConfig(AppConfig):
     name = 'cash'
+
+    def ready(self):
+        from . import signals  # noqa: F401
@@ -0,0 +1,42 @@
+import gzip
+import io
+import zlib
+
+from .models import OFXResponse
+
+
+class ArchivingReader(object):
+    # Passes reads straight through while gzipping a copy of everything
+    # that went past
+
+    def __init__(self, source):
+        self.source = source
+        self.compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        self.chunks = []
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self.source.read(size)
+
+        if data:
+            self.size += len(data)
+            self.chunks.append(self.compressor.compress(data))
+
+        return data
+
+    def compressed(self):
+        return b''.join(self.chunks + [self.compressor.flush()])
+
+
+def save(bank, windows, reader):
+    response = OFXResponse.objects.create(bank=bank,
+                                          window_start=min(state.window_start for state in windows),
+                                          window_end=max(state.window_end for state in windows),
+                                          size=reader.size,
+                                          data=reader.compressed())
+    response.accounts.set([state.account for state in windows])
+    return response
+
+
+def open_response(response):
+    return gzip.GzipFile(fileobj=io.BytesIO(bytes(response.data)))
@@ -0,0 +1,274 @@
+import csv
+import hashlib
+import io
+import itertools
+import time
+from collections import Counter, namedtuple
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Min
+
+from . import ledger, search
+from .models import Income, Transaction
+
+
+# Everything we need to build a Transaction and nothing else. These are a lot
+# cheaper to hang on to than model instances while a batch fills up.
+TransactionRow = namedtuple('TransactionRow', [
+    'transaction_id',
+    'name',
+    'memo',
+    'amount',
+    'date_posted',
+    'transaction_type',
+    'account_id',
+    'check_number',
+])
+TransactionRow.__new__.__defaults__ = (None,)
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+
+    while True:
+        batch = list(itertools.islice(iterator, size))
+
+        if not batch:
+            return
+
+        yield batch
+
+
+def read_csv(filepath):
+    with open(filepath) as f:
+        yield from csv.DictReader(f)
+
+
+def row_id(row):
+    # Banks don't give us IDs in their CSV exports so we make one up from the
+    # contents of the row. The last column is skipped since it's either a
+    # running balance or the leftovers from a trailing comma.
+    #
+    # These ids are already saved, so the hash can't change. md5 of a row
+    # this short is mostly call overhead anyway; building the string is what
+    # costs.
+    values = list(row.values())
+    values.pop()
+    return hashlib.md5(''.join(values).encode('utf-8')).hexdigest()
+
+
+CREATE_STAGING = '''
+    CREATE TEMPORARY TABLE IF NOT EXISTS cash_transaction_staging
+    (LIKE cash_transaction INCLUDING DEFAULTS)
+    ON COMMIT DROP
+'''
+
+COPY_STAGING = '''
+    COPY cash_transaction_staging ({columns})
+    FROM STDIN WITH (FORMAT csv, FORCE_NULL (check_number))
+'''
+
+INSERT_FROM_STAGING = '''
+    INSERT INTO cash_transaction ({columns})
+    SELECT {columns} FROM cash_transaction_staging
+    ON CONFLICT (transaction_id) DO NOTHING
+'''
+
+
+# Columns a bank is allowed to change after the fact. A transaction never
+# moves to a different account, and since FITIDs are only unique within an
+# account, a row whose id is already taken by another account is left alone
+# and counted as a conflict. Those come back with NULL for inserted.
+UPSERT_FIELDS = ['name', 'memo', 'amount', 'date_posted', 'check_number', 'transaction_type']
+
+UPSERT_FROM_STAGING = '''
+    WITH upserted AS (
+        INSERT INTO cash_transaction AS existing ({columns})
+        SELECT DISTINCT ON (transaction_id) {columns}
+        FROM cash_transaction_staging
+        ORDER BY transaction_id, ctid DESC
+        ON CONFLICT (transaction_id) DO UPDATE SET {updates}
+        WHERE existing.account_id = EXCLUDED.account_id
+          AND ({current}) IS DISTINCT FROM ({incoming})
+        RETURNING transaction_id, xmax = 0
+    )
+    SELECT * FROM upserted
+    UNION ALL
+    SELECT DISTINCT staging.transaction_id, NULL::boolean
+    FROM cash_transaction_staging AS staging
+    JOIN cash_transaction AS other ON other.transaction_id = staging.transaction_id
+    WHERE other.account_id <> staging.account_id
+'''
+
+
+def orm_loader(batch):
+    transactions = [Transaction(**row._asdict()) for row in batch]
+    Transaction.objects.bulk_create(transactions, ignore_conflicts=True)
+    search.index_transactions(transactions)
+
+    # bulk_create hands back everything whether it was inserted or not
+    return None
+
+
+def orm_upsert_loader(batch):
+    # Later rows win when the same transaction shows up twice
+    incoming = {row.transaction_id: row for row in batch}
+    existing = Transaction.objects.in_bulk(list(incoming))
+
+    created, changed = [], []
+    conflicts = 0
+
+    for transaction_id, row in incoming.items():
+        current = existing.get(transaction_id)
+
+        if current is None:
+            created.append(Transaction(**row._asdict()))
+            continue
+
+        if current.account_id != row.account_id:
+            conflicts += 1
+            continue
+
+        different = False
+
+        for field in UPSERT_FIELDS:
+            value = Transaction._meta.get_field(field).to_python(getattr(row, field))
+
+            if getattr(current, field) != value:
+                setattr(current, field, value)
+                different = True
+
+        if different:
+            changed.append(current)
+
+    Transaction.objects.bulk_create(created, ignore_conflicts=True)
+    Transaction.objects.bulk_update(changed, UPSERT_FIELDS)
+    search.index_transactions(created + changed)
+    invalidate_ledger([t.transaction_id for t in changed])
+
+    return {
+        'inserted': len(created),
+        'updated': len(changed),
+        'unchanged': len(incoming) - len(created) - len(changed) - conflicts,
+        'conflicts': conflicts,
+    }
+
+
+def write_staging(cursor, batch):
+    # Quoting everything but numbers keeps empty names and memos as empty
+    # strings. check_number is the only column that can be NULL and COPY is
+    # told to treat an empty one that way.
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, quoting=csv.QUOTE_NONNUMERIC)
+    writer.writerows(batch)
+    buffer.seek(0)
+
+    cursor.execute(CREATE_STAGING)
+    cursor.execute('TRUNCATE cash_transaction_staging')
+    cursor.copy_expert(COPY_STAGING.format(columns=', '.join(TransactionRow._fields)), buffer)
+
+
+def copy_loader(batch):
+    columns = ', '.join(TransactionRow._fields)
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        write_staging(cursor, batch)
+        cursor.execute(INSERT_FROM_STAGING.format(columns=columns))
+        return {'inserted': cursor.rowcount}
+
+
+def copy_upsert_loader(batch):
+    # Rows that come back from RETURNING were either inserted (xmax is 0 for
+    # a brand new row) or actually changed. Anything that matched what we
+    # already had is left alone and doesn't come back at all. Ids taken by
+    # another account come back too, marked with NULL.
+    query = UPSERT_FROM_STAGING.format(
+        columns=', '.join(TransactionRow._fields),
+        updates=', '.join('{0} = EXCLUDED.{0}'.format(f) for f in UPSERT_FIELDS),
+        current=', '.join('existing.{}'.format(f) for f in UPSERT_FIELDS),
+        incoming=', '.join('EXCLUDED.{}'.format(f) for f in UPSERT_FIELDS),
+    )
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        write_staging(cursor, batch)
+        cursor.execute(query)
+        returned = cursor.fetchall()
+
+    updated = [transaction_id for transaction_id, inserted in returned if inserted is False]
+    inserted = sum(1 for _, row_inserted in returned if row_inserted)
+    conflicts = sum(1 for _, row_inserted in returned if row_inserted is None)
+    invalidate_ledger(updated)
+
+    return {
+        'inserted': inserted,
+        'updated': len(updated),
+        'unchanged': len({row.transaction_id for row in batch}) - len(returned),
+        'conflicts': conflicts,
+    }
+
+
+def invalidate_ledger(transaction_ids):
+    # A changed amount on a paycheck or an expense moves the ledger from
+    # that pay period on
+    if not transaction_ids:
+        return
+
+    affected = Income.objects.filter(transaction__in=transaction_ids) | \
+        Income.objects.filter(expense__transaction__in=transaction_ids)
+    since = affected.aggregate(Min('budgeted_date'))['budgeted_date__min']
+
+    if since:
+        ledger.invalidate(since)
+
+
+def default_loader(upsert=False):
+    if connection.vendor == 'postgresql' and settings.INGEST_USE_COPY:
+        return copy_upsert_loader if upsert else copy_loader
+
+    return orm_upsert_loader if upsert else orm_loader
+
+
+def ingest(rows, batch_size=None, loader=None, upsert=False, progress=None):
+    # Only one batch worth of rows is ever held in memory, no matter how big
+    # the thing feeding ``rows`` is. ``progress`` gets called with the size
+    # of each batch and whatever the loader counted for it.
+    batch_size = batch_size or settings.INGEST_BATCH_SIZE
+    loader = loader or default_loader(upsert=upsert)
+
+    started = time.monotonic()
+    read = 0
+    batches = 0
+    counts = Counter()
+    counted = True
+
+    for batch in batched(rows, batch_size):
+        batch_counts = loader(batch)
+
+        if batch_counts is None:
+            counted = False
+        else:
+            counts.update(batch_counts)
+
+        read += len(batch)
+        batches += 1
+
+        if progress is not None:
+            progress(len(batch), batch_counts)
+
+    elapsed = time.monotonic() - started
+
+    result = {
+        'rows': read,
+        'inserted': counts['inserted'] if counted else None,
+        'batches': batches,
+        'seconds': elapsed,
+        'rows_per_second': read / elapsed if elapsed else 0,
+    }
+
+    if upsert:
+        result['updated'] = counts['updated']
+        result['unchanged'] = counts['unchanged']
+        result['conflicts'] = counts['conflicts']
+
+    return result
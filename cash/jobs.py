@@ -0,0 +1,60 @@
+from collections import Counter
+
+from django.db.models import F
+
+from .models import IngestionJob
+
+
+class JobProgress(object):
+    # Counts for an IngestionJob pile up here and get written out once per
+    # batch. Several threads can report on the same job as long as each one
+    # has its own JobProgress; the writes are increments.
+
+    def __init__(self, job):
+        self.job = job
+        self.pending = Counter()
+
+    def add(self, **counts):
+        self.pending.update(counts)
+
+    def count(self, size, counts):
+        # Matches ingest()'s progress callback. Whatever a loader didn't
+        # insert or update was already there, apart from rows whose id
+        # belongs to another account. Loaders that can't tell only get their
+        # rows counted.
+        self.add(rows_read=size)
+
+        if counts is not None:
+            inserted = counts.get('inserted', 0)
+            updated = counts.get('updated', 0)
+            conflicts = counts.get('conflicts', 0)
+            self.add(inserted=inserted, updated=updated, errors=conflicts,
+                     duplicates=size - inserted - updated - conflicts)
+
+    def batch(self, size, counts):
+        self.count(size, counts)
+        self.flush()
+
+    def flush(self):
+        if self.job is None:
+            return
+
+        updates = {field: F(field) + count for field, count in self.pending.items() if count}
+
+        if updates:
+            IngestionJob.objects.filter(id=self.job.id).update(**updates)
+
+        self.pending.clear()
+
+
+class CountingReader(object):
+    # Wraps anything with read() and adds up how much came through it
+
+    def __init__(self, source, progress):
+        self.source = source
+        self.progress = progress
+
+    def read(self, size=-1):
+        data = self.source.read(size)
+        self.progress.pending['bytes_read'] += len(data)
+        return data
@@ -0,0 +1,52 @@
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+from .models import LedgerEntry
+
+
+_state = threading.local()
+
+
+@contextmanager
+def deferred_updates():
+    # Views that create or delete whole series of incomes and expenses fire
+    # a lot of signals. Inside this block we only keep track of the earliest
+    # period that was touched and recompute the ledger once on the way out.
+    outermost = not getattr(_state, 'deferring', False)
+
+    if outermost:
+        _state.deferring = True
+        _state.since = None
+        _state.dirty = False
+
+    try:
+        yield
+    finally:
+        if outermost:
+            _state.deferring = False
+
+            if _state.dirty:
+                LedgerEntry.recompute(since=_state.since)
+
+
+def invalidate(since=None):
+    # Mark every period starting with the one budgeted on ``since`` as out
+    # of date. ``None`` means the whole ledger.
+    since = as_date(since)
+
+    if getattr(_state, 'deferring', False):
+        if not _state.dirty:
+            _state.since = since
+        elif since is None or (_state.since is not None and since < _state.since):
+            _state.since = since
+        _state.dirty = True
+    else:
+        LedgerEntry.recompute(since=since)
+
+
+def as_date(value):
+    # Occurrences coming out of a recurrence rule are datetimes
+    if isinstance(value, datetime):
+        return value.date()
+    return value
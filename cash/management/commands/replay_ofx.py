@@ -0,0 +1,45 @@
+from datetime import datetime
+
+from django.core.management.base import BaseCommand
+
+from ofxtools.utils import UTC as OFX_UTC
+
+from cash.models import OFXResponse
+from cash.tasks import replay_responses
+
+
+def day(value):
+    return datetime.strptime(value, '%Y-%m-%d').replace(tzinfo=OFX_UTC)
+
+
+class Command(BaseCommand):
+    help = 'Parse archived OFX responses again and save the transactions in them'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--bank', type=int, help='Only responses from this bank id')
+        parser.add_argument('--account', type=int, help='Only responses covering this account id')
+        parser.add_argument('--since', type=day, help='Only responses ending on or after this day (YYYY-MM-DD)')
+        parser.add_argument('--until', type=day, help='Only responses starting on or before this day (YYYY-MM-DD)')
+        parser.add_argument('--dry-run', action='store_true', help='Parse everything but save nothing')
+
+    def handle(self, *args, **options):
+        responses = OFXResponse.objects.all()
+
+        if options['bank']:
+            responses = responses.filter(bank_id=options['bank'])
+
+        if options['account']:
+            responses = responses.filter(accounts=options['account'])
+
+        if options['since']:
+            responses = responses.filter(window_end__gte=options['since'])
+
+        if options['until']:
+            responses = responses.filter(window_start__lte=options['until'])
+
+        results = replay_responses(responses.distinct(), dry_run=options['dry_run'])
+
+        for result in results:
+            self.stdout.write('Response {response}: {rows} rows'.format(**result))
+
+        self.stdout.write('Replayed {} responses, {} rows'.format(len(results), sum(r['rows'] for r in results)))
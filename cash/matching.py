@@ -0,0 +1,171 @@
+import bisect
+import itertools
+import re
+from collections import defaultdict
+from datetime import timedelta
+from difflib import SequenceMatcher
+
+from django.conf import settings
+from django.db import transaction as db_transaction
+from django.db.models import Q
+from django.db.models.functions import Coalesce
+
+from . import ledger
+from .models import Expense, MatchSuggestion, Transaction
+from .transfers import as_datetime
+
+
+def words(text):
+    return ' '.join(re.findall('[a-z]+', (text or '').lower()))
+
+
+class ExpenseIndex:
+    # Budgeted expenses that aren't tied to a transaction yet, grouped by
+    # amount. The distinct amounts are kept sorted so the ones within the
+    # tolerance of a transaction are found with a bisect, and each group is
+    # sorted by date so the same goes for the date window. Recurring bills
+    # pile up lots of expenses with the same amount, which is why the dates
+    # get their own index.
+    def __init__(self, expenses):
+        groups = defaultdict(list)
+
+        for expense in expenses:
+            if expense['date'] is not None:
+                groups[expense['budgeted_amount']].append((expense['date'], expense['id'], words(expense['description'])))
+
+        self.amounts = sorted(groups)
+        self.groups = {}
+
+        for amount, group in groups.items():
+            group.sort()
+            self.groups[amount] = ([date for date, _, _ in group], group)
+
+    def __len__(self):
+        return len(self.amounts)
+
+    def candidates(self, amount, date, tolerance, window):
+        lo = bisect.bisect_left(self.amounts, amount - tolerance)
+        hi = bisect.bisect_right(self.amounts, amount + tolerance)
+
+        for budgeted_amount in self.amounts[lo:hi]:
+            dates, group = self.groups[budgeted_amount]
+            start = bisect.bisect_left(dates, date - window)
+            end = bisect.bisect_right(dates, date + window)
+
+            for expense_date, expense_id, description in group[start:end]:
+                yield budgeted_amount, expense_date, expense_id, description
+
+
+def score(amount, date, description, candidate, tolerance, window):
+    budgeted_amount, expense_date, _, expense_description = candidate
+
+    amount_score = 1 - abs(amount - budgeted_amount) / tolerance if tolerance else 1
+    date_score = 1 - abs((date - expense_date).days) / (window.days + 1)
+    description_score = SequenceMatcher(None, description, expense_description).ratio()
+
+    return round(0.5 * amount_score + 0.25 * date_score + 0.25 * description_score, 4)
+
+
+def find_matches(transactions, index, tolerance=None, window=None, limit=None):
+    # Yields (transaction_id, expense_id, score) for the best few expenses of
+    # every transaction. Only money going out can pay for an expense.
+    tolerance = settings.MATCH_AMOUNT_TOLERANCE if tolerance is None else tolerance
+    window = timedelta(days=settings.MATCH_DATE_WINDOW if window is None else window)
+    limit = settings.MATCH_SUGGESTIONS if limit is None else limit
+
+    for transaction_id, amount, date_posted, name, memo in transactions:
+        if amount >= 0:
+            continue
+
+        amount = abs(amount)
+        date = date_posted.date()
+        description = words('{} {}'.format(name, memo))
+
+        scored = sorted(((score(amount, date, description, candidate, tolerance, window), candidate[2])
+                         for candidate in index.candidates(amount, date, tolerance, window)),
+                        reverse=True)
+
+        for match_score, expense_id in scored[:limit]:
+            yield transaction_id, expense_id, match_score
+
+
+def suggest_matches(transactions=None, since=None, until=None, batch_size=1000):
+    # Replaces the suggestions for ``transactions`` (every unreconciled
+    # transaction by default) posted from ``since`` through ``until`` and
+    # returns how many there are now. Only expenses close enough to those
+    # days to match are loaded.
+    window = timedelta(days=settings.MATCH_DATE_WINDOW)
+    expenses = Expense.objects.filter(transaction__isnull=True)\
+                              .annotate(date=Coalesce('budgeted_date', 'income__budgeted_date'))
+    unreconciled = Transaction.unreconciled()
+    transactions = unreconciled if transactions is None else unreconciled & transactions
+
+    if since is not None:
+        expenses = expenses.filter(date__gte=since - window)
+        transactions = transactions.filter(date_posted__gte=as_datetime(since))
+
+    if until is not None:
+        expenses = expenses.filter(date__lte=until + window)
+        transactions = transactions.filter(date_posted__lt=as_datetime(until) + timedelta(days=1))
+
+    index = ExpenseIndex(expenses.values('id', 'budgeted_amount', 'date', 'description').iterator())
+
+    with db_transaction.atomic():
+        # Without any expenses left to pay for, every suggestion is stale
+        if not index and since is None and until is None:
+            MatchSuggestion.objects.all().delete()
+            return 0
+
+        MatchSuggestion.objects.filter(Q(transaction__in=transactions.values('transaction_id')) |
+                                       Q(expense__transaction__isnull=False)).delete()
+
+        matches = find_matches(transactions.values_list('transaction_id', 'amount', 'date_posted', 'name', 'memo')
+                                           .iterator(),
+                               index)
+        created = 0
+
+        while True:
+            batch = [MatchSuggestion(transaction_id=transaction_id, expense_id=expense_id, score=match_score)
+                     for transaction_id, expense_id, match_score in itertools.islice(matches, batch_size)]
+
+            if not batch:
+                return created
+
+            MatchSuggestion.objects.bulk_create(batch, ignore_conflicts=True)
+            created += len(batch)
+
+
+def accept(suggestion_ids):
+    # Links the expense of every accepted suggestion to its transaction. The
+    # best scoring suggestion wins when several were picked for the same
+    # transaction or expense.
+    suggestions = MatchSuggestion.objects.filter(id__in=suggestion_ids,
+                                                 expense__transaction__isnull=True,
+                                                 transaction__reconciled=False)\
+                                         .select_related('expense__income')\
+                                         .order_by('-score', 'id')
+    transactions, expenses = set(), {}
+
+    for suggestion in suggestions:
+        if suggestion.transaction_id in transactions or suggestion.expense_id in expenses:
+            continue
+
+        suggestion.expense.transaction_id = suggestion.transaction_id
+        transactions.add(suggestion.transaction_id)
+        expenses[suggestion.expense_id] = suggestion.expense
+
+    if not expenses:
+        return 0
+
+    with db_transaction.atomic():
+        Expense.objects.bulk_update(expenses.values(), ['transaction'])
+        Transaction.objects.filter(transaction_id__in=transactions).update(reconciled=True)
+        MatchSuggestion.objects.filter(Q(transaction__in=transactions) | Q(expense__in=expenses)).delete()
+
+    # bulk_update doesn't send post_save, so the ledger is told directly
+    dates = [expense.income.budgeted_date for expense in expenses.values() if expense.income_id]
+
+    if dates:
+        ledger.invalidate(min(dates))
+
+    return len(expenses)
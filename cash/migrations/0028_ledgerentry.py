@@ -0,0 +1,25 @@
+# Generated by Django 3.2.25 on 2026-10-18 02:14
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cash', '0027_auto_20201011_1535'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LedgerEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('income', models.FloatField(default=0)),
+                ('total_expenses', models.FloatField(default=0)),
+                ('carry_in', models.FloatField(default=0)),
+                ('carry_out', models.FloatField(default=0)),
+                ('period', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='ledger', to='cash.income')),
+            ],
+        ),
+    ]
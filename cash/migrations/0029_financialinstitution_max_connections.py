@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 02:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cash', '0028_ledgerentry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='financialinstitution',
+            name='max_connections',
+            field=models.PositiveIntegerField(default=2),
+        ),
+    ]
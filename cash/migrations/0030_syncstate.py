@@ -0,0 +1,27 @@
+# Generated by Django 3.2.25 on 2026-10-18 02:24
+
+import datetime
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cash', '0029_financialinstitution_max_connections'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncState',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('window_start', models.DateTimeField(blank=True, null=True)),
+                ('window_end', models.DateTimeField(blank=True, null=True)),
+                ('server_end', models.DateTimeField(blank=True, null=True)),
+                ('overlap', models.DurationField(default=datetime.timedelta(days=7))),
+                ('synced_at', models.DateTimeField(blank=True, null=True)),
+                ('account', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='sync_state', to='cash.account')),
+            ],
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 3.2.25 on 2026-10-18 02:29
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cash', '0030_syncstate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Upload',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sha256', models.CharField(max_length=64)),
+                ('name', models.CharField(blank=True, max_length=255)),
+                ('size', models.PositiveIntegerField(default=0)),
+                ('uploaded_at', models.DateTimeField(auto_now_add=True)),
+                ('ingested_at', models.DateTimeField(blank=True, null=True)),
+                ('first_posted', models.DateField(blank=True, null=True)),
+                ('last_posted', models.DateField(blank=True, null=True)),
+                ('rows', models.PositiveIntegerField(blank=True, null=True)),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='uploads', to='cash.account')),
+            ],
+            options={
+                'unique_together': {('account', 'sha256')},
+            },
+        ),
+    ]
@@ -0,0 +1,89 @@
+# Generated by Django 3.2.25 on 2026-10-18 02:36
+
+from django.db import migrations, models
+
+
+def merge_duplicate_accounts(apps, schema_editor):
+    # Syncs used to be able to create the same account twice. The oldest one
+    # of each is kept and everything pointing at the others moves over to it.
+    Account = apps.get_model('cash', 'Account')
+    Transaction = apps.get_model('cash', 'Transaction')
+    Upload = apps.get_model('cash', 'Upload')
+    SyncState = apps.get_model('cash', 'SyncState')
+    IngestionJob = apps.get_model('cash', 'IngestionJob')
+
+    duplicated = Account.objects.values('bank', 'account_number', 'account_type')\
+                                .annotate(count=models.Count('id'))\
+                                .filter(count__gt=1)
+
+    for group in duplicated:
+        accounts = list(Account.objects.filter(bank=group['bank'],
+                                               account_number=group['account_number'],
+                                               account_type=group['account_type'])
+                                       .order_by('id'))
+        keeper, extras = accounts[0], accounts[1:]
+        extra_ids = [account.id for account in extras]
+
+        Transaction.objects.filter(account__in=extra_ids).update(account=keeper)
+        IngestionJob.objects.filter(account__in=extra_ids).update(account=keeper)
+
+        # The same file uploaded to both only needs to be kept once
+        kept = set(Upload.objects.filter(account=keeper).values_list('sha256', flat=True))
+
+        for upload in Upload.objects.filter(account__in=extra_ids).order_by('id'):
+            if upload.sha256 in kept:
+                upload.delete()
+            else:
+                Upload.objects.filter(id=upload.id).update(account=keeper)
+                kept.add(upload.sha256)
+
+        # Whichever sync state is furthest behind wins so nothing gets missed
+        states = sorted(SyncState.objects.filter(account__in=[keeper.id] + extra_ids),
+                        key=lambda state: (state.window_end is not None, state.window_end))
+
+        if states:
+            SyncState.objects.filter(id__in=[state.id for state in states[1:]]).delete()
+            SyncState.objects.filter(id=states[0].id).update(account=keeper)
+
+        if not keeper.upload_parser:
+            parsers = [account.upload_parser for account in extras if account.upload_parser]
+
+            if parsers:
+                Account.objects.filter(id=keeper.id).update(upload_parser=parsers[0])
+
+        Account.objects.filter(id__in=extra_ids).delete()
+
+    # Postgres won't alter a table with foreign key checks still waiting to
+    # run at the end of the transaction
+    if duplicated and schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cash', '0033_ingestionjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='financialinstitution',
+            name='discovered_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='financialinstitution',
+            name='discovery_message',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='financialinstitution',
+            name='discovery_status',
+            field=models.CharField(blank=True, choices=[('pending', 'pending'), ('running', 'running'), ('done', 'done'), ('failed', 'failed')], max_length=7, null=True),
+        ),
+        migrations.RunPython(merge_duplicate_accounts, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='account',
+            unique_together={('bank', 'account_number', 'account_type')},
+        ),
+    ]
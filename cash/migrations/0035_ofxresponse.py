@@ -0,0 +1,31 @@
+# Generated by Django 3.2.25 on 2026-10-18 03:48
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cash', '0034_account_discovery'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OFXResponse',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('window_start', models.DateTimeField()),
+                ('window_end', models.DateTimeField()),
+                ('fetched_at', models.DateTimeField(auto_now_add=True)),
+                ('size', models.PositiveBigIntegerField(default=0)),
+                ('data', models.BinaryField()),
+                ('accounts', models.ManyToManyField(related_name='ofx_responses', to='cash.Account')),
+                ('bank', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ofx_responses', to='cash.financialinstitution')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='ofxresponse',
+            index=models.Index(fields=['bank', 'window_start'], name='cash_ofxres_bank_id_8cc270_idx'),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 3.2.25 on 2026-10-18 03:53
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cash', '0035_ofxresponse'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MatchSuggestion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('score', models.FloatField()),
+                ('expense', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='match_suggestions', to='cash.expense')),
+                ('transaction', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='match_suggestions', to='cash.transaction')),
+            ],
+            options={
+                'unique_together': {('transaction', 'expense')},
+            },
+        ),
+    ]
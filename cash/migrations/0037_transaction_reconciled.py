@@ -0,0 +1,42 @@
+# Generated by Django 3.2.25 on 2026-10-18 04:03
+
+from django.db import migrations, models
+
+
+def mark_reconciled(apps, schema_editor):
+    Transaction = apps.get_model('cash', 'Transaction')
+
+    attached = models.Q(expense__isnull=False) | \
+        models.Q(income__isnull=False) | \
+        models.Q(transfer_from__isnull=False) | \
+        models.Q(transfer_to__isnull=False)
+
+    Transaction.objects.filter(attached).update(reconciled=True)
+
+
+def default_unreconciled(apps, schema_editor):
+    # Bulk loads insert straight from a staging table and never mention the
+    # column, so the database has to fill it in
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute('ALTER TABLE cash_transaction ALTER COLUMN reconciled SET DEFAULT false')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cash', '0036_matchsuggestion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transaction',
+            name='reconciled',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.RunPython(mark_reconciled, migrations.RunPython.noop),
+        migrations.RunPython(default_unreconciled, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(condition=models.Q(('reconciled', False)), fields=['-date_posted', '-transaction_id'], name='transaction_unreconciled'),
+        ),
+    ]
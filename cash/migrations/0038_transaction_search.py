@@ -0,0 +1,73 @@
+# Generated by Django 3.2.25 on 2026-10-18 04:06
+
+import re
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+WORD = re.compile(r'[a-z0-9]+(?:\.[a-z0-9]+)*')
+
+
+def build_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute('''
+            CREATE INDEX transaction_search ON cash_transaction
+            USING gin (to_tsvector('simple', name || ' ' || memo))
+        ''')
+        return
+
+    Transaction = apps.get_model('cash', 'Transaction')
+    TransactionToken = apps.get_model('cash', 'TransactionToken')
+
+    batch = []
+
+    for transaction_id, name, memo in Transaction.objects.values_list('transaction_id', 'name', 'memo').iterator():
+        for token in {word[:100] for word in WORD.findall('{} {}'.format(name, memo).lower())}:
+            batch.append(TransactionToken(token=token, transaction_id=transaction_id))
+
+        if len(batch) >= 5000:
+            TransactionToken.objects.bulk_create(batch)
+            batch = []
+
+    TransactionToken.objects.bulk_create(batch)
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute('DROP INDEX IF EXISTS transaction_search')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cash', '0037_transaction_reconciled'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TransactionToken',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.CharField(max_length=100)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['amount'], name='transaction_amount'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['date_posted'], name='transaction_date_posted'),
+        ),
+        migrations.AddField(
+            model_name='transactiontoken',
+            name='transaction',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='tokens', to='cash.transaction'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='transactiontoken',
+            unique_together={('token', 'transaction')},
+        ),
+        migrations.RunPython(build_search_index, drop_search_index),
+    ]
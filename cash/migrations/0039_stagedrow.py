@@ -0,0 +1,32 @@
+# Generated by Django 3.2.25 on 2026-10-18 04:17
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cash', '0038_transaction_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StagedRow',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('transaction_id', models.CharField(max_length=255)),
+                ('name', models.CharField(max_length=1000)),
+                ('memo', models.CharField(max_length=1000)),
+                ('amount', models.FloatField()),
+                ('date_posted', models.DateTimeField()),
+                ('transaction_type', models.CharField(max_length=11)),
+                ('check_number', models.IntegerField(null=True)),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='cash.account')),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='staged_rows', to='cash.ingestionjob')),
+            ],
+            options={
+                'unique_together': {('job', 'transaction_id')},
+            },
+        ),
+    ]
@@ -1,17 +1,50 @@
-from datetime import datetime, timedelta
+from datetime import timedelta
 
 from django.db import models, connection
-from django.db.models import Sum, Q
+from django.db.models import Sum, Min, Q, F, OuterRef, Subquery, Value, FloatField, DateField, Window
 from django.db.models.functions import Coalesce, Abs
+from django.utils import timezone
 from django.utils.text import slugify
 
-from ofxtools.utils import UTC as OFX_UTC
 from ofxtools.Client import OFXClient, StmtRq
-from ofxtools.Parser import OFXTree
 
 from recurrence.fields import RecurrenceField
 
 
+class IncomeQuerySet(models.QuerySet):
+    def with_totals(self):
+        expenses = Expense.objects.filter(income=OuterRef('pk'))\
+                                  .values('income')\
+                                  .annotate(total=Sum(Coalesce(Abs('transaction__amount'), 'budgeted_amount')))\
+                                  .values('total')
+
+        return self.annotate(actual_income=Coalesce('transaction__amount', 'budgeted'),
+                             actual_expenses=Coalesce(Subquery(expenses, output_field=FloatField()),
+                                                      Value(0.0)))
+
+    def with_ledger(self):
+        # Same numbers as the persisted ledger but computed on the fly as a
+        # running sum. A manually entered carry over resets the running sum,
+        # so every period is partitioned by the most recent override at or
+        # before it.
+        overrides = Income.objects.filter(budgeted_date__lte=OuterRef('budgeted_date'),
+                                          _carry_over__isnull=False)\
+                                  .exclude(_carry_over=0)\
+                                  .order_by('-budgeted_date', '-id')
+        net = F('actual_income') - Abs(F('actual_expenses'))
+        running_net = Window(Sum(net),
+                             partition_by=[F('override_date')],
+                             order_by=[F('budgeted_date').asc(), F('id').asc()])
+
+        return self.with_totals()\
+                   .annotate(override_date=Subquery(overrides.values('budgeted_date')[:1],
+                                                    output_field=DateField()),
+                             override_amount=Coalesce(Subquery(overrides.values('_carry_over')[:1],
+                                                               output_field=FloatField()),
+                                                      Value(0.0)))\
+                   .annotate(running_carry_over=F('override_amount') + running_net - net)
+
+
 class Income(models.Model):
     budgeted = models.FloatField()
     budgeted_date = models.DateField()
@@ -27,6 +60,8 @@ class Income(models.Model):
                                          on_delete=models.PROTECT)
     _carry_over = models.FloatField(null=True, blank=True)
 
+    objects = IncomeQuerySet.as_manager()
+
     def __str__(self):
         try:
             return self.budgeted_date.isoformat()[:10]
@@ -58,31 +93,85 @@ class Income(models.Model):
             return None
 
     @property
-    def carry_over(self):
-        if self._carry_over:
-            return self._carry_over
+    def ledger_entry(self):
+        try:
+            return self.ledger
+        except LedgerEntry.DoesNotExist:
+            LedgerEntry.recompute(since=self.budgeted_date)
+            self._state.fields_cache.pop('ledger', None)
+            return self.ledger
 
-        if self.previous_income:
-            return (self.previous_income.income - abs(self.previous_income.total_expenses)) + self.previous_income.carry_over
-        else:
-            return 0
+    @property
+    def carry_over(self):
+        return self.ledger_entry.carry_in
 
     @property
     def total_expenses(self):
+        return self.ledger_entry.total_expenses
 
-        expression = Sum(Coalesce(Abs('transaction__amount'), 'budgeted_amount'))
+    def save(self, **kwargs):
+        self.slug = str(self)
+        return super().save(**kwargs)
 
-        total_expenses = Expense.objects.filter(income=self)\
-                                        .aggregate(total_expenses=expression)
 
-        if total_expenses['total_expenses']:
-            return total_expenses['total_expenses']
+class LedgerEntry(models.Model):
+    period = models.OneToOneField(Income,
+                                  on_delete=models.CASCADE,
+                                  related_name='ledger')
+    income = models.FloatField(default=0)
+    total_expenses = models.FloatField(default=0)
+    carry_in = models.FloatField(default=0)
+    carry_out = models.FloatField(default=0)
 
-        return 0
+    def __str__(self):
+        return '{} (${:.2f} -> ${:.2f})'.format(self.period, self.carry_in, self.carry_out)
 
-    def save(self, **kwargs):
-        self.slug = str(self)
-        return super().save(**kwargs)
+    @classmethod
+    def recompute(cls, since=None):
+        # Everything before ``since`` is assumed to be correct already, so
+        # the only thing we need from the past is the carry out of the
+        # period right before it. Periods that have never been computed
+        # pull ``since`` back so that the chain never has holes in it.
+        stale_from = Income.objects.filter(ledger__isnull=True)\
+                                   .aggregate(Min('budgeted_date'))['budgeted_date__min']
+
+        if since is None or (stale_from and stale_from < since):
+            since = stale_from
+
+        if since is None:
+            return 0
+
+        previous = cls.objects.filter(period__budgeted_date__lt=since)\
+                              .order_by('-period__budgeted_date')\
+                              .first()
+        carry = previous.carry_out if previous else 0
+
+        periods = Income.objects.filter(budgeted_date__gte=since)\
+                                .with_totals()\
+                                .order_by('budgeted_date')
+        existing = {e.period_id: e for e in cls.objects.filter(period__budgeted_date__gte=since)}
+
+        updated, created = [], []
+
+        for period in periods:
+            entry = existing.get(period.id)
+
+            if entry is None:
+                entry = cls(period=period)
+                created.append(entry)
+            else:
+                updated.append(entry)
+
+            entry.income = period.actual_income
+            entry.total_expenses = period.actual_expenses
+            entry.carry_in = period._carry_over if period._carry_over else carry
+            entry.carry_out = (entry.income - abs(entry.total_expenses)) + entry.carry_in
+            carry = entry.carry_out
+
+        cls.objects.bulk_update(updated, ['income', 'total_expenses', 'carry_in', 'carry_out'])
+        cls.objects.bulk_create(created)
+
+        return len(updated) + len(created)
 
 
 class Expense(models.Model):
@@ -145,6 +234,20 @@ class Transaction(models.Model):
     check_number = models.IntegerField(null=True)
     transaction_type = models.CharField(max_length=11, choices=TRANSACTION_TYPES)
     account = models.ForeignKey("Account", on_delete=models.CASCADE)
+    # Whether anything is attached to this transaction yet. Kept up to date
+    # by update_reconciled so the reconcile queue can come straight off an
+    # index instead of checking expenses, incomes and transfers for every row.
+    reconciled = models.BooleanField(default=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['-date_posted', '-transaction_id'],
+                         condition=Q(reconciled=False),
+                         name='transaction_unreconciled'),
+            # Amounts and dates typed into a search
+            models.Index(fields=['amount'], name='transaction_amount'),
+            models.Index(fields=['date_posted'], name='transaction_date_posted'),
+        ]
 
     def __str__(self):
         return '{} - {} - ${}'.format(self.name, self.date_posted.date().isoformat(), self.amount)
@@ -154,6 +257,63 @@ class Transaction(models.Model):
         return Transaction.objects.filter(transaction_type='DIRECTDEP')\
                                   .order_by('date_posted')
 
+    @classmethod
+    def unreconciled(cls):
+        # Everything that still needs to go in the reconcile queue
+        return Transaction.objects.filter(reconciled=False)
+
+    @classmethod
+    def update_reconciled(cls, transaction_ids):
+        transaction_ids = [t for t in set(transaction_ids) if t is not None]
+
+        if not transaction_ids:
+            return
+
+        transactions = Transaction.objects.filter(transaction_id__in=transaction_ids)
+        attached = Q(expense__isnull=False) | \
+            Q(income__isnull=False) | \
+            Q(transfer_from__isnull=False) | \
+            Q(transfer_to__isnull=False)
+
+        transactions.filter(attached, reconciled=False).update(reconciled=True)
+        transactions.exclude(attached).filter(reconciled=True).update(reconciled=False)
+
+
+class TransactionToken(models.Model):
+    # The words in a transaction's name and memo, for searching on databases
+    # without full text search
+    token = models.CharField(max_length=100)
+    transaction = models.ForeignKey(Transaction, on_delete=models.CASCADE, related_name='tokens')
+
+    class Meta:
+        unique_together = ('token', 'transaction')
+
+
+class MatchSuggestion(models.Model):
+    # A budgeted expense that looks like it was paid by an unreconciled
+    # transaction. These get rebuilt after every ingestion.
+    transaction = models.ForeignKey(Transaction, on_delete=models.CASCADE, related_name='match_suggestions')
+    expense = models.ForeignKey(Expense, on_delete=models.CASCADE, related_name='match_suggestions')
+    score = models.FloatField()
+
+    class Meta:
+        unique_together = ('transaction', 'expense')
+
+    def __str__(self):
+        return '{} -> {} ({:.2f})'.format(self.transaction, self.expense.description, self.score)
+
+
+JOB_KINDS = [
+    ("csv", "CSV upload"),
+    ("ofx", "OFX sync"),
+]
+
+JOB_STATUSES = [
+    ("pending", "pending"),
+    ("running", "running"),
+    ("done", "done"),
+    ("failed", "failed"),
+]
 
 class FinancialInstitution(models.Model):
     name = models.CharField(max_length=255)
@@ -165,6 +325,11 @@ class FinancialInstitution(models.Model):
     org = models.CharField(max_length=10, null=True, blank=True)
     fid = models.CharField(max_length=10, null=True, blank=True)
     version = models.IntegerField(default=220, null=True, blank=True)
+    max_connections = models.PositiveIntegerField(default=2)
+    # How the last look for accounts at the bank went
+    discovery_status = models.CharField(max_length=7, choices=JOB_STATUSES, null=True, blank=True)
+    discovery_message = models.TextField(blank=True)
+    discovered_at = models.DateTimeField(null=True, blank=True)
 
     def __str__(self):
         return self.name
@@ -178,25 +343,6 @@ class FinancialInstitution(models.Model):
                          version=self.version,
                          bankid=self.bank_id)
 
-    def save(self, **kwargs):
-        saved = super().save(**kwargs)
-
-        if self.ofx_endpoint:
-
-            yesterday = (datetime.now() - timedelta(days=1)).replace(tzinfo=OFX_UTC)
-            response = self.ofx_client.request_accounts(self.password, yesterday)
-            parser = OFXTree()
-            parsed_response = parser.parse(response)
-
-            for account in parsed_response.findall('.//ACCTINFO'):
-                account_type = account.find('.//ACCTTYPE').text
-                account_number = account.find('.//ACCTID').text
-                account_obj, created = Account.objects.get_or_create(account_type=account_type,
-                                                                     account_number=account_number,
-                                                                     bank=self)
-
-        return saved
-
 
 class Account(models.Model):
     account_type = models.CharField(max_length=255)
@@ -204,10 +350,177 @@ class Account(models.Model):
     bank = models.ForeignKey("FinancialInstitution", on_delete=models.CASCADE)
     upload_parser = models.CharField(max_length=255, null=True, blank=True)
 
+    class Meta:
+        unique_together = ('bank', 'account_number', 'account_type')
+
     def __str__(self):
         return '{} - {}'.format(self.account_type, self.bank.name)
 
 
+class Upload(models.Model):
+    # One row per distinct file uploaded for an account, keyed by the sha256
+    # of its contents
+    account = models.ForeignKey(Account, on_delete=models.CASCADE, related_name='uploads')
+    sha256 = models.CharField(max_length=64)
+    name = models.CharField(max_length=255, blank=True)
+    size = models.PositiveIntegerField(default=0)
+    uploaded_at = models.DateTimeField(auto_now_add=True)
+    ingested_at = models.DateTimeField(null=True, blank=True)
+    # Posting dates the file covered once it was ingested
+    first_posted = models.DateField(null=True, blank=True)
+    last_posted = models.DateField(null=True, blank=True)
+    rows = models.PositiveIntegerField(null=True, blank=True)
+
+    class Meta:
+        unique_together = ('account', 'sha256')
+
+    def __str__(self):
+        return '{} ({})'.format(self.name or self.sha256, self.account)
+
+
+class UploadChunk(models.Model):
+    # Uploaded files live in the database so a worker on any machine can
+    # read them back
+    upload = models.ForeignKey(Upload, on_delete=models.CASCADE, related_name='chunks')
+    index = models.PositiveIntegerField()
+    data = models.BinaryField()
+
+    class Meta:
+        unique_together = ('upload', 'index')
+
+
+class SyncState(models.Model):
+    account = models.OneToOneField(Account,
+                                   on_delete=models.CASCADE,
+                                   related_name='sync_state')
+    window_start = models.DateTimeField(null=True, blank=True)
+    window_end = models.DateTimeField(null=True, blank=True)
+    # Where the bank says the statement actually ended, which can be earlier
+    # than what we asked for
+    server_end = models.DateTimeField(null=True, blank=True)
+    # Banks post some transactions days after the date they carry, so every
+    # sync goes back over this much of the last one
+    overlap = models.DurationField(default=timedelta(days=7))
+    synced_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return '{} ({} - {})'.format(self.account, self.window_start, self.window_end)
+
+    @property
+    def next_start(self):
+        end = self.server_end or self.window_end
+
+        if end:
+            return end - self.overlap
+
+
+class OFXResponse(models.Model):
+    # The raw statement download from a sync, gzipped, so transactions can
+    # be parsed again later without asking the bank
+    bank = models.ForeignKey(FinancialInstitution, on_delete=models.CASCADE, related_name='ofx_responses')
+    accounts = models.ManyToManyField(Account, related_name='ofx_responses')
+    window_start = models.DateTimeField()
+    window_end = models.DateTimeField()
+    fetched_at = models.DateTimeField(auto_now_add=True)
+    size = models.PositiveBigIntegerField(default=0)
+    data = models.BinaryField()
+
+    class Meta:
+        indexes = [models.Index(fields=['bank', 'window_start'])]
+
+    def __str__(self):
+        return '{} ({} - {})'.format(self.bank, self.window_start, self.window_end)
+
+
+class IngestionJob(models.Model):
+    kind = models.CharField(max_length=3, choices=JOB_KINDS)
+    status = models.CharField(max_length=7, choices=JOB_STATUSES, default='pending')
+    bank = models.ForeignKey(FinancialInstitution, on_delete=models.CASCADE, null=True, blank=True)
+    account = models.ForeignKey(Account, on_delete=models.CASCADE, null=True, blank=True)
+    upload = models.ForeignKey(Upload, on_delete=models.SET_NULL, null=True, blank=True)
+    # Counts are bumped a batch at a time while the job runs
+    rows_read = models.PositiveIntegerField(default=0)
+    inserted = models.PositiveIntegerField(default=0)
+    updated = models.PositiveIntegerField(default=0)
+    duplicates = models.PositiveIntegerField(default=0)
+    errors = models.PositiveIntegerField(default=0)
+    bytes_read = models.PositiveBigIntegerField(default=0)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return '{} {} ({})'.format(self.get_kind_display(), self.id, self.status)
+
+    @property
+    def seconds(self):
+        if self.started_at:
+            return ((self.finished_at or timezone.now()) - self.started_at).total_seconds()
+
+        return 0
+
+    @property
+    def rows_per_second(self):
+        seconds = self.seconds
+        return self.rows_read / seconds if seconds else 0
+
+    def start(self):
+        self.status = 'running'
+        self.started_at = timezone.now()
+        IngestionJob.objects.filter(id=self.id).update(status=self.status, started_at=self.started_at)
+
+    def finish(self, error=None, failed=True):
+        # Only the status fields are saved so counts other threads have
+        # added in the meantime aren't overwritten. ``failed`` is off for
+        # errors that only cost a few rows.
+        self.status = 'failed' if error and failed else 'done'
+        self.finished_at = timezone.now()
+        self.error = error or ''
+        IngestionJob.objects.filter(id=self.id).update(status=self.status,
+                                                       finished_at=self.finished_at,
+                                                       error=self.error)
+
+    def as_dict(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'bank': self.bank_id,
+            'account': self.account_id,
+            'upload': self.upload_id,
+            'rows_read': self.rows_read,
+            'inserted': self.inserted,
+            'updated': self.updated,
+            'duplicates': self.duplicates,
+            'errors': self.errors,
+            'bytes_read': self.bytes_read,
+            'seconds': self.seconds,
+            'rows_per_second': self.rows_per_second,
+            'error': self.error,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+        }
+
+
+class StagedRow(models.Model):
+    # A parsed row of a bulk upload waiting on the merge. Every file of a job
+    # stages its rows here so they don't ride through the result backend, and
+    # whichever file stages a transaction first keeps it.
+    job = models.ForeignKey(IngestionJob, on_delete=models.CASCADE, related_name='staged_rows')
+    transaction_id = models.CharField(max_length=255)
+    name = models.CharField(max_length=1000)
+    memo = models.CharField(max_length=1000)
+    amount = models.FloatField()
+    date_posted = models.DateTimeField()
+    transaction_type = models.CharField(max_length=11)
+    account = models.ForeignKey(Account, on_delete=models.CASCADE)
+    check_number = models.IntegerField(null=True)
+
+    class Meta:
+        unique_together = ('job', 'transaction_id')
+
+
 class Transfer(models.Model):
     transaction_from = models.OneToOneField(Transaction,
                                             on_delete=models.CASCADE,
@@ -0,0 +1,210 @@
+import codecs
+import html
+import re
+import urllib.request
+from datetime import datetime, timedelta
+
+from ofxtools.header import OFXHeaderV1
+from ofxtools.utils import UTC as OFX_UTC
+
+
+# Same tag soup tokenizer ofxtools uses, except that it's run over a stream
+# instead of the whole decoded document. Each match is one tag plus whatever
+# text runs up to the next tag.
+TOKEN = re.compile(r'<(?P<close>/?)(?P<tag>[A-Z0-9./_ ]+?)>(?P<text>[^<]*)')
+CHARSET = re.compile(r'CHARSET:\s*(?P<charset>[\w-]+)')
+DATETIME = re.compile(r'(?P<stamp>\d{8,14})(\.\d+)?(\[(?P<offset>[+-]?\d+(\.\d+)?)(:\w+)?\])?')
+
+CHUNK_SIZE = 64 * 1024
+
+# Responses that carry a STATUS for what was asked for
+STATUS_AGGREGATES = {'SONRS', 'STMTTRNRS', 'CCSTMTTRNRS'}
+
+
+class OFXError(Exception):
+    pass
+
+
+def read_header(source, chunk_size=CHUNK_SIZE):
+    # Everything up to the <OFX> tag is header, either the OFXv1 colon
+    # separated lines or the OFXv2 XML declarations. Hands back the codec
+    # for the body and whatever part of the body got read along the way.
+    raw = b''
+
+    while b'<OFX>' not in raw:
+        chunk = source.read(chunk_size)
+
+        if not chunk:
+            break
+
+        raw += chunk
+
+    header, _, body = raw.partition(b'<OFX>')
+    charset = CHARSET.search(header.decode('ascii', 'replace'))
+    codec = 'utf_8'
+
+    if charset:
+        codec = OFXHeaderV1.codecs.get(charset.group('charset'), codec)
+
+    return codec, b'<OFX>' + body
+
+
+def iter_tokens(source, chunk_size=CHUNK_SIZE):
+    codec, body = read_header(source, chunk_size=chunk_size)
+    decoder = codecs.getincrementaldecoder(codec)(errors='replace')
+    pending = decoder.decode(body)
+
+    while True:
+        chunk = source.read(chunk_size)
+        final = not chunk
+        pending += decoder.decode(chunk or b'', final=final)
+
+        # A tag's text isn't finished until the next tag shows up, so hold
+        # on to everything after the last '<' until more data arrives.
+        if final:
+            complete, pending = pending, ''
+        else:
+            cut = pending.rfind('<')
+
+            if cut <= 0:
+                continue
+
+            complete, pending = pending[:cut], pending[cut:]
+
+        for match in TOKEN.finditer(complete):
+            yield bool(match.group('close')), match.group('tag'), match.group('text').strip()
+
+        if final:
+            return
+
+
+def watch_statuses(tokens, statuses):
+    # Passes tokens through while keeping the STATUS of every statement
+    # response in ``statuses`` as (code, message), keyed by the account it
+    # was for. A statement that failed doesn't say which account it was for,
+    # so those pile up under None instead. A failed sign on fails the whole
+    # response.
+    aggregate, code, message, account = None, None, '', None
+
+    for close, name, text in tokens:
+        if name in STATUS_AGGREGATES and not close:
+            aggregate, code, message, account = name, None, '', None
+
+        elif name in STATUS_AGGREGATES and name == aggregate:
+            if aggregate == 'SONRS':
+                if code != '0':
+                    raise OFXError('Sign on failed: {} {}'.format(code, message).strip())
+            elif account is None:
+                statuses.setdefault(None, []).append((code, message))
+
+            aggregate = None
+
+        elif aggregate is not None and text:
+            if name == 'CODE' and code is None:
+                code = text
+            elif name == 'MESSAGE' and not message:
+                message = html.unescape(text)
+            elif name == 'ACCTID' and account is None and aggregate != 'SONRS':
+                account = html.unescape(text)
+                statuses[account] = (code, message)
+
+        yield close, name, text
+
+
+def iter_records(source, tag, context=(), chunk_size=CHUNK_SIZE, statuses=None):
+    # Yield every ``tag`` aggregate in an OFX document as a flat dict of the
+    # data elements inside of it as soon as its closing tag has been read.
+    # Direct children win over elements nested further down, so
+    # ``record['NAME']`` is the same element ``find('NAME')`` would return.
+    #
+    # Data elements named in ``context`` that show up outside of a record
+    # are remembered and handed back along with every record after them.
+    # That's how a transaction finds out which account's statement it was in.
+    # Running into the first one of them again starts a fresh context.
+    #
+    # Statement statuses go in ``statuses`` when it's given; see
+    # watch_statuses.
+    stack = []
+    record = None
+    depth = None
+    current = {}
+    tokens = iter_tokens(source, chunk_size=chunk_size)
+
+    if statuses is not None:
+        tokens = watch_statuses(tokens, statuses)
+
+    for close, name, text in tokens:
+        if close:
+            # Closing tags for data elements are optional (and meaningless)
+            if name not in stack:
+                continue
+
+            while stack.pop() != name:
+                pass
+
+            if record is not None and len(stack) < depth:
+                yield dict(current), record
+                record = None
+
+        elif text:
+            value = html.unescape(text)
+
+            if record is None:
+                if name in context:
+                    if name == context[0]:
+                        current = {}
+                    current[name] = value
+            elif len(stack) == depth:
+                record[name] = value
+            else:
+                record.setdefault(name, value)
+
+        else:
+            stack.append(name)
+
+            if name == tag and record is None:
+                record = {}
+                depth = len(stack)
+
+
+def iter_aggregates(source, tag, chunk_size=CHUNK_SIZE):
+    for _, record in iter_records(source, tag, chunk_size=chunk_size):
+        yield record
+
+
+def iter_statement_transactions(source, chunk_size=CHUNK_SIZE, statuses=None):
+    # Statements for any number of accounts can come back in one response.
+    # Each one starts with the account it's for and the date range the bank
+    # actually covered, ahead of its transactions.
+    yield from iter_records(source,
+                            'STMTTRN',
+                            context=('ACCTID', 'DTSTART', 'DTEND'),
+                            chunk_size=chunk_size,
+                            statuses=statuses)
+
+
+def parse_datetime(value):
+    # OFX datetimes are YYYYMMDD with optional HHMMSS, fractional seconds and
+    # a [offset:TZ] suffix. Anything without an offset is UTC.
+    match = DATETIME.match(value or '')
+
+    if not match:
+        return None
+
+    parsed = datetime.strptime(match.group('stamp').ljust(14, '0'), '%Y%m%d%H%M%S')
+
+    if match.group('offset'):
+        parsed -= timedelta(hours=float(match.group('offset')))
+
+    return parsed.replace(tzinfo=OFX_UTC)
+
+
+def post(client, request, timeout=None):
+    # OFXClient.download reads the whole response into memory before handing
+    # it back. This sends the same request but returns the open response so
+    # it can be parsed while it's still coming in.
+    http_request = urllib.request.Request(client.url,
+                                          method='POST',
+                                          data=request,
+                                          headers=client.http_headers)
+    return urllib.request.urlopen(http_request, timeout=timeout)
@@ -0,0 +1,144 @@
+from datetime import datetime
+
+from django.conf import settings
+
+from ofxtools.utils import UTC as OFX_UTC
+
+from .ingestion import TransactionRow, row_id
+
+
+class CSVFormat(object):
+    # Describes one bank's CSV export. ``date``, ``amount`` and ``name`` are
+    # the names of the columns those come from. When there's no
+    # ``transaction_type`` column the type comes from the sign of the amount.
+    # ``type_rules`` are (column, text, type) triples that override the type
+    # when ``text`` shows up in ``column``, checked in order. ``negate`` is
+    # for banks that export money going out as positive numbers.
+
+    def __init__(self,
+                 name,
+                 date,
+                 amount,
+                 description,
+                 date_format='%m/%d/%Y',
+                 memo=None,
+                 transaction_type=None,
+                 check_number=None,
+                 type_rules=(),
+                 negate=False,
+                 aliases=()):
+        self.name = name
+        self.date = date
+        self.amount = amount
+        self.description = description
+        self.date_format = date_format
+        self.memo = memo or description
+        self.transaction_type = transaction_type
+        self.check_number = check_number
+        self.type_rules = [tuple(rule) for rule in type_rules]
+        self.negate = negate
+        self.aliases = list(aliases)
+
+    def __repr__(self):
+        return '<CSVFormat: {}>'.format(self.name)
+
+    @property
+    def columns(self):
+        columns = {self.date, self.amount, self.description, self.memo}
+
+        for column in [self.transaction_type, self.check_number]:
+            if column:
+                columns.add(column)
+
+        for column, _, _ in self.type_rules:
+            columns.add(column)
+
+        return columns
+
+    def matches(self, header):
+        return self.columns <= set(header or [])
+
+    def get_type(self, row, amount):
+        for column, text, transaction_type in self.type_rules:
+            if text in row[column]:
+                return transaction_type
+
+        if self.transaction_type:
+            return row[self.transaction_type]
+
+        return 'DEBIT' if amount < 0 else 'CREDIT'
+
+    def posted(self, row):
+        return datetime.strptime(row[self.date], self.date_format).replace(tzinfo=OFX_UTC)
+
+    def transaction_row(self, row, account_id):
+        amount = float(row[self.amount])
+
+        if self.negate:
+            amount = -amount
+
+        check_number = None
+
+        if self.check_number and row[self.check_number]:
+            check_number = row[self.check_number]
+
+        return TransactionRow(transaction_id=row_id(row),
+                              name=row[self.description],
+                              memo=row[self.memo],
+                              amount=amount,
+                              date_posted=self.posted(row),
+                              check_number=check_number,
+                              transaction_type=self.get_type(row, amount),
+                              account_id=account_id)
+
+    def rows(self, records, account_id):
+        for row in records:
+            yield self.transaction_row(row, account_id)
+
+
+BUILTIN_FORMATS = [
+    {
+        'name': 'chase',
+        'aliases': ['chase_parser'],
+        'date': 'Posting Date',
+        'amount': 'Amount',
+        'description': 'Description',
+        'transaction_type': 'Details',
+        'check_number': 'Check or Slip #',
+        'type_rules': [
+            ('Description', 'INTEREST PAYMENT', 'INT'),
+            ('Type', 'ACCT_XFER', 'XFER'),
+        ],
+    },
+    {
+        'name': 'citizens',
+        'aliases': ['citizens_bank_parser'],
+        'date': 'Date',
+        'amount': 'Amount',
+        'description': 'Description',
+    },
+]
+
+
+def load_formats():
+    formats = {}
+
+    for config in BUILTIN_FORMATS + list(getattr(settings, 'CSV_FORMATS', [])):
+        csv_format = CSVFormat(**config)
+
+        for name in [csv_format.name] + csv_format.aliases:
+            formats[name] = csv_format
+
+    return formats
+
+
+def get_format(name):
+    return load_formats().get(name)
+
+
+def sniff(header):
+    # The format that explains the most columns in the header wins
+    candidates = [f for f in set(load_formats().values()) if f.matches(header)]
+
+    if candidates:
+        return max(candidates, key=lambda f: len(f.columns))
@@ -0,0 +1,198 @@
+import re
+from collections import Counter, defaultdict
+from datetime import date, datetime, time, timedelta
+from statistics import median
+
+import recurrence
+
+from django.conf import settings
+from django.db import transaction as db_transaction
+
+from . import ledger
+from .models import Income, Transaction
+from .periods import rehome_expenses
+
+
+# Words banks pad direct deposit descriptions with that don't say anything
+# about who sent the money
+NOISE = {'ach', 'co', 'dep', 'deposit', 'des', 'dir', 'direct', 'id', 'indn', 'payroll', 'ppd', 'reg', 'sal',
+         'salary'}
+
+
+def payer(name):
+    # "ACME CORP PAYROLL PPD ID: 123456789" and "Acme Corp Dir Dep 0415"
+    # are both "acme corp"
+    return ' '.join(word for word in re.findall('[a-z0-9]+', (name or '').lower())
+                    if word not in NOISE and not any(c.isdigit() for c in word))
+
+
+def month_day(day):
+    # The end of the month moves around, so anything that late is the last
+    # day of whichever month it is
+    return -1 if day.day >= 28 else day.day
+
+
+def rules(dates, until):
+    # One rule per cadence we know how to spot. Each one starts on the first
+    # paycheck that lands where that cadence says it should.
+    weekday = Counter(day.weekday() for day in dates).most_common(1)[0][0]
+    anchor = next(day for day in dates if day.weekday() == weekday)
+
+    yield 'weekly', anchor, recurrence.Rule(recurrence.WEEKLY, interval=1, byday=weekday, until=until)
+    yield 'biweekly', anchor, recurrence.Rule(recurrence.WEEKLY, interval=2, byday=weekday, until=until)
+
+    days = [day for day, _ in Counter(month_day(day) for day in dates).most_common(2)]
+
+    if len(days) == 2:
+        anchor = next(day for day in dates if month_day(day) in days)
+        yield 'semi-monthly', anchor, recurrence.Rule(recurrence.MONTHLY, bymonthday=sorted(days, key=lambda d: d % 32),
+                                                      until=until)
+
+
+def pair(occurrences, deposits, slack):
+    # Both lists are sorted by date, so every scheduled payday takes the
+    # first deposit that's close enough to it and hasn't been used yet.
+    # Banks move paydays around weekends and holidays.
+    paired = []
+    index = 0
+
+    for occurrence in occurrences:
+        while index < len(deposits) and deposits[index][0] < occurrence - slack:
+            index += 1
+
+        if index < len(deposits) and deposits[index][0] <= occurrence + slack:
+            paired.append((occurrence, deposits[index]))
+            index += 1
+        else:
+            paired.append((occurrence, None))
+
+    return paired
+
+
+class PaycheckSeries(object):
+    # A proposed series of incomes for one payer, with the direct deposit
+    # that goes with each one they've already paid out
+
+    def __init__(self, payer, cadence, recurrences, paychecks):
+        self.payer = payer
+        self.cadence = cadence
+        self.recurrences = recurrences
+        self.paychecks = paychecks
+
+        amounts = [deposit[2] for _, deposit in paychecks if deposit is not None]
+        self.budgeted = median(amounts)
+        self.deposits = len(amounts)
+
+    def __str__(self):
+        return '{} ({}, ${:.2f})'.format(self.payer, self.cadence, self.budgeted)
+
+    @property
+    def first_date(self):
+        return self.paychecks[0][0]
+
+
+def detect_paychecks(transactions=None, until=None):
+    # Groups direct deposits that aren't attached to an income yet by who
+    # sent them and proposes a series for every payer with a cadence that
+    # explains enough of their deposits
+    if transactions is None:
+        transactions = Transaction.unreconciled() & Transaction.maybe_paychecks()
+
+    until = until or date.today() + timedelta(days=365)
+    slack = timedelta(days=settings.PAYCHECK_DATE_SLACK)
+
+    by_payer = defaultdict(list)
+
+    for transaction_id, name, memo, amount, date_posted in transactions.filter(amount__gt=0)\
+                                                                       .order_by('date_posted')\
+                                                                       .values_list('transaction_id', 'name', 'memo',
+                                                                                    'amount', 'date_posted'):
+        by_payer[payer(name) or payer(memo)].append((date_posted.date(), transaction_id, amount))
+
+    proposals = []
+
+    for name, deposits in by_payer.items():
+        if not name or len(deposits) < settings.PAYCHECK_MIN_DEPOSITS:
+            continue
+
+        dates = [day for day, _, _ in deposits]
+        best, best_coverage = None, 0
+
+        for cadence, anchor, rule in rules(dates, datetime.combine(until, time(5))):
+            recurrences = recurrence.Recurrence(dtstart=datetime.combine(anchor, time(5)), rrules=[rule])
+            occurrences = [occurrence.date() for occurrence in recurrences.occurrences()]
+            paychecks = pair(occurrences, [d for d in deposits if d[0] >= anchor - slack], slack)
+
+            # Every deposit should be a payday and every payday up until the
+            # last deposit should have had one
+            scheduled = sum(1 for occurrence in occurrences if occurrence <= dates[-1] + slack)
+            paid = sum(1 for _, deposit in paychecks if deposit is not None)
+            coverage = paid / max(len(deposits), scheduled)
+
+            if coverage > best_coverage:
+                best = PaycheckSeries(name, cadence, recurrences, paychecks)
+                best_coverage = coverage
+
+        if best is not None and best_coverage >= settings.PAYCHECK_MIN_COVERAGE:
+            proposals.append(best)
+
+    return sorted(proposals, key=lambda series: -series.deposits)
+
+
+def create_series(series):
+    # Creates every income in ``series`` in one go. Days that already have an
+    # income keep it and get the deposit if it doesn't have one yet. Hands
+    # back how many were created and the days whose deposit had nowhere to go.
+    taken, open_incomes = set(), {}
+
+    for income_id, day, transaction_id in Income.objects.filter(budgeted_date__gte=series.first_date)\
+                                                        .values_list('id', 'budgeted_date', 'transaction_id'):
+        taken.add(day)
+
+        if transaction_id is None:
+            open_incomes.setdefault(day, income_id)
+
+    paychecks = [(day, deposit) for day, deposit in series.paychecks if day not in taken]
+    attached = {day: Income(id=open_incomes[day], transaction_id=deposit[1])
+                for day, deposit in series.paychecks
+                if day in open_incomes and deposit is not None}
+    unlinked = [day for day, deposit in series.paychecks
+                if day in taken and day not in open_incomes and deposit is not None]
+
+    if attached:
+        with db_transaction.atomic(), ledger.deferred_updates():
+            Income.objects.bulk_update(attached.values(), ['transaction'])
+            Transaction.objects.filter(transaction_id__in=[income.transaction_id for income in attached.values()])\
+                               .update(reconciled=True)
+            ledger.invalidate(min(attached))
+
+    if not paychecks:
+        return 0, unlinked
+
+    with db_transaction.atomic(), ledger.deferred_updates():
+        (first_date, first_deposit), rest = paychecks[0], paychecks[1:]
+
+        first = Income.objects.create(budgeted=series.budgeted,
+                                      budgeted_date=first_date,
+                                      transaction_id=first_deposit and first_deposit[1],
+                                      recurrences=series.recurrences)
+
+        incomes = [Income(budgeted=series.budgeted,
+                          budgeted_date=day,
+                          slug=day.isoformat(),
+                          transaction_id=deposit and deposit[1],
+                          first_occurrence=first,
+                          recurrences=series.recurrences)
+                   for day, deposit in rest]
+
+        Income.objects.bulk_create(incomes)
+        Transaction.objects.filter(transaction_id__in=[income.transaction_id for income in incomes])\
+                           .update(reconciled=True)
+        ledger.invalidate(first_date)
+
+        _, moved_from = rehome_expenses([first.id] + [income.id for income in incomes])
+
+        if moved_from:
+            ledger.invalidate(moved_from)
+
+    return len(paychecks), unlinked
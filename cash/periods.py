@@ -0,0 +1,81 @@
+from bisect import bisect_right
+
+from django.db import connection
+
+from .ledger import as_date
+from .models import Income
+
+
+# Every period runs from its own budgeted date up until the next one. Any
+# expense that falls inside one of the given periods but isn't attached to
+# it yet gets moved there. The old period's date comes back so that we know
+# how far back the ledger needs to be recomputed.
+REHOME_EXPENSES = '''
+    WITH periods AS (
+        SELECT
+            id,
+            budgeted_date AS starts,
+            LEAD(budgeted_date) OVER (ORDER BY budgeted_date, id) AS ends
+        FROM cash_income
+    )
+    UPDATE cash_expense AS expense
+    SET income_id = periods.id
+    FROM periods, cash_expense AS previous
+    LEFT JOIN cash_income AS previous_income
+      ON previous_income.id = previous.income_id
+    WHERE periods.id IN ({income_ids})
+      AND previous.id = expense.id
+      AND expense.budgeted_date >= periods.starts
+      AND (periods.ends IS NULL OR expense.budgeted_date < periods.ends)
+      AND (expense.income_id IS NULL OR expense.income_id <> periods.id)
+    RETURNING previous_income.budgeted_date
+'''
+
+
+def rehome_expenses(income_ids):
+    if not income_ids:
+        return 0, None
+
+    query = REHOME_EXPENSES.format(income_ids=', '.join(['%s'] * len(income_ids)))
+
+    with connection.cursor() as cursor:
+        cursor.execute(query, list(income_ids))
+        moved_from = [row[0] for row in cursor.fetchall()]
+
+    earliest = min((d for d in moved_from if d is not None), default=None)
+
+    return len(moved_from), earliest
+
+
+class PayPeriods(object):
+    # Loads the start date of every pay period once so that assigning a
+    # whole series of expenses to their periods is a binary search per
+    # occurrence instead of a query per occurrence.
+
+    def __init__(self, queryset=None):
+        if queryset is None:
+            queryset = Income.objects.all()
+
+        periods = queryset.order_by('budgeted_date', 'id').values_list('id', 'budgeted_date')
+
+        self.ids = [period_id for period_id, _ in periods]
+        self.dates = [budgeted_date for _, budgeted_date in periods]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def index(self, expense_date):
+        index = bisect_right(self.dates, as_date(expense_date)) - 1
+
+        # If we can't find an income here that means that we're back before
+        # there is any income. The way to reconcile this is to just stick it
+        # into the chronologically first one
+        return max(index, 0)
+
+    def income_id(self, expense_date):
+        if self.ids:
+            return self.ids[self.index(expense_date)]
+
+    def budgeted_date(self, expense_date):
+        if self.dates:
+            return self.dates[self.index(expense_date)]
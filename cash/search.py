@@ -0,0 +1,152 @@
+import re
+from datetime import datetime, time, timedelta
+
+from django.conf import settings
+from django.core.paginator import InvalidPage, Page, Paginator
+from django.db import connection
+from django.db.models import BooleanField, Case, F, FloatField, Func, Value, When
+from django.utils import timezone
+
+from .models import TransactionToken
+
+
+# Has to match the expression the transaction_search index was built on or
+# Postgres won't use it. Built from the columns rather than written out so
+# it still points at the right table inside a subquery.
+SEARCH_VECTOR = Func(F('name'), F('memo'), template="to_tsvector('simple', %(expressions)s)", arg_joiner=" || ' ' || ")
+
+WORD = re.compile(r'[a-z0-9]+(?:\.[a-z0-9]+)*')
+AMOUNT = re.compile(r'^\$(\d+(?:\.\d{1,2})?)$|^(\d+\.\d{1,2})$')
+DATE_FORMATS = ['%Y-%m-%d', '%m/%d/%Y', '%m/%d/%y']
+
+
+def uses_full_text():
+    return connection.vendor == 'postgresql'
+
+
+def tokens(*texts):
+    return {word[:100] for text in texts for word in WORD.findall((text or '').lower())}
+
+
+def parse_date(text):
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(text, date_format).date()
+        except ValueError:
+            pass
+
+
+def parse_query(text):
+    # "$12.50 coffee 10/01/2020" looks for coffee that cost $12.50 on
+    # October 1st. Plain numbers are left as words since they're usually part
+    # of a store number or a check number.
+    words, amounts, days = [], [], []
+
+    for part in text.split():
+        amount = AMOUNT.match(part)
+        day = parse_date(part)
+
+        if amount:
+            amounts.append(float(amount.group(1) or amount.group(2)))
+        elif day:
+            days.append(day)
+        else:
+            words.extend(WORD.findall(part.lower()))
+
+    return words, amounts, days
+
+
+def search(queryset, text):
+    # Every word has to show up at the start of a word in the name or memo,
+    # so a search works while the last word is still being typed
+    words, amounts, days = parse_query(text)
+
+    for amount in amounts:
+        queryset = queryset.filter(amount__in=[amount, -amount])
+
+    for day in days:
+        start = datetime.combine(day, time.min, tzinfo=timezone.utc)
+        queryset = queryset.filter(date_posted__gte=start, date_posted__lt=start + timedelta(days=1))
+
+    if not words:
+        return queryset.order_by('-date_posted')
+
+    if uses_full_text():
+        query = Func(Value(' & '.join('{}:*'.format(word) for word in words)),
+                     template="to_tsquery('simple', %(expressions)s)")
+
+        matches = Func(SEARCH_VECTOR, query, template='%(expressions)s', arg_joiner=' @@ ',
+                       output_field=BooleanField())
+        queryset = queryset.filter(matches)
+
+        # A letter or two matches most of the table and the ranking would
+        # cost more than the search, so those are just newest first. Longer
+        # words only rank the newest few hundred matches, and everything
+        # older comes after them newest first. Anything the search should be
+        # narrowed down to has to be filtered on before it gets here, or the
+        # candidates could all be outside of it.
+        if max(len(word) for word in words) < settings.SEARCH_RANK_MIN_PREFIX:
+            return queryset.order_by('-date_posted')
+
+        candidates = queryset.order_by('-date_posted').values('transaction_id')[:settings.SEARCH_RANK_CANDIDATES]
+        rank = Case(When(transaction_id__in=candidates,
+                         then=Func(SEARCH_VECTOR, query, function='ts_rank', output_field=FloatField())))
+
+        return queryset.annotate(rank=rank).order_by(F('rank').desc(nulls_last=True), '-date_posted')
+
+    # Tokens are kept lowercase, so everything starting with a word sorts
+    # between it and it followed by the highest character there is. Unlike
+    # LIKE that's a range any database can read off the index.
+    for word in words:
+        matching = TransactionToken.objects.filter(token__gte=word, token__lt=word + '\uffff')
+        queryset = queryset.filter(transaction_id__in=matching.values('transaction_id'))
+
+    return queryset.order_by('-date_posted')
+
+
+def index_transactions(transactions):
+    # Keeps the token index up to date on databases without full text
+    # search. Postgres searches the transactions themselves.
+    if uses_full_text():
+        return
+
+    transactions = list(transactions)
+
+    TransactionToken.objects.filter(transaction__in=[t.transaction_id for t in transactions]).delete()
+    TransactionToken.objects.bulk_create([TransactionToken(token=token, transaction_id=t.transaction_id)
+                                          for t in transactions
+                                          for token in tokens(t.name, t.memo)],
+                                         ignore_conflicts=True)
+
+
+class PeekPage(Page):
+    def __init__(self, object_list, number, paginator, more):
+        super().__init__(object_list, number, paginator)
+        self.more = more
+
+    def has_next(self):
+        return self.more
+
+
+class PeekPaginator(Paginator):
+    # Counting every match just to know whether there's another page costs
+    # more than the search itself, so each page reads one row past its end
+    # instead
+
+    def validate_number(self, number):
+        try:
+            number = int(number)
+        except (TypeError, ValueError):
+            raise InvalidPage('That page number is not an integer')
+
+        if number < 1:
+            raise InvalidPage('That page number is less than 1')
+
+        return number
+
+    def page(self, number):
+        number = self.validate_number(number)
+        bottom = (number - 1) * self.per_page
+        rows = list(self.object_list[bottom:bottom + self.per_page + 1])
+
+        return PeekPage(rows[:self.per_page], number, self, len(rows) > self.per_page)
@@ -0,0 +1,92 @@
+from django.db import transaction
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+
+from . import ledger, search
+from .models import Income, Expense, Transaction, Transfer, FinancialInstitution
+from .tasks import discover_accounts
+
+
+def earliest(*dates):
+    dates = [ledger.as_date(d) for d in dates if d is not None]
+
+    if dates:
+        return min(dates)
+
+
+@receiver(pre_save, sender=Income)
+@receiver(pre_save, sender=Expense)
+def remember_previous_state(sender, instance, **kwargs):
+    instance._previous_date = None
+    instance._previous_transaction_id = None
+
+    if instance.pk is None:
+        return
+
+    if sender is Income:
+        previous = Income.objects.filter(pk=instance.pk).values_list('budgeted_date', 'transaction_id')
+    else:
+        previous = Expense.objects.filter(pk=instance.pk).values_list('income__budgeted_date', 'transaction_id')
+
+    instance._previous_date, instance._previous_transaction_id = previous.first() or (None, None)
+
+
+def update_reconciled(instance):
+    Transaction.update_reconciled([instance.transaction_id,
+                                   getattr(instance, '_previous_transaction_id', None)])
+
+
+@receiver(post_save, sender=Income)
+@receiver(post_delete, sender=Income)
+def income_changed(sender, instance, **kwargs):
+    ledger.invalidate(earliest(instance.budgeted_date,
+                               getattr(instance, '_previous_date', None)))
+    update_reconciled(instance)
+
+
+@receiver(post_save, sender=Expense)
+@receiver(post_delete, sender=Expense)
+def expense_changed(sender, instance, **kwargs):
+    current_date = None
+
+    if instance.income_id:
+        current_date = Income.objects.filter(pk=instance.income_id)\
+                                     .values_list('budgeted_date', flat=True)\
+                                     .first()
+
+    since = earliest(current_date, getattr(instance, '_previous_date', None))
+
+    if since is not None:
+        ledger.invalidate(since)
+
+    update_reconciled(instance)
+
+
+@receiver(post_save, sender=Transfer)
+@receiver(post_delete, sender=Transfer)
+def transfer_changed(sender, instance, **kwargs):
+    Transaction.update_reconciled([instance.transaction_from_id, instance.transaction_to_id])
+
+
+@receiver(post_save, sender=Transaction)
+def transaction_changed(sender, instance, created, **kwargs):
+    search.index_transactions([instance])
+
+    # A brand new transaction can't be attached to anything yet
+    if created:
+        return
+
+    affected = Income.objects.filter(transaction=instance) | Income.objects.filter(expense__transaction=instance)
+    since = affected.values_list('budgeted_date', flat=True).order_by('budgeted_date').first()
+
+    if since is not None:
+        ledger.invalidate(since)
+
+
+@receiver(post_save, sender=FinancialInstitution)
+def bank_saved(sender, instance, **kwargs):
+    # Talking to the bank can take a while and shouldn't hold up (or roll
+    # back) the save, so it's left to a worker once the bank is committed
+    if instance.ofx_endpoint:
+        bank_id = instance.id
+        transaction.on_commit(lambda: discover_accounts.delay(bank_id))
@@ -1,77 +1,410 @@
 import csv
-import hashlib
 import itertools
-from datetime import datetime
-
-from django.db.models import Q
+import socket
+import time
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from functools import partial
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import Q, Max
+from django.utils import timezone
 
 from ofxtools.utils import UTC as OFX_UTC
 from ofxtools.Client import OFXClient, StmtRq
-from ofxtools.Parser import OFXTree
+
+from celery import chord, group
 
 from cream.celery import app
 
-from .models import Transaction, FinancialInstitution, Income, Expense, Account
+from . import archive, ledger, matching, ofx, parsers, transfers, uploads
+from .ingestion import TransactionRow, UPSERT_FIELDS, batched, read_csv, ingest
+from .jobs import CountingReader, JobProgress
+from .models import (Transaction, FinancialInstitution, Income, Expense, Account, SyncState, Upload,
+                     IngestionJob, StagedRow)
+from .periods import PayPeriods
+
+
+def retryable(error):
+    if isinstance(error, urllib.error.HTTPError):
+        return error.code >= 500 or error.code == 429
+
+    return isinstance(error, (urllib.error.URLError, socket.timeout, ConnectionError))
+
+
+def with_retries(func, retries=None, backoff=None):
+    retries = settings.OFX_SYNC_RETRIES if retries is None else retries
+    backoff = settings.OFX_SYNC_BACKOFF if backoff is None else backoff
+
+    for attempt in itertools.count():
+        try:
+            return func()
+        except Exception as error:
+            if attempt >= retries or not retryable(error):
+                raise
+
+            time.sleep(backoff * 2 ** attempt)
+
+
+def in_own_connection(func, *args):
+    # Worker threads get their own database connections from Django. They
+    # need to be closed by the thread that opened them.
+    try:
+        return func(*args)
+    finally:
+        connections.close_all()
+
+
+def statement_error(account, statuses):
+    # What went wrong with ``account``'s statement, going by the statuses
+    # ofx.watch_statuses collected, or None if it came back fine
+    code, message = statuses.get(account.account_number, (None, ''))
+
+    if code == '0':
+        return None
+
+    if code is not None:
+        return 'Statement for {} failed: {} {}'.format(account.account_number, code, message).strip()
+
+    failures = ', '.join('{} {}'.format(code, message).strip() for code, message in statuses.get(None, []))
+
+    if failures:
+        return 'No statement came back for {} ({})'.format(account.account_number, failures)
+
+    return 'No statement came back for {}'.format(account.account_number)
 
 
 class TransactionMachine(object):
-    def __init__(self, bank):
+    def __init__(self, bank, job=None):
         self.bank = bank
-        self.parser = OFXTree()
+        self.client = bank.ofx_client
+        self.job = job
 
     def fetch_new_transactions(self):
-        results = []
+        accounts = list(self.bank.account_set.all())
+
+        # OFX lets us ask for a bunch of statements in one go, which saves a
+        # signon and a TLS handshake for every account after the first one
+        size = settings.OFX_STATEMENTS_PER_REQUEST
+        groups = [accounts[i:i + size] for i in range(0, len(accounts), size)]
+
+        # Banks get cranky when you open too many sessions at once
+        with ThreadPoolExecutor(max_workers=self.bank.max_connections or 1) as executor:
+            results = executor.map(partial(in_own_connection, self.sync_accounts), groups)
+            return list(itertools.chain.from_iterable(results))
+
+    def sync_accounts(self, accounts):
+        results = [{'bank': self.bank.id, 'account': account.id} for account in accounts]
+
+        try:
+            counts = with_retries(lambda: self.import_accounts(accounts))
 
-        for account in self.bank.account_set.all():
-            transactions = [self.make_transaction_object(t, account) for t in self.fetch_transactions_for_account(account)]
-            results.extend(Transaction.objects.bulk_create(transactions, ignore_conflicts=True))
+            for result in results:
+                result.update(counts[result['account']])
+
+        except Exception as error:
+            for result in results:
+                result['error'] = repr(error)
+
+            progress = JobProgress(self.job)
+            progress.add(errors=len(accounts))
+            progress.flush()
 
         return results
 
-    def fetch_transactions_for_account(self, account):
+    def sync_windows(self, accounts):
+        states = {s.account_id: s for s in SyncState.objects.filter(account__in=accounts)}
+
+        # Accounts that have never been synced with a watermark start where
+        # their newest transaction is
+        latest = Transaction.objects.filter(account__in=[a for a in accounts if a.id not in states])\
+                                    .values('account')\
+                                    .annotate(latest=Max('date_posted'))
+        latest = {row['account']: row['latest'] for row in latest}
+
+        now = timezone.now()
+        windows = {}
+
+        for account in accounts:
+            state = states.get(account.id) or SyncState(account=account)
+            from_date = state.next_start
+
+            if from_date is None and latest.get(account.id):
+                from_date = latest[account.id] - state.overlap
+
+            if from_date is None:
+                from_date = datetime(2016, 1, 1, tzinfo=OFX_UTC)
+
+            state.window_start = from_date
+            state.window_end = now
+            state.server_end = None
+            windows[account.id] = state
+
+        return windows
+
+    def import_accounts(self, accounts):
+        # Everything in one response is saved together so a bank that falls
+        # over half way through doesn't leave half of a statement behind.
+        # Other requests don't go down with it.
+        by_number = {account.account_number: account for account in accounts}
+        windows = self.sync_windows(accounts)
+        counts = {account.id: {'rows': 0, 'duplicates': 0, 'first': None, 'last': None} for account in accounts}
+
+        # The job's counts are only written once everything here commits.
+        # Other threads are updating the same job row and would otherwise
+        # wait on each other's transactions.
+        progress = JobProgress(self.job)
+
+        # Whatever falls inside the overlap has most likely been saved
+        # already. Anything that hasn't changed since then is thrown out here
+        # instead of making the database do it. Pending transactions that
+        # have since posted still go through and get updated.
+        #
+        # Every account has its own overlap, so one that's been synced
+        # recently doesn't drag in another's whole history. Transactions only
+        # keep the day they were posted.
+        overlaps = Q()
+
+        for account_id, state in windows.items():
+            overlaps |= Q(account_id=account_id,
+                          date_posted__gte=state.window_start.replace(hour=0, minute=0, second=0, microsecond=0))
+
+        saved = Transaction.objects.filter(overlaps).values_list('account_id', 'transaction_id', *UPSERT_FIELDS)
+        seen = {account.id: {} for account in accounts}
+
+        for values in saved.iterator():
+            seen[values[0]][values[1]] = tuple(values[2:])
+
+        statuses = {}
+
+        def rows():
+            for context, record in self.fetch_transactions_for_accounts(windows.values(), progress, statuses):
+                account = by_number.get(context.get('ACCTID'))
+
+                if account is None:
+                    continue
+
+                if context.get('DTEND'):
+                    windows[account.id].server_end = ofx.parse_datetime(context['DTEND'])
+
+                row = self.make_transaction_object(record, account)
+                values = tuple(getattr(row, field) for field in UPSERT_FIELDS)
+
+                if seen[account.id].get(row.transaction_id) == values:
+                    counts[account.id]['duplicates'] += 1
+                    progress.add(rows_read=1, duplicates=1)
+                    continue
+
+                account_counts = counts[account.id]
+                account_counts['rows'] += 1
+
+                posted = row.date_posted.date()
+
+                if account_counts['first'] is None or posted < account_counts['first']:
+                    account_counts['first'] = posted
+
+                if account_counts['last'] is None or posted > account_counts['last']:
+                    account_counts['last'] = posted
+
+                yield row
+
+        with transaction.atomic():
+            ingest(rows(), upsert=True, progress=progress.count)
+
+            # Only accounts whose statement actually came back move their
+            # watermark. The rest start from the same place next time.
+            synced = []
+
+            for account in accounts:
+                error = statement_error(account, statuses)
+
+                if error:
+                    counts[account.id]['error'] = error
+                    progress.add(errors=1)
+                else:
+                    synced.append(windows[account.id])
+
+            for state in synced:
+                state.synced_at = state.window_end
+
+            fields = ['window_start', 'window_end', 'server_end', 'synced_at']
+            SyncState.objects.bulk_update([s for s in synced if s.pk], fields)
+            SyncState.objects.bulk_create([s for s in synced if not s.pk])
+
+        progress.flush()
+        return counts
+
+    def fetch_transactions_for_accounts(self, windows, progress=None, statuses=None):
+        statement_requests = []
+
+        for state in windows:
+            statement_requests.append(StmtRq(acctid=state.account.account_number,
+                                             accttype=state.account.account_type,
+                                             dtstart=state.window_start,
+                                             dtend=state.window_end))
+
+        request = self.client.request_statements(self.bank.password,
+                                                 *statement_requests,
+                                                 dryrun=True)
+
+        with ofx.post(self.client, request.read(), timeout=settings.OFX_TIMEOUT) as response:
+            source = response if progress is None else CountingReader(response, progress)
+
+            if settings.OFX_ARCHIVE_RESPONSES:
+                source = archive.ArchivingReader(source)
+
+            yield from ofx.iter_statement_transactions(source, statuses=statuses)
+
+        # Only whole responses are worth keeping
+        if settings.OFX_ARCHIVE_RESPONSES:
+            archive.save(self.bank, windows, source)
+
+    def make_transaction_object(self, record, account):
+        date_posted = datetime.strptime(record['DTPOSTED'][:8], '%Y%m%d').replace(tzinfo=OFX_UTC)
+
+        return TransactionRow(transaction_type=record['TRNTYPE'],
+                              transaction_id=record['FITID'],
+                              amount=float(record['TRNAMT']),
+                              name=record.get('NAME', ''),
+                              memo=record.get('MEMO', ''),
+                              date_posted=date_posted,
+                              account_id=account.id)
+
+
+@app.task
+def discover_accounts(bank_id):
+    # Asks the bank which accounts it has and adds any we don't know about.
+    # How it went is left on the bank so the admin can show it.
+    bank = FinancialInstitution.objects.get(id=bank_id)
+    banks = FinancialInstitution.objects.filter(id=bank_id)
+    banks.update(discovery_status='running')
+
+    def fetch_accounts():
+        yesterday = timezone.now() - timedelta(days=1)
+        client = bank.ofx_client
+        request = client.request_accounts(bank.password, yesterday, dryrun=True)
+
+        with ofx.post(client, request.read(), timeout=settings.OFX_TIMEOUT) as response:
+            return {(info['ACCTID'], info['ACCTTYPE']) for info in ofx.iter_aggregates(response, 'ACCTINFO')}
+
+    try:
+        found = with_retries(fetch_accounts)
+    except Exception as error:
+        banks.update(discovery_status='failed',
+                     discovery_message=repr(error),
+                     discovered_at=timezone.now())
+        return {'bank': bank.id, 'error': repr(error)}
+
+    existing = set(Account.objects.filter(bank=bank).values_list('account_number', 'account_type'))
+    new = found - existing
+
+    Account.objects.bulk_create([Account(bank=bank, account_number=number, account_type=account_type)
+                                 for number, account_type in new],
+                                ignore_conflicts=True)
+
+    message = 'Found {} accounts, {} new'.format(len(found), len(new))
+    banks.update(discovery_status='done', discovery_message=message, discovered_at=timezone.now())
+
+    return {'bank': bank.id, 'accounts': len(found), 'new': len(new)}
+
+
+def replay_responses(responses, dry_run=False):
+    # Runs archived OFX responses back through make_transaction_object and
+    # saves whatever comes out. Nothing goes to the bank, so this is how to
+    # pick up a parsing fix for transactions we already have.
+    results = []
+
+    for response in responses.select_related('bank').prefetch_related('accounts').order_by('window_start'):
+        machine = TransactionMachine(response.bank)
+        by_number = {account.account_number: account for account in response.accounts.all()}
+
+        def rows():
+            with archive.open_response(response) as f:
+                for context, record in ofx.iter_statement_transactions(f):
+                    account = by_number.get(context.get('ACCTID'))
+
+                    if account is not None:
+                        yield machine.make_transaction_object(record, account)
+
+        if dry_run:
+            result = {'rows': sum(1 for _ in rows())}
+        else:
+            result = ingest(rows(), upsert=True)
+
+        result['response'] = response.id
+        results.append(result)
+
+    return results
+
+
+@app.task
+def update_transactions(max_workers=None):
+    banks = FinancialInstitution.objects.exclude(ofx_endpoint__isnull=True)\
+                                        .exclude(ofx_endpoint='')
+
+    def sync_bank(bank):
+        job = IngestionJob.objects.create(kind='ofx', bank=bank)
+        job.start()
+
         try:
-            latest_transaction = Transaction.objects.filter(account=account).latest('date_posted')
-            from_date = latest_transaction.date_posted.replace(tzinfo=OFX_UTC)
-        except Transaction.DoesNotExist:
-            from_date = datetime(2016, 1, 1, tzinfo=OFX_UTC)
+            results = TransactionMachine(bank, job).fetch_new_transactions()
+
+            # The other half of a transfer might be at another bank that's
+            # syncing right now. Whichever of the two finishes last sees
+            # both halves.
+            firsts = [result['first'] for result in results if result.get('first')]
+            lasts = [result['last'] for result in results if result.get('last')]
+
+            if firsts:
+                transfers.detect_transfers(min(firsts), max(lasts))
+        except Exception as error:
+            job.finish(error=repr(error))
+            raise
 
-        to_date = datetime.now().replace(tzinfo=OFX_UTC)
+        errors = [result['error'] for result in results if 'error' in result]
+        job.finish(error=errors[0] if errors else None)
 
-        statement_request = StmtRq(acctid=account.account_number,
-                                   accttype=account.account_type,
-                                   dtstart=from_date,
-                                   dtend=to_date)
+        for result in results:
+            result['job'] = job.id
 
-        response = self.bank.ofx_client.request_statements(self.bank.password,
-                                                           statement_request)
-        parsed_response = self.parser.parse(response)
+        return results
+
+    with ThreadPoolExecutor(max_workers=max_workers or settings.OFX_SYNC_WORKERS) as executor:
+        results = list(itertools.chain.from_iterable(executor.map(partial(in_own_connection, sync_bank), banks)))
 
-        yield from parsed_response.findall('.//STMTTRN')
+    # Only what came in on this sync gets scored
+    firsts = [result['first'] for result in results if result.get('first')]
+    lasts = [result['last'] for result in results if result.get('last')]
 
-    def make_transaction_object(self, transaction_xml, account):
-        transaction = Transaction()
-        transaction.transaction_type = transaction_xml.find('TRNTYPE').text
-        transaction.transaction_id = transaction_xml.find('FITID').text
-        transaction.amount = transaction_xml.find('TRNAMT').text
-        transaction.name = transaction_xml.find('NAME').text
-        transaction.memo = transaction_xml.find('MEMO').text
-        transaction.date_posted = datetime.strptime(transaction_xml.find('DTPOSTED').text[:8], '%Y%m%d').replace(tzinfo=OFX_UTC)
-        transaction.account = account
+    if firsts:
+        matching.suggest_matches(since=min(firsts), until=max(lasts))
 
-        return transaction
+    return results
 
 
 @app.task
-def update_transactions():
-    # Only load Schwab for the moment
-    banks = FinancialInstitution.objects.filter(id=1)
+def match_transactions(since=None, until=None):
+    # Dates come through the broker as ISO strings
+    return matching.suggest_matches(since=since and date.fromisoformat(since),
+                                    until=until and date.fromisoformat(until))
+
+
+def match_expenses(dates):
+    # Newly budgeted expenses can be paid by transactions that are already
+    # in, so everything close enough to them is scored again once they're
+    # committed
+    dates = [ledger.as_date(d) for d in dates if d is not None]
 
-    update_results = []
-    for bank in banks:
-        machine = TransactionMachine(bank)
-        update_results.extend(machine.fetch_new_transactions())
+    if not dates:
+        return
 
-    return [t.transaction_id for t in update_results]
+    window = timedelta(days=settings.MATCH_DATE_WINDOW)
+    since = (min(dates) - window).isoformat()
+    until = (max(dates) + window).isoformat()
+
+    transaction.on_commit(lambda: match_transactions.delay(since, until))
 
 
 @app.task
@@ -81,100 +414,216 @@ def backfill_expenses():
     debit = Q(transaction_type='DEBIT')
     pos = Q(transaction_type='POS')
 
+    periods = PayPeriods()
+
+    if not periods:
+        return
+
     expenses = []
     for transaction in Transaction.objects.filter(atm | check | debit | pos).filter(date_posted__gte='2020-01-03'):
-        income = Income.objects.filter(budgeted_date__lte=transaction.date_posted).latest('budgeted_date')
         expense = Expense(budgeted_amount=abs(transaction.amount),
-                          income=income,
+                          income_id=periods.income_id(transaction.date_posted.date()),
                           description=transaction.memo,
                           transaction=transaction)
         expenses.append(expense)
 
     Expense.objects.bulk_create(expenses, ignore_conflicts=True)
+    Transaction.update_reconciled(expense.transaction_id for expense in expenses)
 
+    if expenses:
+        earliest = min(e.transaction.date_posted for e in expenses)
+        ledger.invalidate(periods.budgeted_date(earliest.date()))
 
-@app.task
-def process_file(account_id, filepath):
-    account = Account.objects.get(id=account_id)
 
+def find_format(account, header):
     if account.upload_parser:
-        eval(account.upload_parser).delay(account_id, filepath)
+        csv_format = parsers.get_format(account.upload_parser)
+
+        if csv_format is None:
+            raise ValueError('{} is set up to use the {!r} upload format, which does not exist'
+                             .format(account, account.upload_parser))
     else:
-        raise Exception('No upload parser defined for {}'.format(account))
+        csv_format = parsers.sniff(header)
+
+        if csv_format is None:
+            raise ValueError('No upload format matches the columns {} uploaded for {}'
+                             .format(', '.join(header or []), account))
+
+    return csv_format
+
+
+def ingest_csv(account, f, batch_size=None, upload=None, job=None):
+    if job is None:
+        job = IngestionJob.objects.create(kind='csv', account=account, upload=upload)
+
+    job.start()
+    progress = JobProgress(job)
+
+    try:
+        reader = csv.DictReader(uploads.counted_lines(f, progress))
+        csv_format = find_format(account, reader.fieldnames)
+        ranges = uploads.covered_ranges(account.id) if upload else []
+        stats = {}
+        rows = uploads.new_rows(csv_format, reader, account.id, ranges, stats, progress,
+                                seen=uploads.SeenIds(account.id))
+        result = ingest(rows, batch_size=batch_size, progress=progress.batch)
+        progress.flush()
+        found = transfers.detect_transfers(stats['first'], stats['last']) if result['rows'] else 0
+
+    except Exception as error:
+        progress.flush()
+        job.finish(error=repr(error))
+        raise
+
+    if upload is not None:
+        Upload.objects.filter(id=upload.id).update(ingested_at=timezone.now(),
+                                                   first_posted=stats['first'],
+                                                   last_posted=stats['last'],
+                                                   rows=result['rows'] + stats['skipped'] + stats['duplicates'])
+
+    job.finish(error=stats['error'], failed=False)
+
+    result.update(format=csv_format.name,
+                  skipped=stats['skipped'],
+                  duplicates=stats['duplicates'],
+                  errors=stats['errors'],
+                  transfers=found,
+                  matches=matching.suggest_matches(Transaction.objects.filter(account=account),
+                                                   stats['first'], stats['last']) if result['rows'] else 0,
+                  job=job.id)
+    return result
 
 
 @app.task
-def chase_parser(account_id, filepath):
+def process_file(account_id, filepath, batch_size=None):
+    with open(filepath, newline='') as f:
+        return ingest_csv(Account.objects.get(id=account_id), f, batch_size=batch_size)
 
-    with open(filepath) as f:
-        reader = csv.DictReader(f)
 
-        transactions = []
-        account = Account.objects.get(id=account_id)
+@app.task
+def process_upload(upload_id, batch_size=None, job_id=None):
+    upload = Upload.objects.select_related('account').get(id=upload_id)
+    job = IngestionJob.objects.get(id=job_id) if job_id else None
+
+    with uploads.open_upload(upload) as f:
+        return ingest_csv(upload.account, f, batch_size=batch_size, upload=upload, job=job)
 
-        for row in reader:
-            id_string = ''.join(v for v in list(row.values())[:-1])
-            hasher = hashlib.md5()
-            hasher.update(id_string.encode('utf-8'))
-            transaction_id = hasher.hexdigest()
-            name = row['Description']
-            memo = row['Description']
-            amount = row['Amount']
-            date_posted = datetime.strptime(row['Posting Date'], '%m/%d/%Y').replace(tzinfo=OFX_UTC)
-            check_number = None
 
-            if row['Check or Slip #']:
-                check_number = row['Check or Slip #']
+@app.task
+def parse_upload(upload_id, job_id, batch_size=None):
+    # Parses one file of a bulk upload and stages its rows for the merge. Only
+    # the counts go back through the result backend.
+    upload = Upload.objects.select_related('account').get(id=upload_id)
+    progress = JobProgress(None)
+    stats = {}
+    staged = 0
+
+    with uploads.open_upload(upload) as f:
+        reader = csv.DictReader(uploads.counted_lines(f, progress))
+        csv_format = find_format(upload.account, reader.fieldnames)
+        ranges = uploads.covered_ranges(upload.account_id)
+        rows = uploads.new_rows(csv_format, reader, upload.account_id, ranges, stats, progress,
+                                seen=uploads.SeenIds(upload.account_id))
+
+        for batch in batched(rows, batch_size or settings.INGEST_BATCH_SIZE):
+            StagedRow.objects.bulk_create([StagedRow(job_id=job_id, **row._asdict()) for row in batch],
+                                          ignore_conflicts=True)
+            staged += len(batch)
+
+    return {
+        'upload': upload.id,
+        'format': csv_format.name,
+        'rows': staged,
+        'first': stats['first'] and stats['first'].isoformat(),
+        'last': stats['last'] and stats['last'].isoformat(),
+        'skipped': stats['skipped'],
+        'duplicates': stats['duplicates'],
+        'errors': stats['errors'],
+        'error': stats['error'],
+        'counts': dict(progress.pending),
+    }
 
-            transaction_type = row['Details']
 
-            if 'INTEREST PAYMENT' in name:
-                transaction_type = 'INT'
-            elif 'ACCT_XFER' in row['Type']:
-                transaction_type = 'XFER'
+@app.task
+def merge_uploads(parsed, account_id, job_id, batch_size=None):
+    # Monthly exports overlap, so the same transaction tends to show up in
+    # more than one file. Everything is merged and goes in as one ingest.
+    job = IngestionJob.objects.get(id=job_id)
+    progress = JobProgress(job)
+    staged = StagedRow.objects.filter(job=job)
+
+    for result in parsed:
+        progress.add(**result['counts'])
+
+    # Rows another file staged first didn't make it in
+    repeated = sum(parse['rows'] for parse in parsed) - staged.count()
+    progress.add(rows_read=repeated, duplicates=repeated)
+
+    rows = (TransactionRow(*values) for values in staged.order_by('id')
+                                                      .values_list(*TransactionRow._fields)
+                                                      .iterator())
+
+    firsts = [date.fromisoformat(parse['first']) for parse in parsed if parse['first']]
+    lasts = [date.fromisoformat(parse['last']) for parse in parsed if parse['last']]
+
+    try:
+        result = ingest(rows, batch_size=batch_size, progress=progress.batch)
+        progress.flush()
+        found = transfers.detect_transfers(min(firsts), max(lasts)) if result['rows'] else 0
+    except Exception as error:
+        progress.flush()
+        job.finish(error=repr(error))
+        raise
+    finally:
+        staged.delete()
+
+    now = timezone.now()
+
+    for parse in parsed:
+        Upload.objects.filter(id=parse['upload']).update(ingested_at=now,
+                                                         first_posted=parse['first'],
+                                                         last_posted=parse['last'],
+                                                         rows=parse['rows'] + parse['skipped'] + parse['duplicates'])
+
+    errors = [parse['error'] for parse in parsed if parse['error']]
+    job.finish(error=errors[0] if errors else None, failed=False)
+
+    result.update(files=len(parsed),
+                  transfers=found,
+                  matches=matching.suggest_matches(Transaction.objects.filter(account_id=account_id),
+                                                   min(firsts), max(lasts)) if result['rows'] else 0,
+                  job=job.id)
+    return result
 
-            transaction = Transaction(transaction_id=transaction_id,
-                                      name=name,
-                                      memo=memo,
-                                      amount=amount,
-                                      date_posted=date_posted,
-                                      check_number=check_number,
-                                      transaction_type=transaction_type,
-                                      account=account)
-            transactions.append(transaction)
 
-        Transaction.objects.bulk_create(transactions, ignore_conflicts=True)
+@app.task
+def fail_uploads(request, exc, traceback, job_id):
+    # A file that couldn't be parsed means the merge never runs, so the job
+    # is failed here and whatever the other files staged is thrown out
+    IngestionJob.objects.get(id=job_id).finish(error=repr(exc))
+    StagedRow.objects.filter(job=job_id).delete()
+
+
+def ingest_uploads(upload_ids, account_id, job):
+    # Every file is parsed by whichever worker is free, then merged
+    job.start()
+    header = group(parse_upload.s(upload_id, job.id) for upload_id in upload_ids)
+    merge = merge_uploads.s(account_id, job.id).on_error(fail_uploads.s(job.id))
+
+    try:
+        return chord(header)(merge)
+    except Exception as error:
+        # Run eagerly, a chord raises instead of calling its error callback
+        fail_uploads(None, error, None, job.id)
+
+
+@app.task
+def chase_parser(account_id, filepath, batch_size=None):
+    rows = parsers.get_format('chase').rows(read_csv(filepath), account_id)
+    return ingest(rows, batch_size=batch_size)
 
 
 @app.task
-def citizens_bank_parser(account_id, filepath):
-    with open(filepath) as f:
-        reader = csv.DictReader(f)
-
-        transactions = []
-        account = Account.objects.get(id=account_id)
-
-        for row in reader:
-            id_string = ''.join(v for v in list(row.values())[:-1])
-            hasher = hashlib.md5()
-            hasher.update(id_string.encode('utf-8'))
-            transaction_id = hasher.hexdigest()
-            name = row['Description']
-            memo = row['Description']
-            amount = row['Amount']
-            date_posted = datetime.strptime(row['Date'], '%m/%d/%Y').replace(tzinfo=OFX_UTC)
-            transaction_type = 'CREDIT'
-
-            if float(amount) < 0:
-                transaction_type = 'DEBIT'
-
-            transaction = Transaction(transaction_id=transaction_id,
-                                      name=name,
-                                      memo=memo,
-                                      amount=amount,
-                                      date_posted=date_posted,
-                                      transaction_type=transaction_type,
-                                      account=account)
-            transactions.append(transaction)
-
-        Transaction.objects.bulk_create(transactions, ignore_conflicts=True)
+def citizens_bank_parser(account_id, filepath, batch_size=None):
+    rows = parsers.get_format('citizens').rows(read_csv(filepath), account_id)
+    return ingest(rows, batch_size=batch_size)
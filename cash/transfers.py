@@ -0,0 +1,114 @@
+import itertools
+from collections import defaultdict, deque
+from datetime import datetime, time, timedelta
+
+from django.conf import settings
+from django.db import connection, transaction as db_transaction
+from django.utils import timezone
+
+from .models import MatchSuggestion, Transaction, Transfer
+
+
+# Held while looking for transfers so two imports finishing at the same time
+# don't both pair up the same two transactions
+DETECTION_LOCK = 0x7846_6572
+
+# Transfers found by detect_transfers say so, to tell them apart from ones
+# entered by hand
+DETECTED = 'Detected automatically'
+
+
+def pair_transfers(transactions, window):
+    # ``transactions`` are (transaction_id, account_id, amount, date_posted)
+    # in the order they were posted. Each one pairs up with the closest
+    # earlier transaction for the same amount going the other way in a
+    # different account. Anything posted more than ``window`` before the
+    # current transaction can't pair with it or anything after it, so only a
+    # window's worth of them is ever held, hashed on the amount in cents.
+    waiting = defaultdict(list)
+    posted = deque()
+
+    for transaction_id, account_id, amount, date_posted in transactions:
+        while posted and posted[0][0] < date_posted - window:
+            _, key, entry = posted.popleft()
+            bucket = waiting.get(key)
+
+            if bucket and entry in bucket:
+                bucket.remove(entry)
+
+                if not bucket:
+                    del waiting[key]
+
+        key = round(abs(amount) * 100)
+        bucket = waiting[key]
+
+        for entry in reversed(bucket):
+            other_id, other_account_id, other_amount = entry
+
+            if other_account_id != account_id and (other_amount < 0) != (amount < 0):
+                bucket.remove(entry)
+
+                if not bucket:
+                    del waiting[key]
+
+                if other_amount < 0:
+                    yield other_id, transaction_id
+                else:
+                    yield transaction_id, other_id
+                break
+        else:
+            entry = (transaction_id, account_id, amount)
+            bucket.append(entry)
+            posted.append((date_posted, key, entry))
+
+
+def as_datetime(value):
+    return datetime.combine(value, time.min, tzinfo=timezone.utc)
+
+
+def detect_transfers(since=None, until=None, batch_size=1000):
+    # Looks for transfers between our own accounts among the unreconciled
+    # transactions posted from ``since`` through ``until``, along with
+    # whatever is close enough to them to be the other half. Returns how many
+    # were found.
+    window = timedelta(days=settings.TRANSFER_DATE_WINDOW)
+    transactions = Transaction.unreconciled().exclude(amount=0)
+
+    if since is not None:
+        transactions = transactions.filter(date_posted__gte=as_datetime(since) - window)
+
+    if until is not None:
+        transactions = transactions.filter(date_posted__lt=as_datetime(until) + window + timedelta(days=1))
+
+    pairs = pair_transfers(transactions.order_by('date_posted', 'transaction_id')
+                                       .values_list('transaction_id', 'account_id', 'amount', 'date_posted')
+                                       .iterator(),
+                           window)
+    created = 0
+
+    with db_transaction.atomic():
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT pg_advisory_xact_lock(%s)', [DETECTION_LOCK])
+
+        while True:
+            batch = [Transfer(transaction_from_id=transaction_from,
+                              transaction_to_id=transaction_to,
+                              reason=DETECTED)
+                     for transaction_from, transaction_to in itertools.islice(pairs, batch_size)]
+
+            if not batch:
+                return created
+
+            # Anything another import paired up first is left to it, and the
+            # flags and the count come from whichever transfers actually exist
+            Transfer.objects.bulk_create(batch, ignore_conflicts=True)
+            paired = {(t.transaction_from_id, t.transaction_to_id) for t in batch}
+            created += sum(1 for pair in Transfer.objects.filter(transaction_from__in=[f for f, _ in paired])
+                                                         .values_list('transaction_from', 'transaction_to')
+                           if pair in paired)
+
+            # Transfers are reconciled, so they don't need an expense
+            matched = [t.transaction_from_id for t in batch] + [t.transaction_to_id for t in batch]
+            Transaction.update_reconciled(matched)
+            MatchSuggestion.objects.filter(transaction__in=matched, transaction__reconciled=True).delete()
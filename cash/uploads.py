@@ -0,0 +1,225 @@
+import hashlib
+import io
+import os
+import zipfile
+from collections import OrderedDict
+from datetime import datetime
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import transaction
+
+from ofxtools.utils import UTC as OFX_UTC
+
+from .ingestion import batched
+from .models import Transaction, Upload, UploadChunk
+
+
+class ChunkReader(io.RawIOBase):
+    # Reads an upload back out of its chunks without loading the whole file
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.pending = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.pending:
+            try:
+                self.pending = bytes(next(self.chunks))
+            except StopIteration:
+                return 0
+
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
+
+
+def split(uploaded_file, size):
+    # Django hands uploads over in whatever pieces it read them in, so cut
+    # them into our own chunk size
+    pending = b''
+
+    for piece in uploaded_file.chunks():
+        pending += piece
+
+        while len(pending) >= size:
+            yield pending[:size]
+            pending = pending[size:]
+
+    if pending:
+        yield pending
+
+
+def expand(uploaded_files):
+    # Zip archives are opened up and each CSV inside is treated as if it had
+    # been uploaded on its own
+    for uploaded_file in uploaded_files:
+        if not uploaded_file.name.lower().endswith('.zip'):
+            yield uploaded_file
+            continue
+
+        with zipfile.ZipFile(uploaded_file) as archive:
+            for info in archive.infolist():
+                name = os.path.basename(info.filename)
+
+                if info.is_dir() or not name.lower().endswith('.csv'):
+                    continue
+
+                yield ContentFile(archive.read(info), name=name)
+
+
+def store(account_id, uploaded_file):
+    # Uploads are keyed by the hash of their contents, so the same export
+    # uploaded twice is only stored and imported once. Returns the Upload and
+    # whether it still needs ingesting.
+    chunk_size = settings.UPLOAD_CHUNK_SIZE
+    hasher = hashlib.sha256()
+
+    for chunk in uploaded_file.chunks():
+        hasher.update(chunk)
+
+    with transaction.atomic():
+        upload, created = Upload.objects.get_or_create(account_id=account_id,
+                                                       sha256=hasher.hexdigest(),
+                                                       defaults={'name': uploaded_file.name,
+                                                                 'size': uploaded_file.size})
+
+        if created:
+            chunks = (UploadChunk(upload=upload, index=index, data=data)
+                      for index, data in enumerate(split(uploaded_file, chunk_size)))
+
+            for batch in batched(chunks, 10):
+                UploadChunk.objects.bulk_create(batch)
+
+    return upload, upload.ingested_at is None
+
+
+def open_upload(upload):
+    chunks = (UploadChunk.objects.filter(upload=upload)
+                                 .order_by('index')
+                                 .values_list('data', flat=True)
+                                 .iterator(chunk_size=1))
+
+    # The csv module handles line endings itself, including newlines inside
+    # quoted fields
+    return io.TextIOWrapper(io.BufferedReader(ChunkReader(chunks)), encoding='utf-8', newline='')
+
+
+def covered_ranges(account_id):
+    return list(Upload.objects.filter(account_id=account_id, ingested_at__isnull=False)
+                              .exclude(first_posted=None)
+                              .values_list('first_posted', 'last_posted'))
+
+
+def counted_lines(f, progress):
+    # Lines come out decoded, so they're encoded again to count the bytes
+    # they took up in the file
+    encoding = getattr(f, 'encoding', None) or 'utf-8'
+
+    for line in f:
+        progress.pending['bytes_read'] += len(line.encode(encoding, 'replace'))
+        yield line
+
+
+class SeenIds(object):
+    # IDs already saved for an account, loaded a month at a time as rows from
+    # that month turn up so a file only costs a query per month it covers.
+    # Exports are sorted by date one way or the other, so only the last few
+    # months used are kept and memory doesn't grow with the file. Raw md5
+    # digests take half the memory of the hex strings.
+
+    def __init__(self, account_id, keep=None):
+        self.account_id = account_id
+        self.keep = keep or settings.UPLOAD_SEEN_MONTHS
+        self.months = OrderedDict()
+
+    def __len__(self):
+        return sum(len(digests) for digests in self.months.values())
+
+    def load(self, year, month):
+        start = datetime(year, month, 1, tzinfo=OFX_UTC)
+        end = datetime(year + month // 12, month % 12 + 1, 1, tzinfo=OFX_UTC)
+        ids = Transaction.objects.filter(account_id=self.account_id,
+                                         date_posted__gte=start,
+                                         date_posted__lt=end)\
+                                 .values_list('transaction_id', flat=True)
+        digests = set()
+
+        for transaction_id in ids.iterator():
+            try:
+                digests.add(bytes.fromhex(transaction_id))
+            except ValueError:
+                # OFX ids, which CSV rows can't collide with
+                pass
+
+        self.months[year, month] = digests
+
+        while len(self.months) > self.keep:
+            self.months.popitem(last=False)
+
+        return digests
+
+    def __contains__(self, row):
+        posted = row.date_posted
+        month = (posted.year, posted.month)
+
+        if month in self.months:
+            self.months.move_to_end(month)
+            digests = self.months[month]
+        else:
+            digests = self.load(*month)
+
+        return bytes.fromhex(row.transaction_id) in digests
+
+
+def new_rows(csv_format, records, account_id, ranges, stats, progress, seen=None):
+    # An export has every transaction for the days strictly inside the range
+    # it covers, so rows on those days have already been imported and can be
+    # dropped before they're hashed. Days on the edge of an old export might
+    # have been cut off partway through, so those still go through the
+    # normal duplicate check.
+    #
+    # Rows whose id is in ``seen`` are dropped too, so re-importing a file
+    # doesn't send anything to the database. Repeats inside the file are
+    # still left to the database; remembering every new id would make memory
+    # grow with the file.
+    #
+    # Rows that can't be parsed are counted and left out rather than
+    # throwing away the rest of the file.
+    stats.update(first=None, last=None, skipped=0, duplicates=0, errors=0, error=None)
+
+    for row in records:
+        try:
+            posted = csv_format.posted(row).date()
+            transaction_row = None
+
+            if not any(first < posted < last for first, last in ranges):
+                transaction_row = csv_format.transaction_row(row, account_id)
+
+        except (KeyError, TypeError, ValueError) as error:
+            stats['errors'] += 1
+            stats['error'] = stats['error'] or 'Line {}: {!r}'.format(records.line_num, error)
+            progress.add(rows_read=1, errors=1)
+            continue
+
+        if stats['first'] is None or posted < stats['first']:
+            stats['first'] = posted
+
+        if stats['last'] is None or posted > stats['last']:
+            stats['last'] = posted
+
+        if transaction_row is None:
+            stats['skipped'] += 1
+            progress.add(rows_read=1, duplicates=1)
+            continue
+
+        if seen is not None and transaction_row in seen:
+            stats['duplicates'] += 1
+            progress.add(rows_read=1, duplicates=1)
+            continue
+
+        yield transaction_row
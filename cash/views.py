@@ -1,17 +1,16 @@
-import os
 from datetime import datetime, timedelta
 
 from ofxtools.utils import UTC
 
 from django.conf import settings
-from django.db import connection
-from django.db.models import Q, CharField
+from django.db import connection, transaction
+from django.db.models import Q, CharField, Prefetch
 from django.db.models.functions import Cast
-from django.http import HttpResponse
+from django.http import HttpResponse, JsonResponse
 from django.contrib import messages
-from django.shortcuts import render, redirect
+from django.shortcuts import render, redirect, get_object_or_404
 from django.urls import reverse
-from django.views.generic import ListView, DetailView, RedirectView
+from django.views.generic import ListView, DetailView, RedirectView, View
 from django.views.generic.base import TemplateView
 from django.views.generic.detail import SingleObjectTemplateResponseMixin
 from django.views.generic.edit import ModelFormMixin, ProcessFormView, CreateView, UpdateView, FormView
@@ -21,9 +20,11 @@ from dal import autocomplete
 
 from recurrence import Recurrence
 
-from .models import Income, Expense, Transaction, Account, Transfer
+from . import ledger, matching, paychecks, search, uploads
+from .models import Income, Expense, Transaction, Account, Transfer, IngestionJob, MatchSuggestion
+from .periods import PayPeriods, rehome_expenses
 from .forms import ExpenseForm, IncomeForm
-from .tasks import process_file
+from .tasks import ingest_uploads, match_expenses, process_upload
 
 
 class IndexView(TemplateView):
@@ -31,7 +32,7 @@ class IndexView(TemplateView):
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context['income'] = Income.objects.order_by('-budgeted_date')
+        context['income'] = Income.objects.with_ledger().order_by('-budgeted_date')
         return context
 
 
@@ -44,24 +45,39 @@ class UploadCSVView(TemplateView):
         return context
 
     def post(self, request, *args, **kwargs):
-        filedir = '{}/uploads'.format(settings.BASE_DIR)
+        account_id = request.POST['account-name']
+        pending = []
 
-        try:
-            os.makedirs(filedir)
-        except OSError:
-            pass
+        for uploaded_file in uploads.expand(request.FILES.getlist('csv')):
+            upload, needs_ingest = uploads.store(account_id, uploaded_file)
 
-        filepath = '{}/{}'.format(filedir, request.FILES['csv'].name)
+            if needs_ingest:
+                pending.append(upload)
+            else:
+                messages.info(request, "{} was already imported.".format(upload.name))
 
-        with open(filepath, 'wb+') as f:
-            for chunk in request.FILES['csv'].chunks():
-                f.write(chunk)
+        if len(pending) == 1:
+            job = IngestionJob.objects.create(kind='csv', account_id=account_id, upload=pending[0])
+            process_upload.delay(pending[0].id, job_id=job.id)
+        elif pending:
+            job = IngestionJob.objects.create(kind='csv', account_id=account_id)
+            ingest_uploads([upload.id for upload in pending], account_id, job)
+
+        if pending:
+            messages.success(request, "Upload successful!")
+            kwargs['job'] = job
 
-        process_file.delay(request.POST['account-name'], filepath)
-        messages.success(request, "Upload successful!")
         return self.render_to_response(self.get_context_data(**kwargs))
 
 
+class IngestionJobStatus(View):
+    # Cheap enough to poll while a job runs
+
+    def get(self, request, pk):
+        job = get_object_or_404(IngestionJob, pk=pk)
+        return JsonResponse(job.as_dict())
+
+
 class IncomeDetail(DetailView):
     model = Income
     template_name = 'cash/income-detail.html'
@@ -97,35 +113,37 @@ class OccurrenceInfo(object):
 class UpdateIncomeRelationsMixin(OccurrenceInfo):
     def update_relations(self, update_series=False):
 
-        occurrences, first_occurrence = self.update_occurrence_info(update_series=update_series)
-        self.object.save()
+        with transaction.atomic(), ledger.deferred_updates():
+            occurrences, first_occurrence = self.update_occurrence_info(update_series=update_series)
+            self.object.save()
 
-        new_income = []
+            new_income = []
+            moved = 0
 
-        for recurrence in occurrences[1:]:
-            income = Income(budgeted_date=recurrence.date(),
-                            budgeted=self.object.budgeted,
-                            slug=recurrence.date().isoformat()[:10],
-                            first_occurrence=first_occurrence,
-                            recurrences=self.object.recurrences)
-            new_income.append(income)
+            for recurrence in occurrences[1:]:
+                income = Income(budgeted_date=recurrence.date(),
+                                budgeted=self.object.budgeted,
+                                slug=recurrence.date().isoformat()[:10],
+                                first_occurrence=first_occurrence,
+                                recurrences=self.object.recurrences)
+                new_income.append(income)
 
-        if new_income:
-            Income.objects.bulk_create(new_income)
-            self.update_expenses(new_income)
+            if new_income:
+                Income.objects.bulk_create(new_income)
+                ledger.invalidate(new_income[0].budgeted_date)
+                moved = self.update_expenses(new_income)
 
-    def update_expenses(self, created):
-        for income in created:
-            expenses = Expense.objects.filter(budgeted_date__gte=income.budgeted_date)
-            if income.next_income:
-                expenses = expenses.filter(budgeted_date__lt=income.next_income.budgeted_date)
+        return moved
 
-            for expense in expenses:
-                expense.income = None
+    def update_expenses(self, created):
+        moved, moved_from = rehome_expenses([income.id for income in created])
 
-            Expense.objects.bulk_update(expenses, ['income'])
+        # The expenses that just moved might have come from periods that are
+        # older than anything in this series
+        if moved_from:
+            ledger.invalidate(moved_from)
 
-            income.expense_set.add(*expenses)
+        return moved
 
 
 class IncomeCreateFromTransaction(IncomeCreateBase):
@@ -170,10 +188,40 @@ class IncomeCreateFromTransaction(IncomeCreateBase):
         return context
 
 
+class PaycheckSeriesView(TemplateView):
+    template_name = 'cash/paycheck-series.html'
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['proposals'] = paychecks.detect_paychecks()
+        return context
+
+    def post(self, request, *args, **kwargs):
+        payers = set(request.POST.getlist('payer'))
+        created, unlinked = 0, []
+
+        for series in paychecks.detect_paychecks():
+            if series.payer in payers:
+                series_created, series_unlinked = paychecks.create_series(series)
+                created += series_created
+                unlinked += series_unlinked
+
+        if created:
+            messages.success(request, 'Created {} paychecks.'.format(created))
+
+        if unlinked:
+            messages.warning(request, 'Another paycheck was already deposited on {}. Those deposits are still '
+                                      'waiting to be matched up.'.format(', '.join(day.isoformat()
+                                                                                  for day in sorted(unlinked))))
+
+        return redirect(reverse('detect-paychecks'))
+
+
 class IncomeCreate(UpdateIncomeRelationsMixin, IncomeCreateBase):
     def form_valid(self, form):
-        valid = super().form_valid(form)
-        self.update_relations()
+        with ledger.deferred_updates():
+            valid = super().form_valid(form)
+            self.update_relations()
         return valid
 
 
@@ -210,12 +258,13 @@ class IncomeUpdate(UpdateIncomeRelationsMixin, UpdateView):
         return form
 
     def form_valid(self, form):
-        valid = super().form_valid(form)
+        with ledger.deferred_updates():
+            valid = super().form_valid(form)
 
-        if self.request.POST.get('update_all', 'No') == 'Yes':
-            later_occurrences = self.object.first_occurrence.income_set.filter(budgeted_date__gt=self.object.budgeted_date)
-            later_occurrences.delete()
-            self.update_relations(update_series=True)
+            if self.request.POST.get('update_all', 'No') == 'Yes':
+                later_occurrences = self.object.first_occurrence.income_set.filter(budgeted_date__gt=self.object.budgeted_date)
+                later_occurrences.delete()
+                self.update_relations(update_series=True)
 
         return valid
 
@@ -223,36 +272,33 @@ class IncomeUpdate(UpdateIncomeRelationsMixin, UpdateView):
 class UpdateExpenseRelationsMixin(OccurrenceInfo):
     def update_relations(self, update_series=False):
 
-        occurrences, first_occurrence = self.update_occurrence_info(update_series=update_series)
+        with ledger.deferred_updates():
+            occurrences, first_occurrence = self.update_occurrence_info(update_series=update_series)
 
-        self.object.income = self.find_income(self.object.budgeted_date)
-        self.object.save()
+            self.periods = PayPeriods()
 
-        new_expenses = []
+            self.object.income_id = self.periods.income_id(self.object.budgeted_date)
+            self.object.save()
 
-        for occurrence in occurrences[1:]:
-            new_expenses.append(self.make_new_expense(occurrence,
-                                                      first_occurrence=first_occurrence))
+            new_expenses = []
 
-        Expense.objects.bulk_create(new_expenses)
+            for occurrence in occurrences[1:]:
+                new_expenses.append(self.make_new_expense(occurrence,
+                                                          first_occurrence=first_occurrence))
 
-    def find_income(self, expense_date):
-        income = Income.objects.filter(budgeted_date__lte=expense_date).order_by('-budgeted_date').first()
+            Expense.objects.bulk_create(new_expenses)
 
-        # If we can't find an income here that means that we're back before
-        # there is any income. The way to reconcile this is to just stick it
-        # into the chronologically first one
-        if not income:
-            income = Income.objects.order_by('budgeted_date').first()
+            if new_expenses and self.periods:
+                ledger.invalidate(self.periods.budgeted_date(self.object.budgeted_date))
 
-        return income
+            match_expenses([self.object.budgeted_date] + [expense.budgeted_date for expense in new_expenses])
 
     def make_new_expense(self, occurrence, first_occurrence=None):
 
         expense = Expense(budgeted_date=occurrence.date(),
                           budgeted_amount=self.object.budgeted_amount,
                           description=self.object.description,
-                          income=self.find_income(occurrence.date()),
+                          income_id=self.periods.income_id(occurrence.date()),
                           first_occurrence=first_occurrence)
         return expense
 
@@ -290,8 +336,9 @@ class CreateExpense(UpdateExpenseRelationsMixin, CreateView):
         return context
 
     def form_valid(self, form):
-        valid = super().form_valid(form)
-        self.update_relations()
+        with ledger.deferred_updates():
+            valid = super().form_valid(form)
+            self.update_relations()
         return valid
 
     def get_success_url(self):
@@ -334,22 +381,23 @@ class UpdateExpense(UpdateExpenseRelationsMixin, UpdateView):
         return form
 
     def form_valid(self, form):
-        valid = super().form_valid(form)
+        with ledger.deferred_updates():
+            valid = super().form_valid(form)
 
-        update_series = False
+            update_series = False
 
-        if self.request.POST.get('update_all', 'No') == 'Yes':
+            if self.request.POST.get('update_all', 'No') == 'Yes':
 
-            update_series = True
+                update_series = True
 
-            if self.object.first_occurrence:
-                later_occurrences = self.object.first_occurrence.expense_set.filter(budgeted_date__gt=self.object.budgeted_date)
-            else:
-                later_occurrences = self.object.expense_set.filter(budgeted_date__gt=self.object.budgeted_date)
+                if self.object.first_occurrence:
+                    later_occurrences = self.object.first_occurrence.expense_set.filter(budgeted_date__gt=self.object.budgeted_date)
+                else:
+                    later_occurrences = self.object.expense_set.filter(budgeted_date__gt=self.object.budgeted_date)
 
-            later_occurrences.delete()
+                later_occurrences.delete()
 
-        self.update_relations(update_series=update_series)
+            self.update_relations(update_series=update_series)
 
         return valid
 
@@ -365,23 +413,53 @@ class ReconcileTransactions(TemplateView):
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
 
-        context['transactions'] = Transaction.objects.filter(Q(expense__isnull=True) & Q(income__isnull=True)).order_by('-date_posted')
+        suggestions = MatchSuggestion.objects.select_related('expense__income').order_by('-score')
+        transactions = Transaction.unreconciled()\
+                                  .select_related('account__bank')\
+                                  .prefetch_related(Prefetch('match_suggestions', queryset=suggestions))\
+                                  .order_by('-date_posted', '-transaction_id')
+
+        # Pages pick up after the last transaction of the one before, which
+        # the index can jump straight to no matter how far back it is
+        before = self.request.GET.get('before')
+
+        try:
+            date_posted, transaction_id = before.split(',', 1)
+            date_posted = datetime.fromisoformat(date_posted)
+        except (AttributeError, ValueError):
+            pass
+        else:
+            transactions = transactions.filter(Q(date_posted__lt=date_posted) |
+                                               Q(date_posted=date_posted, transaction_id__lt=transaction_id))
+
+        page = list(transactions[:settings.RECONCILE_PAGE_SIZE + 1])
+        context['transactions'] = page[:settings.RECONCILE_PAGE_SIZE]
+
+        if len(page) > settings.RECONCILE_PAGE_SIZE:
+            last = context['transactions'][-1]
+            context['before'] = '{},{}'.format(last.date_posted.isoformat(), last.transaction_id)
 
         return context
 
     def post(self, request, *args, **kwargs):
-        return self.render_to_response(self.get_context_data(**kwargs))
+        matched = matching.accept(request.POST.getlist('suggestion'))
+
+        if matched:
+            messages.success(request, 'Matched {} transactions to expenses.'.format(matched))
+
+        return redirect(reverse('incoming-transactions'))
 
 
 class TransactionAutocomplete(autocomplete.Select2QuerySetView):
+    paginator_class = search.PeekPaginator
+
     def get_queryset(self):
         queryset = Transaction.objects.filter(expense__isnull=True)
 
-        if self.q:
-            queryset = queryset.filter(memo__icontains=self.q)
-
+        # Narrowed down before searching so the ranked matches all come from
+        # the right pay period
         if self.request.GET.get('income_id'):
-            income = Income.objects.get(id=id)
+            income = Income.objects.get(id=self.request.GET['income_id'])
 
             if income.previous_income:
                 offset = income.previous_income.budgeted_date
@@ -390,6 +468,9 @@ class TransactionAutocomplete(autocomplete.Select2QuerySetView):
 
             queryset = queryset.filter(date_posted__gt=offset).filter(date_posted__lt=income.budgeted_date)
 
+        if self.q:
+            queryset = search.search(queryset, self.q)
+
         return queryset
 
 class IncomeAutocomplete(autocomplete.Select2QuerySetView):
@@ -95,3 +95,63 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'static')
 # Celery junk
 CELERY_RESULT_BACKEND = 'django-db'
 
+# Number of transactions written per INSERT when importing
+INGEST_BATCH_SIZE = 1000
+
+# Load imports with COPY through a staging table when running on Postgres
+INGEST_USE_COPY = True
+
+# Extra CSV upload formats on top of the ones in cash/parsers.py. Each one is
+# a dict of CSVFormat arguments, e.g. {'name': 'mybank', 'date': 'Date',
+# 'amount': 'Amount', 'description': 'Payee'}
+CSV_FORMATS = []
+
+# Uploads are kept in the database in pieces of this many bytes
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Months of saved transaction ids kept around while checking an upload for
+# rows that are already there
+UPLOAD_SEEN_MONTHS = 3
+
+# How many banks get synced at once. Each bank then has up to its own
+# max_connections requests open at a time.
+OFX_SYNC_WORKERS = 8
+
+# Statement requests for a bank's accounts are batched into one OFX request,
+# up to this many at a time
+OFX_STATEMENTS_PER_REQUEST = 25
+OFX_SYNC_RETRIES = 3
+OFX_SYNC_BACKOFF = 1.0
+OFX_TIMEOUT = 60
+
+# Keep a gzipped copy of every statement download so it can be replayed
+# with `manage.py replay_ofx`
+OFX_ARCHIVE_RESPONSES = True
+
+
+# Unreconciled transactions get matched up with budgeted expenses that are
+# within this many dollars and days of them
+MATCH_AMOUNT_TOLERANCE = 1.0
+MATCH_DATE_WINDOW = 7
+# How many suggestions are kept for each transaction
+MATCH_SUGGESTIONS = 3
+
+# The two halves of a transfer between our own accounts can post this many
+# days apart
+TRANSFER_DATE_WINDOW = 3
+
+# Transaction searches are ranked by how well they match once a word is at
+# least this long. Only the newest SEARCH_RANK_CANDIDATES matches are ranked;
+# older ones follow them newest first, as do all matches of shorter searches.
+SEARCH_RANK_MIN_PREFIX = 3
+SEARCH_RANK_CANDIDATES = 500
+
+# Direct deposits from the same payer become a series of incomes when at
+# least PAYCHECK_MIN_COVERAGE of them land within PAYCHECK_DATE_SLACK days of
+# a weekly, biweekly or semi-monthly schedule
+PAYCHECK_DATE_SLACK = 3
+PAYCHECK_MIN_DEPOSITS = 3
+PAYCHECK_MIN_COVERAGE = 0.8
+
+# How many transactions the reconcile page shows at a time
+RECONCILE_PAGE_SIZE = 50
@@ -10,7 +10,9 @@ from cash.views import (IndexView,
                         IncomeCreate,
                         IncomeCreateFromTransaction,
                         IncomeUpdate,
+                        PaycheckSeriesView,
                         UploadCSVView,
+                        IngestionJobStatus,
                         TransactionAutocomplete,
                         PaycheckAutocomplete,
                         IncomeAutocomplete)
@@ -21,10 +23,12 @@ urlpatterns = [
     path('income/create/', IncomeCreate.as_view(), name='create-income'),
     path('income/update/<int:pk>/', IncomeUpdate.as_view(), name='update-income'),
     path('income/create-from-transaction/<str:transaction_id>/', IncomeCreateFromTransaction.as_view(), name='create-income-from-transaction'),
+    path('income/paychecks/', PaycheckSeriesView.as_view(), name='detect-paychecks'),
     path('income/<slug:slug>/', IncomeDetail.as_view(), name='income-detail'),
     path('expense/create/', CreateExpense.as_view(), name='create-expense'),
     path('expense/update/<int:pk>/', UpdateExpense.as_view(), name='update-expense'),
     path('upload-csv/', UploadCSVView.as_view(), name='upload-csv'),
+    path('jobs/<int:pk>/', IngestionJobStatus.as_view(), name='ingestion-job'),
     path('', IndexView.as_view(), name='index'),
     path('incoming-transactions/', ReconcileTransactions.as_view(), name='incoming-transactions'),
     path('transaction/<str:pk>/', TransactionDetail.as_view(), name='transaction-detail'),
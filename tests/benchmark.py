@@ -0,0 +1,63 @@
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+
+class QueryCounter(object):
+    # Counts queries on every connection, including the ones worker threads
+    # open while it's installed
+
+    def __init__(self):
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        with self.lock:
+            self.count += 1
+
+        return execute(sql, params, many, context)
+
+    def connection_created(self, sender, connection, **kwargs):
+        connection.execute_wrappers.append(self)
+
+    def __enter__(self):
+        for connection in connections.all():
+            connection.execute_wrappers.append(self)
+
+        connection_created.connect(self.connection_created)
+        return self
+
+    def __exit__(self, *args):
+        connection_created.disconnect(self.connection_created)
+
+        for connection in connections.all():
+            if self in connection.execute_wrappers:
+                connection.execute_wrappers.remove(self)
+
+
+@contextmanager
+def measure(name, rows, report):
+    # Fills in a dict with how long the block took, how many queries it ran
+    # and the most memory Python had allocated at once. tracemalloc makes
+    # everything slower, so compare rows per second against other runs of
+    # this, not against production.
+    stats = {'name': name, 'rows': rows}
+
+    tracemalloc.start()
+    started = time.monotonic()
+
+    with QueryCounter() as queries:
+        yield stats
+
+    stats['seconds'] = time.monotonic() - started
+    stats['rows_per_second'] = rows / stats['seconds']
+    stats['queries'] = queries.count
+    stats['peak_mb'] = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+    tracemalloc.stop()
+
+    report('{name}: {rows} rows in {seconds:.2f}s ({rows_per_second:.0f} rows/s), '
+           '{queries} queries, {peak_mb:.1f} MB peak'.format(**stats))
@@ -4,10 +4,39 @@ import pytest
 
 import recurrence
 
+from cream.celery import app
+
 from cash.models import Income, Transaction, FinancialInstitution, Account, Expense
 from cash.views import UpdateIncomeRelationsMixin, UpdateExpenseRelationsMixin
 
 
+def pytest_addoption(parser):
+    parser.addoption('--benchmark', action='store_true', help='Run the slow benchmark sizes too')
+
+
+def pytest_configure(config):
+    config.addinivalue_line('markers', 'benchmark: only runs with --benchmark')
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption('--benchmark'):
+        return
+
+    skip = pytest.mark.skip(reason='needs --benchmark')
+
+    for item in items:
+        if 'benchmark' in item.keywords:
+            item.add_marker(skip)
+
+
+@pytest.fixture
+def eager_tasks(monkeypatch):
+    # Runs anything sent to Celery right away instead of queueing it. Celery
+    # still wants a broker connection to hand it the serializer.
+    monkeypatch.setattr(app.conf, 'task_always_eager', True)
+    monkeypatch.setattr(app.conf, 'broker_url', 'memory://')
+
+
 @pytest.fixture
 def five_this_morning():
     return datetime.now().replace(hour=5, minute=0, second=0)
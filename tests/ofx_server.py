@@ -0,0 +1,255 @@
+import itertools
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+
+from cash import ofx
+
+
+HEADER = '''OFXHEADER:100
+DATA:OFXSGML
+VERSION:102
+SECURITY:NONE
+ENCODING:USASCII
+CHARSET:1252
+COMPRESSION:NONE
+OLDFILEUID:NONE
+NEWFILEUID:NONE
+
+'''
+
+SIGNON = ('<SIGNONMSGSRSV1><SONRS><STATUS><CODE>0<SEVERITY>INFO</STATUS>'
+          '<DTSERVER>{now}<LANGUAGE>ENG</SONRS></SIGNONMSGSRSV1>')
+
+
+def naive(value):
+    if value is not None:
+        return value.replace(tzinfo=None)
+
+
+def ofx_date(value):
+    return value.strftime('%Y%m%d%H%M%S.000')
+
+
+def transaction(fitid, amount, name, date_posted, memo=None):
+    return ''.join([
+        '<STMTTRN>',
+        '<TRNTYPE>{}'.format('DEBIT' if amount < 0 else 'CREDIT'),
+        '<DTPOSTED>{}'.format(ofx_date(date_posted)),
+        '<TRNAMT>{:.2f}'.format(amount),
+        '<FITID>{}'.format(fitid),
+        '<NAME>{}'.format(name),
+        '<MEMO>{}'.format(memo or name),
+        '</STMTTRN>',
+    ])
+
+
+def statement_parts(account_number, transactions, account_type='CHECKING', start=None, end=None):
+    end = end or datetime.utcnow()
+    start = start or end - timedelta(days=30)
+
+    yield '<STMTTRNRS><TRNUID>{}<STATUS><CODE>0<SEVERITY>INFO</STATUS>'.format(account_number)
+    yield '<STMTRS><CURDEF>USD'
+    yield '<BANKACCTFROM><BANKID>123456789<ACCTID>{}<ACCTTYPE>{}</BANKACCTFROM>'.format(account_number, account_type)
+    yield '<BANKTRANLIST><DTSTART>{}<DTEND>{}'.format(ofx_date(start), ofx_date(end))
+    yield from transactions
+    yield '</BANKTRANLIST>'
+    yield '</STMTRS></STMTTRNRS>'
+
+
+def failed_statement(code, message):
+    # Banks don't say which account a failed statement was for
+    return ('<STMTTRNRS><TRNUID>1<STATUS><CODE>{}<SEVERITY>ERROR<MESSAGE>{}</STATUS>'
+            '</STMTTRNRS>'.format(code, message))
+
+
+def statement(account_number, transactions, account_type='CHECKING', start=None, end=None):
+    return ''.join(statement_parts(account_number, transactions, account_type, start, end))
+
+
+def statement_response_parts(statements):
+    # ``statements`` can be an iterable of iterables of strings, so a big
+    # response never has to exist in one piece
+    yield HEADER
+    yield '<OFX>'
+    yield SIGNON.format(now=ofx_date(datetime.utcnow()))
+    yield '<BANKMSGSRSV1>'
+
+    for parts in statements:
+        yield from parts
+
+    yield '</BANKMSGSRSV1></OFX>'
+
+
+def statement_response(statements):
+    return ''.join(statement_response_parts([[s] for s in statements]))
+
+
+def account_info_response(accounts):
+    infos = []
+    for account_number, account_type in accounts:
+        infos.append('<ACCTINFO><DESC>{0}<BANKACCTINFO><BANKACCTFROM><BANKID>123456789'
+                     '<ACCTID>{0}<ACCTTYPE>{1}</BANKACCTFROM><SUPTXDL>Y<XFERSRC>Y<XFERDEST>Y'
+                     '<SVCSTATUS>ACTIVE</BANKACCTINFO></ACCTINFO>'.format(account_number, account_type))
+
+    return ''.join([
+        HEADER,
+        '<OFX>',
+        SIGNON.format(now=ofx_date(datetime.utcnow())),
+        '<SIGNUPMSGSRSV1><ACCTINFOTRNRS><TRNUID>1<STATUS><CODE>0<SEVERITY>INFO</STATUS>',
+        '<ACCTINFORS><DTACCTUP>{}'.format(ofx_date(datetime.utcnow())),
+        ''.join(infos),
+        '</ACCTINFORS></ACCTINFOTRNRS></SIGNUPMSGSRSV1></OFX>',
+    ])
+
+
+class OFXStub(object):
+    # Just enough of a bank to answer account info and statement requests.
+    # Every account gets ``transactions`` made up transactions, one an hour
+    # up until the stub was started, and only the ones inside the requested
+    # window are sent back. ``late`` holds extra (fitid, amount, name, date)
+    # tuples per account for transactions that show up after the fact.
+    # ``latency`` is how long every response takes and ``failures`` maps an
+    # account number (or 'ACCTINFO' for the account list) to how many
+    # ``failure_status`` responses it gets before things start working.
+    # ``spacing`` is the time between made up transactions; make it smaller
+    # to fit a lot of them into a sync window. ``statement_errors`` maps an
+    # account number to the (code, message) its statement fails with.
+    #
+    # Statements are generated as they're written out, so the stub can serve
+    # millions of transactions without holding them all in memory.
+
+    def __init__(self, accounts, transactions=10, latency=0, failures=None, failure_status=500,
+                 spacing=timedelta(hours=1), statement_errors=None):
+        self.accounts = accounts
+        self.statement_errors = dict(statement_errors or {})
+        self.transactions = transactions
+        self.latency = latency
+        self.failures = dict(failures or {})
+        self.failure_status = failure_status
+        self.spacing = spacing
+        self.late = {}
+        self.end = datetime.utcnow().replace(microsecond=0)
+        self.requests = []
+        self.windows = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                status, parts = stub.respond(body)
+
+                # No Content-Length; the body ends when the connection closes
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/x-ofx')
+                self.send_header('Connection', 'close')
+                self.end_headers()
+
+                pending = []
+                size = 0
+
+                for part in parts:
+                    pending.append(part)
+                    size += len(part)
+
+                    if size >= 64 * 1024:
+                        self.wfile.write(''.join(pending).encode('utf-8'))
+                        pending = []
+                        size = 0
+
+                self.wfile.write(''.join(pending).encode('utf-8'))
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/ofx'.format(self.server.server_address[1])
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def account_transactions(self, account_number, start=None, end=None):
+        first = self.end - self.spacing * self.transactions
+
+        def generated():
+            for index in range(self.transactions):
+                amount = -(index % 97) - 0.5 if index % 10 else 1500.0
+                yield ('{}-{}'.format(account_number, index),
+                       amount,
+                       'STUB PAYEE {}'.format(index % 50),
+                       first + self.spacing * index)
+
+        for fitid, amount, name, date_posted in itertools.chain(generated(), self.late.get(account_number, [])):
+            if start and date_posted < start:
+                continue
+            if end and date_posted > end:
+                continue
+
+            yield transaction(fitid, amount, name, date_posted)
+
+    def respond(self, body):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+        try:
+            time.sleep(self.latency)
+
+            if b'<ACCTINFORQ>' in body:
+                self.requests.append(('ACCTINFORQ', []))
+
+                with self.lock:
+                    if self.failures.get('ACCTINFO'):
+                        self.failures['ACCTINFO'] -= 1
+                        return self.failure_status, ['Internal Server Error']
+
+                return 200, [account_info_response(self.accounts)]
+
+            windows = []
+            for request in ofx.iter_aggregates(BytesIO(body), 'STMTRQ'):
+                windows.append((request['ACCTID'],
+                                naive(ofx.parse_datetime(request.get('DTSTART'))),
+                                naive(ofx.parse_datetime(request.get('DTEND')))))
+
+            requested = [account_number for account_number, _, _ in windows]
+            self.requests.append(('STMTRQ', requested))
+            self.windows.extend(windows)
+
+            with self.lock:
+                if any(self.failures.get(a) for a in requested):
+                    for account_number in requested:
+                        if self.failures.get(account_number):
+                            self.failures[account_number] -= 1
+                    return self.failure_status, ['Internal Server Error']
+
+            statements = []
+            for account_number, start, end in windows:
+                if account_number in self.statement_errors:
+                    statements.append([failed_statement(*self.statement_errors[account_number])])
+                    continue
+
+                end = min(end or self.end, self.end)
+                statements.append(statement_parts(account_number,
+                                                  self.account_transactions(account_number, start, end),
+                                                  start=start,
+                                                  end=end))
+
+            return 200, statement_response_parts(statements)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
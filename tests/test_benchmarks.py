@@ -0,0 +1,82 @@
+import csv
+import math
+from datetime import date, timedelta
+
+import pytest
+
+from cash.models import Transaction
+from cash.tasks import process_file, update_transactions
+
+from .benchmark import measure
+from .ofx_server import OFXStub
+from .test_sync import ACCOUNTS, make_bank
+
+
+# The small size runs with everything else. The big ones take minutes, so
+# they only run with --benchmark, e.g.
+#
+#   pytest -s tests/test_benchmarks.py --benchmark -k 100k
+SIZES = [
+    pytest.param(1000, id='1k'),
+    pytest.param(100000, id='100k', marks=pytest.mark.benchmark),
+    pytest.param(1000000, id='1m', marks=pytest.mark.benchmark),
+]
+
+
+@pytest.fixture
+def report(capsys):
+    def report(line):
+        with capsys.disabled():
+            print('\n' + line)
+
+    return report
+
+
+def max_queries(settings, rows, groups=1):
+    # Work should grow with the number of batches, never with the number of
+    # rows
+    batches = math.ceil(rows / settings.INGEST_BATCH_SIZE) + groups
+    return 20 * groups + 6 * batches
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.parametrize('size', SIZES)
+def test_sync_throughput(settings, eager_tasks, report, size):
+    settings.OFX_SYNC_BACKOFF = 0
+    per_account = size // len(ACCOUNTS)
+
+    with OFXStub(ACCOUNTS, transactions=per_account, spacing=timedelta(minutes=1)) as stub:
+        make_bank(stub, 'Benchmark Bank')
+
+        with measure('update_transactions', size, report) as stats:
+            results = update_transactions()
+
+    assert all('error' not in result for result in results)
+    assert sum(result['rows'] for result in results) == size
+    assert Transaction.objects.count() == size
+    assert stats['queries'] <= max_queries(settings, size)
+    assert stats['peak_mb'] < 64
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.parametrize('size', SIZES)
+def test_csv_throughput(settings, account, report, tmp_path, size):
+    path = tmp_path / 'chase.csv'
+    start = date(2000, 1, 1)
+
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['Details', 'Posting Date', 'Description', 'Amount', 'Type', 'Balance', 'Check or Slip #'])
+
+        for index in range(size):
+            posted = start + timedelta(days=index // 100)
+            writer.writerow(['DEBIT', posted.strftime('%m/%d/%Y'), 'STORE {}'.format(index),
+                             '-{}.{:02d}'.format(index % 500, index % 100), 'DEBIT_CARD', '100.00', ''])
+
+    with measure('process_file', size, report) as stats:
+        result = process_file(account.id, str(path))
+
+    assert result['rows'] == size
+    assert Transaction.objects.count() == size
+    assert stats['queries'] <= max_queries(settings, size)
+    assert stats['peak_mb'] < 64
@@ -2,12 +2,15 @@ from datetime import datetime, timedelta
 
 import pytest
 
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 
 import recurrence
 
 from cash.models import Expense, Income, Transaction
-from cash.views import UpdateIncomeRelationsMixin
+from cash.periods import PayPeriods
+from cash.views import UpdateIncomeRelationsMixin, UpdateExpenseRelationsMixin
 
 
 @pytest.mark.django_db
@@ -187,3 +190,43 @@ def test_update_partial_series(client, expense_series):
 
     assert Expense.objects.filter(budgeted_amount=100).count() == 6
     assert Expense.objects.filter(budgeted_amount=150).count() == 53
+
+
+@pytest.mark.django_db
+def test_pay_periods(income_series):
+    periods = PayPeriods()
+    incomes = list(income_series.order_by('budgeted_date'))
+
+    assert len(periods) == len(incomes)
+    assert periods.income_id(incomes[0].budgeted_date - timedelta(days=30)) == incomes[0].id
+    assert periods.income_id(incomes[4].budgeted_date) == incomes[4].id
+    assert periods.income_id(incomes[4].budgeted_date + timedelta(days=13)) == incomes[4].id
+    assert periods.income_id(incomes[-1].budgeted_date + timedelta(days=300)) == incomes[-1].id
+
+
+@pytest.mark.django_db
+def test_series_assignment_query_count(five_this_morning, income_series):
+    def create_series(weeks):
+        rule = recurrence.Rule(recurrence.WEEKLY,
+                               byday=five_this_morning.weekday(),
+                               until=five_this_morning + timedelta(weeks=weeks))
+        expense = Expense.objects.create(budgeted_date=five_this_morning.date(),
+                                         budgeted_amount=20.0,
+                                         description='weekly groceries',
+                                         recurrences=recurrence.serialize(rule))
+
+        updater = UpdateExpenseRelationsMixin()
+        updater.object = expense
+
+        with CaptureQueriesContext(connection) as queries:
+            updater.update_relations(update_series=True)
+
+        return len(queries)
+
+    assert create_series(10) == create_series(52)
+
+    for expense in Expense.objects.all():
+        income = Income.objects.filter(budgeted_date__lte=expense.budgeted_date)\
+                               .order_by('-budgeted_date')\
+                               .first()
+        assert expense.income == income
@@ -2,11 +2,13 @@ from datetime import datetime, timedelta
 
 import pytest
 
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 
 import recurrence
 
-from cash.models import Income
+from cash.models import Income, Expense
 from cash.views import UpdateIncomeRelationsMixin
 
 
@@ -173,3 +175,34 @@ def test_create_with_matching_income(client, paycheck_matching_budgeted_income):
     assert income.transaction == transaction
     assert income.income == transaction.amount
     assert income.first_occurrence == first_occurrence
+
+
+@pytest.mark.django_db
+def test_update_expenses_moves_into_new_periods(biweekly, five_this_morning):
+    first_occurrence = Income.objects.create(budgeted=1000.0,
+                                             budgeted_date=five_this_morning.date(),
+                                             recurrences=recurrence.serialize(biweekly))
+
+    expenses = []
+    for week in range(52):
+        expenses.append(Expense(budgeted_amount=25.0,
+                                budgeted_date=(five_this_morning + timedelta(weeks=week, days=1)).date(),
+                                description='weekly snacks',
+                                income=first_occurrence))
+    Expense.objects.bulk_create(expenses)
+
+    updater = UpdateIncomeRelationsMixin()
+    updater.object = first_occurrence
+
+    with CaptureQueriesContext(connection) as queries:
+        moved = updater.update_relations(update_series=True)
+
+    assert moved == 50
+    assert sum('UPDATE "cash_expense"' in q['sql'] or 'UPDATE cash_expense' in q['sql'] for q in queries) == 1
+
+    for expense in Expense.objects.select_related('income'):
+        expected = Income.objects.filter(budgeted_date__lte=expense.budgeted_date)\
+                                 .order_by('-budgeted_date')\
+                                 .first()
+        assert expense.income == expected
+        assert expense.income.total_expenses == 50.0
@@ -0,0 +1,247 @@
+import csv
+from datetime import datetime
+
+import pytest
+
+from ofxtools.utils import UTC as OFX_UTC
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from cash import parsers
+from cash.ingestion import (TransactionRow, batched, copy_loader, copy_upsert_loader,
+                            default_loader, ingest, orm_loader, orm_upsert_loader, read_csv)
+from cash.models import Account, Expense, Transaction
+from cash.tasks import chase_parser, citizens_bank_parser, process_file
+
+
+CHASE_HEADER = ['Details', 'Posting Date', 'Description', 'Amount', 'Type', 'Balance', 'Check or Slip #']
+CITIZENS_HEADER = ['Date', 'Description', 'Amount', 'Balance']
+
+
+def write_csv(path, header, rows):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(rows)
+
+    return str(path)
+
+
+@pytest.fixture
+def chase_csv(tmp_path):
+    rows = [['DEBIT', '10/{:02d}/2020'.format(day), 'CORNER STORE {}'.format(day), '-12.50', 'DEBIT_CARD', '100.00', '']
+            for day in range(1, 29)]
+    rows.append(['CREDIT', '10/29/2020', 'INTEREST PAYMENT', '0.02', 'ACH_CREDIT', '100.02', ''])
+    rows.append(['DEBIT', '10/30/2020', 'ONLINE TRANSFER', '-50.00', 'ACCT_XFER', '50.02', ''])
+    rows.append(['CHECK', '10/31/2020', 'CHECK 101', '-25.00', 'CHECK_PAID', '25.02', '101'])
+
+    return write_csv(tmp_path / 'chase.csv', CHASE_HEADER, rows)
+
+
+@pytest.fixture
+def citizens_csv(tmp_path):
+    rows = [['10/01/2020', 'PAYCHECK', '1500.00', '1500.00'],
+            ['10/02/2020', 'GROCERIES', '-75.25', '1424.75']]
+
+    return write_csv(tmp_path / 'citizens.csv', CITIZENS_HEADER, rows)
+
+
+def test_batched():
+    assert list(batched(range(7), 3)) == [[0, 1, 2], [3, 4, 5], [6]]
+    assert list(batched([], 3)) == []
+
+
+@pytest.mark.django_db
+def test_chase_parser(account, chase_csv):
+    with CaptureQueriesContext(connection) as queries:
+        result = chase_parser(account.id, chase_csv, batch_size=10)
+
+    assert result['rows'] == 31
+    assert result['batches'] == 4
+    assert sum(q['sql'].strip().startswith('INSERT INTO') for q in queries) == 4
+
+    assert Transaction.objects.count() == 31
+    assert Transaction.objects.get(name='INTEREST PAYMENT').transaction_type == 'INT'
+    assert Transaction.objects.get(name='ONLINE TRANSFER').transaction_type == 'XFER'
+    assert Transaction.objects.get(name='CHECK 101').check_number == 101
+
+    # Same file again shouldn't make any new transactions
+    chase_parser(account.id, chase_csv)
+    assert Transaction.objects.count() == 31
+
+
+@pytest.mark.django_db
+def test_citizens_bank_parser(account, citizens_csv):
+    result = citizens_bank_parser(account.id, citizens_csv)
+
+    assert result['rows'] == 2
+    assert Transaction.objects.get(name='PAYCHECK').transaction_type == 'CREDIT'
+    assert Transaction.objects.get(name='GROCERIES').transaction_type == 'DEBIT'
+
+
+def test_sniff_format():
+    assert parsers.sniff(CHASE_HEADER).name == 'chase'
+    assert parsers.sniff(CITIZENS_HEADER).name == 'citizens'
+    assert parsers.sniff(['When', 'What', 'How Much']) is None
+    assert parsers.get_format('chase_parser').name == 'chase'
+
+
+@pytest.mark.django_db
+def test_process_file_sniffs_format(account, chase_csv, citizens_csv):
+    result = process_file(account.id, chase_csv)
+
+    assert result['format'] == 'chase'
+    assert result['rows'] == 31
+    assert Transaction.objects.get(name='INTEREST PAYMENT').transaction_type == 'INT'
+
+    result = process_file(account.id, citizens_csv)
+
+    assert result['format'] == 'citizens'
+    assert Transaction.objects.get(name='GROCERIES').transaction_type == 'DEBIT'
+
+
+@pytest.mark.django_db
+def test_process_file_uses_account_parser(account, citizens_csv, tmp_path):
+    account.upload_parser = 'citizens_bank_parser'
+    account.save()
+
+    assert process_file(account.id, citizens_csv)['format'] == 'citizens'
+
+    account.upload_parser = 'nonsense'
+    account.save()
+
+    with pytest.raises(ValueError, match="'nonsense' upload format, which does not exist"):
+        process_file(account.id, citizens_csv)
+
+    account.upload_parser = None
+    account.save()
+    budget_csv = write_csv(tmp_path / 'budget.csv', ['Category', 'Planned'], [['Groceries', '400']])
+
+    with pytest.raises(ValueError, match='No upload format matches the columns Category, Planned'):
+        process_file(account.id, budget_csv)
+
+
+@pytest.mark.django_db
+def test_configured_format(settings, account, tmp_path):
+    settings.CSV_FORMATS = [{
+        'name': 'credit_union',
+        'date': 'Trans Date',
+        'date_format': '%Y-%m-%d',
+        'amount': 'Debit Amount',
+        'description': 'Payee',
+        'memo': 'Notes',
+        'negate': True,
+        'type_rules': [('Payee', 'DIVIDEND', 'DIV')],
+    }]
+    path = write_csv(tmp_path / 'union.csv', ['Trans Date', 'Payee', 'Notes', 'Debit Amount'],
+                     [['2020-10-01', 'HARDWARE STORE', 'nails', '19.99'],
+                      ['2020-10-02', 'DIVIDEND', '', '-0.15']])
+
+    result = process_file(account.id, path)
+
+    assert result['format'] == 'credit_union'
+    store = Transaction.objects.get(name='HARDWARE STORE')
+    assert store.amount == -19.99
+    assert store.memo == 'nails'
+    assert store.transaction_type == 'DEBIT'
+    assert store.date_posted == datetime(2020, 10, 1, tzinfo=OFX_UTC)
+    assert Transaction.objects.get(name='DIVIDEND').transaction_type == 'DIV'
+
+
+def test_rows_are_lazy(chase_csv):
+    rows = parsers.get_format('chase').rows(read_csv(chase_csv), 1)
+    first = next(rows)
+
+    assert isinstance(first, TransactionRow)
+    assert first.amount == -12.5
+    assert first.check_number is None
+
+
+@pytest.mark.django_db
+def test_copy_loader(account, chase_csv):
+    result = ingest(parsers.get_format('chase').rows(read_csv(chase_csv), account.id), batch_size=8, loader=copy_loader)
+
+    assert result['rows'] == 31
+    assert result['inserted'] == 31
+
+    transaction = Transaction.objects.get(name='CHECK 101')
+    assert transaction.check_number == 101
+    assert transaction.amount == -25.0
+    assert Transaction.objects.get(name='CORNER STORE 1').check_number is None
+
+    result = ingest(parsers.get_format('chase').rows(read_csv(chase_csv), account.id), loader=copy_loader)
+
+    assert result['inserted'] == 0
+    assert Transaction.objects.count() == 31
+
+
+@pytest.mark.django_db
+def test_loader_fallback(settings):
+    assert default_loader() is copy_loader
+    assert default_loader(upsert=True) is copy_upsert_loader
+
+    settings.INGEST_USE_COPY = False
+
+    assert default_loader() is orm_loader
+    assert default_loader(upsert=True) is orm_upsert_loader
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('loader', [copy_upsert_loader, orm_upsert_loader])
+def test_upsert(account, income_series, loader):
+    posted = datetime(2020, 10, 1, tzinfo=OFX_UTC)
+    rows = [TransactionRow(transaction_id='txn-{}'.format(i),
+                           name='THING {}'.format(i),
+                           memo='THING {}'.format(i),
+                           amount=-10.0 - i,
+                           date_posted=posted,
+                           transaction_type='HOLD',
+                           account_id=account.id) for i in range(5)]
+
+    result = ingest(rows, loader=loader, upsert=True)
+
+    assert (result['inserted'], result['updated'], result['unchanged']) == (5, 0, 0)
+
+    income = income_series.order_by('budgeted_date')[2]
+    Expense.objects.create(budgeted_amount=5.0,
+                           description='the thing that was on hold',
+                           income=income,
+                           transaction_id='txn-3')
+
+    rows[3] = rows[3]._replace(amount=-20.0, transaction_type='DEBIT')
+    rows.append(rows[0])
+
+    result = ingest(rows, loader=loader, upsert=True)
+
+    assert (result['inserted'], result['updated'], result['unchanged']) == (0, 1, 4)
+
+    transaction = Transaction.objects.get(transaction_id='txn-3')
+    assert transaction.amount == -20.0
+    assert transaction.transaction_type == 'DEBIT'
+    assert income.ledger_entry.total_expenses == 20.0
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('loader', [copy_upsert_loader, orm_upsert_loader])
+def test_upsert_leaves_other_accounts_alone(account, loader):
+    other = Account.objects.create(bank=account.bank, account_type='SAVINGS', account_number='000044446666')
+    posted = datetime(2020, 10, 1, tzinfo=OFX_UTC)
+    row = TransactionRow(transaction_id='1001',
+                         name='COFFEE',
+                         memo='COFFEE',
+                         amount=-3.5,
+                         date_posted=posted,
+                         transaction_type='DEBIT',
+                         account_id=account.id)
+
+    ingest([row], loader=loader, upsert=True)
+
+    # Another account's FITID happens to be the same
+    clash = row._replace(name='RENT', memo='RENT', amount=-1500.0, account_id=other.id)
+    result = ingest([clash], loader=loader, upsert=True)
+
+    assert (result['inserted'], result['updated'], result['conflicts']) == (0, 0, 1)
+
+    transaction = Transaction.objects.get(transaction_id='1001')
+    assert (transaction.name, transaction.amount, transaction.account_id) == ('COFFEE', -3.5, account.id)
@@ -0,0 +1,98 @@
+from datetime import datetime
+
+import pytest
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from cash import ledger
+from cash.models import Expense, Income, LedgerEntry, Transaction
+
+
+def recursive_carry_over(incomes, index):
+    if index == 0:
+        return 0
+
+    previous = incomes[index - 1]
+    return (previous.income - abs(previous.total_expenses)) + recursive_carry_over(incomes, index - 1)
+
+
+@pytest.mark.django_db
+def test_ledger_matches_carry_over(expense_series):
+    incomes = list(Income.objects.order_by('budgeted_date'))
+
+    assert LedgerEntry.objects.count() == len(incomes)
+
+    for index, income in enumerate(incomes):
+        assert income.carry_over == pytest.approx(recursive_carry_over(incomes, index))
+
+
+@pytest.mark.django_db
+def test_expense_change_only_touches_later_periods(expense_series):
+    incomes = list(Income.objects.order_by('budgeted_date'))
+    somewhere_in_the_middle = incomes[10]
+    before = {e.period_id: e.carry_out for e in LedgerEntry.objects.all()}
+
+    Expense.objects.create(budgeted_amount=250.0,
+                           budgeted_date=somewhere_in_the_middle.budgeted_date,
+                           description='a very large pizza',
+                           income=somewhere_in_the_middle)
+
+    after = {e.period_id: e.carry_out for e in LedgerEntry.objects.all()}
+
+    for income in incomes[:10]:
+        assert after[income.id] == before[income.id]
+
+    for income in incomes[10:]:
+        assert after[income.id] == pytest.approx(before[income.id] - 250.0)
+
+
+@pytest.mark.django_db
+def test_transaction_amount_updates_ledger(account, income_series):
+    income = income_series.order_by('budgeted_date')[3]
+    transaction = Transaction.objects.create(transaction_id='paycheck-789',
+                                             name='Payday',
+                                             memo='Payday',
+                                             amount=1200.0,
+                                             account=account,
+                                             transaction_type='DIRECTDEP',
+                                             date_posted=datetime.combine(income.budgeted_date, datetime.min.time()))
+    income.transaction = transaction
+    income.save()
+
+    assert LedgerEntry.objects.get(period=income).income == 1200.0
+
+    transaction.amount = 1300.0
+    transaction.save()
+
+    next_income = income.next_income
+    assert LedgerEntry.objects.get(period=income).income == 1300.0
+    assert next_income.carry_over == pytest.approx(income.carry_over + 1300.0)
+
+
+@pytest.mark.django_db
+def test_deferred_updates_recompute_once(income_series):
+    incomes = list(income_series.order_by('budgeted_date'))
+
+    with CaptureQueriesContext(connection) as queries:
+        with ledger.deferred_updates():
+            for income in incomes[5:]:
+                Expense.objects.create(budgeted_amount=10.0,
+                                       budgeted_date=income.budgeted_date,
+                                       description='coffee',
+                                       income=income)
+
+            assert not any('UPDATE "cash_ledgerentry"' in q['sql'] for q in queries.captured_queries)
+
+    assert LedgerEntry.objects.get(period=incomes[-1]).total_expenses == 10.0
+
+
+@pytest.mark.django_db
+def test_carry_over_is_constant_time(income_series):
+    last = Income.objects.order_by('-budgeted_date').select_related('ledger').first()
+
+    with CaptureQueriesContext(connection) as queries:
+        last.carry_over
+        last.total_expenses
+
+    assert len(queries) == 0
@@ -0,0 +1,128 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from django.urls import reverse
+
+from cash import matching
+from cash.models import Expense, MatchSuggestion, Transaction
+
+
+def spend(account, transaction_id, amount, date, memo):
+    return Transaction.objects.create(transaction_id=transaction_id,
+                                      name=memo,
+                                      memo=memo,
+                                      amount=amount,
+                                      account=account,
+                                      transaction_type='DEBIT',
+                                      date_posted=datetime.combine(date, datetime.min.time()))
+
+
+@pytest.mark.django_db
+def test_suggest_matches(account, expense_series):
+    expense = expense_series.order_by('budgeted_date')[3]
+
+    twinkies = spend(account, 'twinkies', -100.5, expense.budgeted_date + timedelta(days=2), 'TWINKIES R US')
+    spend(account, 'refund', 100.0, expense.budgeted_date, 'TWINKIES R US')
+    spend(account, 'rent', -1500.0, expense.budgeted_date, 'RENT')
+    spend(account, 'too-late', -100.0, expense.budgeted_date + timedelta(days=20), 'TWINKIES R US')
+
+    assert matching.suggest_matches() == 1
+
+    suggestion = MatchSuggestion.objects.get()
+    assert suggestion.transaction == twinkies
+    assert suggestion.expense == expense
+
+    # Running it again replaces the suggestions instead of piling them up
+    assert matching.suggest_matches() == 1
+    assert MatchSuggestion.objects.count() == 1
+
+
+@pytest.mark.django_db
+def test_best_suggestion_first(account, expense_series):
+    expense = expense_series.order_by('budgeted_date')[3]
+    groceries = Expense.objects.create(budgeted_amount=100.0,
+                                       budgeted_date=expense.budgeted_date + timedelta(days=3),
+                                       income=expense.income,
+                                       description='groceries')
+
+    transaction = spend(account, 'twinkies', -100.0, expense.budgeted_date + timedelta(days=1), 'Twinkies')
+
+    matching.suggest_matches()
+
+    assert [s.expense for s in MatchSuggestion.objects.filter(transaction=transaction).order_by('-score')] == \
+           [expense, groceries]
+
+
+@pytest.mark.django_db
+def test_accept_suggestions(client, account, expense_series):
+    expenses = expense_series.order_by('budgeted_date')
+    first = spend(account, 'first', -100.0, expenses[1].budgeted_date, 'twinkies')
+    later = spend(account, 'later', -100.0, expenses[1].budgeted_date + timedelta(days=4), 'twinkies')
+    second = spend(account, 'second', -100.0, expenses[2].budgeted_date, 'twinkies')
+
+    matching.suggest_matches()
+
+    # Both transactions look like they paid for the same expense, so only
+    # the closer one gets it
+    response = client.post('/incoming-transactions/',
+                           {'suggestion': list(MatchSuggestion.objects.values_list('id', flat=True))})
+
+    assert response.status_code == 302
+    assert Expense.objects.get(id=expenses[1].id).transaction == first
+    assert Expense.objects.get(id=expenses[2].id).transaction == second
+    assert Expense.objects.filter(transaction__isnull=False).count() == 2
+    assert list(MatchSuggestion.objects.all()) == []
+
+    response = client.get('/incoming-transactions/')
+    assert list(response.context['transactions']) == [later]
+
+
+@pytest.mark.django_db
+def test_suggest_matches_for_new_days(account, expense_series):
+    expenses = expense_series.order_by('budgeted_date')
+    old = spend(account, 'old', -100.0, expenses[1].budgeted_date, 'twinkies')
+    matching.suggest_matches()
+    MatchSuggestion.objects.filter(transaction=old).update(score=0.01)
+
+    new = spend(account, 'new', -100.0, expenses[3].budgeted_date, 'twinkies')
+    day = expenses[3].budgeted_date
+
+    assert matching.suggest_matches(Transaction.objects.filter(account=account), day, day) == 1
+
+    # Older transactions keep the suggestions they already had
+    assert MatchSuggestion.objects.get(transaction=new).expense == expenses[3]
+    assert MatchSuggestion.objects.get(transaction=old).score == 0.01
+
+
+@pytest.mark.django_db
+def test_accept_skips_reconciled(account, expense_series):
+    expense = expense_series.order_by('budgeted_date')[1]
+    transaction = spend(account, 'twinkies', -100.0, expense.budgeted_date, 'twinkies')
+    matching.suggest_matches()
+
+    # Something else got attached to it in the meantime
+    Transaction.objects.filter(transaction_id=transaction.transaction_id).update(reconciled=True)
+
+    assert matching.accept(MatchSuggestion.objects.values_list('id', flat=True)) == 0
+    assert Expense.objects.get(id=expense.id).transaction is None
+
+
+@pytest.mark.django_db(transaction=True)
+def test_new_expense_matches_existing_transactions(client, account, income_series, eager_tasks):
+    income = income_series.order_by('budgeted_date')[7]
+    budgeted_date = income.budgeted_date + timedelta(days=3)
+    transaction = spend(account, 'whipped-cream', -50.0, budgeted_date + timedelta(days=1), 'WHIPPED CREAM')
+
+    # Nothing to match it with when it came in
+    matching.suggest_matches()
+    assert not MatchSuggestion.objects.exists()
+
+    client.post(reverse('create-expense'), {
+        'budgeted_amount': 50.0,
+        'budgeted_date': budgeted_date,
+        'description': 'whipped cream',
+        'recurrences': 'RDATE:{}'.format(budgeted_date.strftime('%Y%m%dT050000Z')),
+    })
+
+    assert MatchSuggestion.objects.get().transaction == transaction
@@ -0,0 +1,152 @@
+from datetime import datetime
+from io import BytesIO
+
+import pytest
+
+from ofxtools.Parser import OFXTree
+from ofxtools.utils import UTC as OFX_UTC
+
+from cash import ofx
+from cash.tasks import TransactionMachine
+
+from .ofx_server import failed_statement, statement as stub_statement, statement_response, transaction
+
+
+V1_HEADER = '''OFXHEADER:100
+DATA:OFXSGML
+VERSION:102
+SECURITY:NONE
+ENCODING:USASCII
+CHARSET:1252
+COMPRESSION:NONE
+OLDFILEUID:NONE
+NEWFILEUID:NONE
+
+'''
+
+V2_HEADER = '''<?xml version="1.0" encoding="UTF-8" standalone="no"?>
+<?OFX OFXHEADER="200" VERSION="220" SECURITY="NONE" OLDFILEUID="NONE" NEWFILEUID="NONE"?>
+'''
+
+
+def statement(transactions, close_elements=False):
+    def element(tag, value):
+        if close_elements:
+            return '<{0}>{1}</{0}>'.format(tag, value)
+        return '<{0}>{1}'.format(tag, value)
+
+    body = []
+    for index, (amount, name) in enumerate(transactions):
+        body.append(''.join([
+            '<STMTTRN>',
+            element('TRNTYPE', 'DEBIT' if amount < 0 else 'CREDIT'),
+            element('DTPOSTED', '2020101{}120000.000'.format(index % 10)),
+            element('TRNAMT', '{:.2f}'.format(amount)),
+            element('FITID', 'fitid-{}'.format(index)),
+            element('NAME', name),
+            '<PAYEE>', element('NAME', 'nested payee'), '</PAYEE>',
+            element('MEMO', 'memo {}'.format(index)),
+            '</STMTTRN>',
+        ]))
+
+    return ''.join([
+        '<OFX><SIGNONMSGSRSV1><SONRS><STATUS>',
+        element('CODE', '0'),
+        element('SEVERITY', 'INFO'),
+        '</STATUS></SONRS></SIGNONMSGSRSV1>',
+        '<BANKMSGSRSV1><STMTTRNRS><STMTRS><BANKACCTFROM>',
+        element('BANKID', '123456789'),
+        element('ACCTID', '000044445555'),
+        element('ACCTTYPE', 'CHECKING'),
+        '</BANKACCTFROM><BANKTRANLIST>',
+        ''.join(body),
+        '</BANKTRANLIST></STMTRS></STMTTRNRS></BANKMSGSRSV1></OFX>',
+    ])
+
+
+TRANSACTIONS = [(-12.5, 'CORNER STORE'), (1500.0, 'PAYCHECK'), (-3.75, 'BEANS &amp; RICE')] * 5
+
+
+@pytest.mark.parametrize('header,close_elements', [(V1_HEADER, False), (V2_HEADER, True)])
+@pytest.mark.parametrize('chunk_size', [1, 7, 64 * 1024])
+def test_iter_aggregates_matches_ofxtree(header, close_elements, chunk_size):
+    document = (header + statement(TRANSACTIONS, close_elements=close_elements)).encode('utf-8')
+
+    expected = []
+    for transaction in OFXTree().parse(BytesIO(document)).findall('.//STMTTRN'):
+        expected.append({tag: transaction.find(tag).text for tag in ['FITID', 'TRNAMT', 'NAME', 'MEMO']})
+
+    records = list(ofx.iter_aggregates(BytesIO(document), 'STMTTRN', chunk_size=chunk_size))
+
+    assert len(records) == len(TRANSACTIONS)
+
+    for record, transaction in zip(records, expected):
+        for tag, value in transaction.items():
+            assert record[tag] == value.replace('&amp;', '&')
+
+
+def test_iter_aggregates_is_incremental():
+    document = (V1_HEADER + statement(TRANSACTIONS)).encode('utf-8')
+    source = BytesIO(document)
+
+    records = ofx.iter_aggregates(source, 'STMTTRN', chunk_size=256)
+    next(records)
+
+    assert source.tell() < len(document)
+
+
+@pytest.mark.django_db
+def test_make_transaction_object(account):
+    document = (V1_HEADER + statement(TRANSACTIONS)).encode('utf-8')
+    record = next(ofx.iter_aggregates(BytesIO(document), 'STMTTRN'))
+
+    row = TransactionMachine(account.bank).make_transaction_object(record, account)
+
+    assert row.transaction_id == 'fitid-0'
+    assert row.amount == -12.5
+    assert row.name == 'CORNER STORE'
+    assert row.memo == 'memo 0'
+    assert row.date_posted.date().isoformat() == '2020-10-10'
+    assert row.account_id == account.id
+
+
+def test_iter_statement_transactions():
+    transfer = ('<STMTTRN><TRNTYPE>XFER<DTPOSTED>20201010<TRNAMT>-50.00<FITID>xfer-1'
+                '<NAME>TRANSFER<BANKACCTTO><BANKID>1<ACCTID>9999<ACCTTYPE>SAVINGS</BANKACCTTO></STMTTRN>')
+    document = statement_response([
+        stub_statement('1111', [transfer, transaction('a', -1.0, 'A', datetime(2020, 10, 10))]),
+        stub_statement('2222', [transaction('b', -2.0, 'B', datetime(2020, 10, 11))]),
+    ]).encode('utf-8')
+
+    records = [(context['ACCTID'], record['FITID']) for context, record in ofx.iter_statement_transactions(BytesIO(document))]
+
+    assert records == [('1111', 'xfer-1'), ('1111', 'a'), ('2222', 'b')]
+
+
+
+def test_statement_statuses():
+    document = statement_response([
+        stub_statement('1111', [transaction('a', -1.0, 'A', datetime(2020, 10, 10))]),
+        failed_statement('2000', 'General error'),
+    ]).encode('utf-8')
+    statuses = {}
+
+    assert len(list(ofx.iter_statement_transactions(BytesIO(document), statuses=statuses))) == 1
+    assert statuses == {'1111': ('0', ''), None: [('2000', 'General error')]}
+
+    # A bad password fails everything
+    document = document.replace(b'<CODE>0<SEVERITY>INFO</STATUS><DTSERVER>',
+                                b'<CODE>15500<SEVERITY>ERROR<MESSAGE>Bad password</STATUS><DTSERVER>')
+
+    with pytest.raises(ofx.OFXError, match='15500 Bad password'):
+        list(ofx.iter_statement_transactions(BytesIO(document), statuses={}))
+
+
+@pytest.mark.parametrize('value,expected', [
+    ('20201010', datetime(2020, 10, 10)),
+    ('20201010120000.000', datetime(2020, 10, 10, 12)),
+    ('20201010120000.000[-5:EST]', datetime(2020, 10, 10, 17)),
+    ('202010101200[+1]', datetime(2020, 10, 10, 11)),
+])
+def test_parse_datetime(value, expected):
+    assert ofx.parse_datetime(value) == expected.replace(tzinfo=OFX_UTC)
@@ -0,0 +1,113 @@
+import calendar
+from datetime import date, datetime, timedelta
+
+import pytest
+
+from cash.models import Income, LedgerEntry, Transaction
+from cash.paychecks import detect_paychecks, payer
+
+
+def deposit(account, transaction_id, name, amount, day):
+    return Transaction.objects.create(transaction_id=transaction_id,
+                                      name=name,
+                                      memo=name,
+                                      amount=amount,
+                                      account=account,
+                                      transaction_type='DIRECTDEP',
+                                      date_posted=datetime.combine(day, datetime.min.time()))
+
+
+def business_day(day):
+    # Paydays on a weekend come early
+    while day.weekday() > 4:
+        day -= timedelta(days=1)
+    return day
+
+
+@pytest.fixture
+def pay_history(account):
+    first = date(2019, 1, 4)
+
+    for index in range(26):
+        day = first + timedelta(days=14 * index)
+
+        # Paid a day late once
+        if index == 10:
+            day += timedelta(days=1)
+
+        deposit(account, 'acme-{}'.format(index), 'ACME CORP PAYROLL PPD ID: 99{}'.format(index),
+                2000.0 + index % 3, day)
+
+    for month in range(1, 13):
+        last = calendar.monthrange(2019, month)[1]
+
+        deposit(account, 'globex-{}-15'.format(month), 'Globex Dir Dep', 800.0, business_day(date(2019, month, 15)))
+        deposit(account, 'globex-{}-{}'.format(month, last), 'Globex Dir Dep', 800.0,
+                business_day(date(2019, month, last)))
+
+    deposit(account, 'venmo-1', 'VENMO CASHOUT', 20.0, date(2019, 3, 3))
+    deposit(account, 'venmo-2', 'VENMO CASHOUT', 45.0, date(2019, 7, 19))
+
+
+def test_payer():
+    assert payer('ACME CORP PAYROLL PPD ID: 123456789') == 'acme corp'
+    assert payer('Acme Corp Dir Dep 0415') == 'acme corp'
+
+
+@pytest.mark.django_db
+def test_detect_paychecks(pay_history):
+    proposals = {series.payer: series for series in detect_paychecks(until=date(2020, 6, 1))}
+
+    assert set(proposals) == {'acme corp', 'globex'}
+
+    acme = proposals['acme corp']
+    assert acme.cadence == 'biweekly'
+    assert acme.budgeted == 2001.0
+    assert acme.deposits == 26
+    assert acme.first_date == date(2019, 1, 4)
+
+    globex = proposals['globex']
+    assert globex.cadence == 'semi-monthly'
+    assert globex.deposits == 24
+
+
+@pytest.mark.django_db
+def test_create_paycheck_series(client, pay_history):
+    response = client.get('/income/paychecks/')
+    assert {series.payer for series in response.context['proposals']} == {'acme corp', 'globex'}
+
+    response = client.post('/income/paychecks/', {'payer': ['acme corp']})
+    assert response.status_code == 302
+
+    incomes = Income.objects.order_by('budgeted_date')
+    first = incomes[0]
+
+    assert first.budgeted_date == date(2019, 1, 4)
+    assert first.transaction_id == 'acme-0'
+    assert incomes.filter(first_occurrence=first).count() == incomes.count() - 1
+    assert incomes.filter(transaction__isnull=False).count() == 26
+    assert Income.objects.get(transaction_id='acme-10').budgeted_date == date(2019, 5, 24)
+    assert incomes.last().budgeted_date > date.today()
+    assert LedgerEntry.objects.count() == incomes.count()
+
+    # Only the other payer is left to propose
+    response = client.get('/income/paychecks/')
+    assert [series.payer for series in response.context['proposals']] == ['globex']
+
+
+@pytest.mark.django_db
+def test_paychecks_on_the_same_day(client, pay_history):
+    # Typed in by hand before the deposit showed up
+    Income.objects.create(budgeted=800.0, budgeted_date=date(2019, 4, 15))
+
+    client.post('/income/paychecks/', {'payer': ['acme corp']})
+    response = client.post('/income/paychecks/', {'payer': ['globex']}, follow=True)
+
+    # Both of them paid on February 15th and March 15th
+    assert Income.objects.get(budgeted_date=date(2019, 3, 15)).transaction_id == 'acme-5'
+    assert not Transaction.objects.get(transaction_id='globex-3-15').reconciled
+    assert 'Another paycheck was already deposited on 2019-02-15, 2019-03-15.' in response.content.decode()
+
+    # The one without a deposit got Globex's
+    assert Income.objects.get(budgeted_date=date(2019, 4, 15)).transaction_id == 'globex-4-15'
+    assert Transaction.objects.get(transaction_id='globex-4-15').reconciled
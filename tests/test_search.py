@@ -0,0 +1,157 @@
+from datetime import date, datetime, timedelta, timezone
+
+import pytest
+
+from django.db import connection
+
+from cash import search
+from cash.models import Transaction, TransactionToken
+
+
+def spend(account, transaction_id, name, amount, day):
+    return Transaction.objects.create(transaction_id=transaction_id,
+                                      name=name,
+                                      memo='POS DEBIT',
+                                      amount=amount,
+                                      account=account,
+                                      transaction_type='DEBIT',
+                                      date_posted=datetime.combine(day, datetime.min.time(), tzinfo=timezone.utc))
+
+
+@pytest.fixture
+def purchases(account):
+    spend(account, 'coffee', 'STARBUCKS STORE 123', -4.5, date(2020, 10, 1))
+    spend(account, 'books', 'AMAZON.COM MKTP', -12.5, date(2020, 10, 1))
+    spend(account, 'movie', 'Starlight Cinema', -12.5, date(2020, 10, 2))
+
+
+def autocomplete(client, q, **params):
+    response = client.get('/transaction-autocomplete/', dict(q=q, **params))
+    return {result['id'] for result in response.json()['results']}
+
+
+def test_parse_query():
+    assert search.parse_query('Star $12.50 10/02/2020 store 123') == \
+        (['star', 'store', '123'], [12.5], [date(2020, 10, 2)])
+
+
+@pytest.mark.django_db
+def test_autocomplete_search(client, purchases):
+    assert autocomplete(client, 'star') == {'coffee', 'movie'}
+    assert autocomplete(client, 'star $12.50') == {'movie'}
+    assert autocomplete(client, 'amazon') == {'books'}
+    assert autocomplete(client, 'amazon.com mk') == {'books'}
+    assert autocomplete(client, 'pos 123') == {'coffee'}
+    assert autocomplete(client, '12.50 10/01/2020') == {'books'}
+    assert autocomplete(client, 'nothing') == set()
+
+
+@pytest.mark.django_db
+def test_autocomplete_within_income(client, purchases, income_series):
+    income = income_series.order_by('budgeted_date')[1]
+
+    assert autocomplete(client, 'star', income_id=income.id) == set()
+
+
+@pytest.mark.django_db
+def test_autocomplete_pages(client, account):
+    for index in range(12):
+        spend(account, 'coffee-{}'.format(index), 'STARBUCKS', -4.5, date(2020, 10, index + 1))
+
+    response = client.get('/transaction-autocomplete/', {'q': 'starbucks'})
+
+    assert len(response.json()['results']) == 10
+    assert response.json()['pagination']['more']
+
+    response = client.get('/transaction-autocomplete/', {'q': 'starbucks', 'page': 2})
+
+    assert len(response.json()['results']) == 2
+    assert not response.json()['pagination']['more']
+
+
+@pytest.mark.django_db
+def test_token_search(monkeypatch, purchases):
+    monkeypatch.setattr(search, 'uses_full_text', lambda: False)
+
+    # Postgres doesn't need the tokens, so they weren't kept up to date
+    assert not TransactionToken.objects.exists()
+    search.index_transactions(Transaction.objects.all())
+
+    def found(q):
+        return {t.transaction_id for t in search.search(Transaction.objects.all(), q)}
+
+    assert found('star') == {'coffee', 'movie'}
+    assert found('star cin') == {'movie'}
+    assert found('$4.50') == {'coffee'}
+    assert found('amazon.com') == {'books'}
+
+    movie = Transaction.objects.get(transaction_id='movie')
+    movie.name = 'Regal'
+    movie.save()
+
+    assert found('star') == {'coffee'}
+    assert found('regal') == {'movie'}
+
+
+@pytest.mark.django_db
+def test_search_uses_index(purchases):
+    queryset = search.search(Transaction.objects.all(), 'star')
+
+    with connection.cursor() as cursor:
+        cursor.execute('SET LOCAL enable_seqscan = off')
+        sql, params = queryset.query.sql_with_params()
+        cursor.execute('EXPLAIN ' + sql, params)
+        plan = '\n'.join(row[0] for row in cursor.fetchall())
+
+    assert 'transaction_search' in plan
+
+
+@pytest.mark.django_db
+def test_ranking_is_bounded(account, settings):
+    settings.SEARCH_RANK_CANDIDATES = 100
+    day = datetime(2020, 1, 1, tzinfo=timezone.utc)
+
+    Transaction.objects.bulk_create([Transaction(transaction_id='coffee-{}'.format(index),
+                                                 name='STARBUCKS STORE {}'.format(index),
+                                                 memo='POS DEBIT',
+                                                 amount=-4.5,
+                                                 account=account,
+                                                 transaction_type='DEBIT',
+                                                 date_posted=day + timedelta(hours=index))
+                                     for index in range(5000)])
+
+    # A letter or two isn't worth ranking
+    assert 'ts_rank' not in str(search.search(Transaction.objects.all(), 'st').query)
+
+    results = search.search(Transaction.objects.all(), 'starbucks')
+
+    # Nothing past the candidates gets left out
+    assert results.count() == 5000
+
+    sql, params = results[:10].query.sql_with_params()
+
+    with connection.cursor() as cursor:
+        cursor.execute('ANALYZE cash_transaction')
+        cursor.execute('EXPLAIN (ANALYZE, VERBOSE, FORMAT JSON) ' + sql, params)
+        plan = cursor.fetchone()[0][0]['Plan']
+
+    # Everything matches, but only the candidates get ranked
+    sort, = plan['Plans']
+
+    assert sort['Node Type'] == 'Sort'
+    assert sort['Sort Key'][0].startswith('(CASE WHEN (hashed SubPlan 1) THEN ts_rank(')
+
+
+@pytest.mark.django_db
+def test_autocomplete_ranks_within_income(client, account, income_series, settings):
+    settings.SEARCH_RANK_CANDIDATES = 5
+    incomes = income_series.order_by('budgeted_date')
+    income = incomes[1]
+
+    spend(account, 'old-books', 'AMAZON.COM MKTP', -12.5, income.budgeted_date - timedelta(days=1))
+
+    for index in range(10):
+        spend(account, 'new-books-{}'.format(index), 'AMAZON.COM MKTP', -12.5,
+              incomes[3].budgeted_date - timedelta(days=1))
+
+    assert autocomplete(client, 'amazon', income_id=income.id) == {'old-books'}
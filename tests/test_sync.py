@@ -0,0 +1,309 @@
+import io
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+
+import pytest
+
+from django.core.management import call_command
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test.utils import CaptureQueriesContext
+
+from ofxtools.utils import UTC as OFX_UTC
+
+from cash.models import Account, FinancialInstitution, IngestionJob, OFXResponse, SyncState, Transaction
+from cash.tasks import TransactionMachine, discover_accounts, update_transactions
+
+from .ofx_server import OFXStub
+
+
+ACCOUNTS = [('1111', 'CHECKING'), ('2222', 'SAVINGS'), ('3333', 'CHECKING'), ('4444', 'SAVINGS')]
+OTHER_ACCOUNTS = [('5555', 'CHECKING'), ('6666', 'SAVINGS')]
+
+
+def make_bank(stub, name, **kwargs):
+    return FinancialInstitution.objects.create(name=name,
+                                               ofx_endpoint=stub.url,
+                                               user_id='user',
+                                               password='hunter2',
+                                               org='STUB',
+                                               fid='1234',
+                                               bank_id='123456789',
+                                               **kwargs)
+
+
+@pytest.fixture(autouse=True)
+def fast_retries(settings, eager_tasks):
+    settings.OFX_SYNC_BACKOFF = 0
+
+
+@pytest.mark.django_db(transaction=True)
+def test_sync_all_banks():
+    with OFXStub(ACCOUNTS, transactions=25) as first, OFXStub(OTHER_ACCOUNTS, transactions=5) as second:
+        first_bank = make_bank(first, 'First Bank')
+        second_bank = make_bank(second, 'Second Bank')
+        FinancialInstitution.objects.create(name='Cash under the mattress')
+
+        assert Account.objects.filter(bank=first_bank).count() == 4
+        assert Account.objects.filter(bank=second_bank).count() == 2
+
+        results = update_transactions()
+
+    assert len(results) == 6
+    assert all('error' not in result for result in results)
+    assert Transaction.objects.filter(account__bank=first_bank).count() == 100
+    assert Transaction.objects.filter(account__bank=second_bank).count() == 10
+
+    job = IngestionJob.objects.get(bank=first_bank)
+
+    assert job.kind == 'ofx'
+    assert job.status == 'done'
+    assert (job.rows_read, job.inserted, job.duplicates, job.errors) == (100, 100, 0, 0)
+    assert job.bytes_read > 0
+    assert {result['job'] for result in results if result['bank'] == first_bank.id} == {job.id}
+
+
+@pytest.mark.django_db(transaction=True)
+def test_sync_batches_statement_requests():
+    with OFXStub(ACCOUNTS, transactions=7) as stub:
+        bank = make_bank(stub, 'Batch Bank')
+        results = update_transactions()
+
+    statement_requests = [accounts for kind, accounts in stub.requests if kind == 'STMTRQ']
+
+    assert statement_requests == [['1111', '2222', '3333', '4444']]
+    assert [r['rows'] for r in results] == [7, 7, 7, 7]
+
+    for account in Account.objects.filter(bank=bank):
+        transactions = Transaction.objects.filter(account=account)
+        assert transactions.count() == 7
+        assert all(t.transaction_id.startswith(account.account_number) for t in transactions)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_sync_respects_max_connections(settings):
+    settings.OFX_STATEMENTS_PER_REQUEST = 1
+
+    with OFXStub(ACCOUNTS, latency=0.2) as serial, OFXStub(ACCOUNTS, latency=0.2) as parallel:
+        make_bank(serial, 'Serial Bank', max_connections=1)
+        make_bank(parallel, 'Parallel Bank', max_connections=4)
+
+        started = time.monotonic()
+        update_transactions()
+        elapsed = time.monotonic() - started
+
+    assert serial.max_in_flight == 1
+    assert parallel.max_in_flight > 1
+
+    # Both banks run at the same time so it only takes as long as the slow one
+    assert elapsed < 4 * 0.2 + 4 * 0.2
+
+
+@pytest.mark.django_db(transaction=True)
+def test_sync_retries_and_isolates_failures(settings):
+    settings.OFX_STATEMENTS_PER_REQUEST = 1
+
+    with OFXStub(ACCOUNTS, transactions=3, failures={'1111': 2, '2222': 10}) as stub:
+        bank = make_bank(stub, 'Flaky Bank')
+
+        results = {r['account']: r for r in update_transactions()}
+
+    accounts = {a.account_number: a.id for a in Account.objects.filter(bank=bank)}
+
+    assert results[accounts['1111']]['rows'] == 3
+    assert 'HTTPError 500' in results[accounts['2222']]['error']
+    assert Transaction.objects.filter(account_id=accounts['2222']).count() == 0
+    assert Transaction.objects.filter(account__bank=bank).count() == 9
+
+    job = IngestionJob.objects.get(bank=bank)
+
+    assert job.status == 'failed'
+    assert 'HTTPError 500' in job.error
+    assert (job.rows_read, job.inserted, job.errors) == (9, 9, 1)
+
+
+
+@pytest.mark.django_db(transaction=True)
+def test_failed_statement_keeps_watermark():
+    with OFXStub(ACCOUNTS[:2], transactions=48) as stub:
+        bank = make_bank(stub, 'Grumpy Bank')
+        update_transactions()
+
+        before = {state.account.account_number: state.window_end for state in SyncState.objects.all()}
+        stub.statement_errors['2222'] = ('2000', 'General error')
+
+        results = {r['account']: r for r in update_transactions()}
+
+    accounts = {a.account_number: a.id for a in Account.objects.filter(bank=bank)}
+    after = {state.account.account_number: state.window_end for state in SyncState.objects.all()}
+
+    assert 'error' not in results[accounts['1111']]
+    assert after['1111'] > before['1111']
+
+    assert 'General error' in results[accounts['2222']]['error']
+    assert after['2222'] == before['2222']
+
+    job = IngestionJob.objects.filter(bank=bank).latest('id')
+
+    assert job.status == 'failed'
+    assert job.errors == 1
+
+
+@pytest.mark.django_db(transaction=True)
+def test_sync_watermark_and_overlap():
+    with OFXStub(ACCOUNTS[:1], transactions=24 * 30) as stub:
+        bank = make_bank(stub, 'Watermark Bank')
+        account = Account.objects.get(bank=bank)
+
+        first, = update_transactions()
+        state = SyncState.objects.get(account=account)
+
+        assert first['rows'] == 24 * 30
+        assert state.window_start == datetime(2016, 1, 1, tzinfo=OFX_UTC)
+        assert state.server_end == stub.end.replace(tzinfo=OFX_UTC)
+        assert state.server_end <= state.window_end
+
+        # Something from a couple days back finally posts
+        posted = stub.end - timedelta(days=2)
+        stub.late['1111'] = [('late-1', -42.0, 'SLOWPOKE', posted)]
+
+        second, = update_transactions()
+        _, dtstart, _ = stub.windows[-1]
+
+        assert dtstart == stub.end - timedelta(days=7)
+        assert second['rows'] == 1
+        assert second['duplicates'] > 0
+        assert Transaction.objects.filter(transaction_id='late-1').exists()
+        assert Transaction.objects.filter(account=account).count() == 24 * 30 + 1
+
+
+
+@pytest.mark.django_db(transaction=True)
+def test_sync_preloads_each_accounts_own_overlap():
+    with OFXStub(ACCOUNTS[:2], transactions=24 * 30) as stub:
+        bank = make_bank(stub, 'Lopsided Bank')
+        update_transactions()
+
+        # Savings wants a much longer overlap than checking does
+        SyncState.objects.filter(account__account_number='2222').update(overlap=timedelta(days=60))
+
+        with CaptureQueriesContext(connection) as queries:
+            TransactionMachine(bank).import_accounts(list(Account.objects.filter(bank=bank)))
+
+    preload, = [q['sql'] for q in queries if '"cash_transaction"."account_id", "cash_transaction"."transaction_id"' in q['sql']]
+
+    with connection.cursor() as cursor:
+        # It's read through a server side cursor
+        cursor.execute(preload[preload.index('SELECT'):])
+        loaded = Counter(account_number for account_number, in
+                         Transaction.objects.filter(transaction_id__in=[row[1] for row in cursor.fetchall()])
+                                            .values_list('account__account_number'))
+
+    assert loaded['2222'] == 24 * 30
+    assert 7 * 24 <= loaded['1111'] <= 8 * 24
+
+
+@pytest.mark.django_db(transaction=True)
+def test_sync_updates_changed_transactions():
+    with OFXStub(ACCOUNTS[:1], transactions=48) as stub:
+        make_bank(stub, 'Pending Bank')
+        update_transactions()
+
+        held = Transaction.objects.get(transaction_id='1111-47')
+        stub.late['1111'] = [('1111-47', held.amount - 5, 'FINALLY POSTED', stub.end - timedelta(hours=1))]
+
+        result, = update_transactions()
+
+    posted = Transaction.objects.get(transaction_id='1111-47')
+
+    assert result['rows'] == 1
+    assert posted.amount == held.amount - 5
+    assert posted.name == 'FINALLY POSTED'
+    assert Transaction.objects.count() == 48
+
+
+@pytest.mark.django_db(transaction=True)
+def test_account_discovery():
+    with OFXStub(ACCOUNTS[:2]) as stub:
+        bank = make_bank(stub, 'Discovery Bank')
+        bank.refresh_from_db()
+
+        assert bank.discovery_status == 'done'
+        assert bank.discovery_message == 'Found 2 accounts, 2 new'
+
+        stub.accounts = ACCOUNTS
+        result = discover_accounts(bank.id)
+
+    assert result == {'bank': bank.id, 'accounts': 4, 'new': 2}
+    assert Account.objects.filter(bank=bank).count() == 4
+
+
+@pytest.mark.django_db(transaction=True)
+def test_account_discovery_failure_keeps_bank():
+    with OFXStub(ACCOUNTS, failures={'ACCTINFO': 10}) as stub:
+        bank = make_bank(stub, 'Broken Bank')
+
+    bank.refresh_from_db()
+
+    assert bank.discovery_status == 'failed'
+    assert 'HTTPError 500' in bank.discovery_message
+    assert Account.objects.filter(bank=bank).count() == 0
+
+
+@pytest.mark.django_db(transaction=True)
+def test_responses_are_archived_and_replayed():
+    with OFXStub(ACCOUNTS[:2], transactions=20) as stub:
+        bank = make_bank(stub, 'Archive Bank')
+        update_transactions()
+
+    response = OFXResponse.objects.get(bank=bank)
+
+    assert {a.account_number for a in response.accounts.all()} == {'1111', '2222'}
+    assert 0 < len(response.data) < response.size
+
+    # Pretend the first parse got names wrong and fix them from the archive
+    Transaction.objects.update(name='')
+    requests = len(stub.requests)
+
+    out = io.StringIO()
+    call_command('replay_ofx', '--bank', str(bank.id), stdout=out)
+
+    assert 'Replayed 1 responses, 40 rows' in out.getvalue()
+    assert len(stub.requests) == requests
+    assert not Transaction.objects.filter(name='').exists()
+
+    out = io.StringIO()
+    call_command('replay_ofx', '--since', '2100-01-01', stdout=out)
+
+    assert 'Replayed 0 responses' in out.getvalue()
+
+
+@pytest.mark.django_db(transaction=True)
+def test_duplicate_accounts_merged_by_migration():
+    executor = MigrationExecutor(connection)
+    executor.migrate([('cash', '0033_ingestionjob')])
+    apps = executor.loader.project_state([('cash', '0033_ingestionjob')]).apps
+
+    bank = apps.get_model('cash', 'FinancialInstitution').objects.create(name='Twice Bank')
+    Account = apps.get_model('cash', 'Account')
+    first, second = [Account.objects.create(bank=bank, account_number='1111', account_type='CHECKING')
+                     for _ in range(2)]
+    Account.objects.create(bank=bank, account_number='1111', account_type='SAVINGS')
+
+    apps.get_model('cash', 'Transaction').objects.create(transaction_id='t1', name='', memo='', amount=1,
+                                                         date_posted=datetime(2020, 10, 1, tzinfo=OFX_UTC),
+                                                         transaction_type='DEBIT', account=second)
+    SyncState = apps.get_model('cash', 'SyncState')
+    SyncState.objects.create(account=first, window_end=datetime(2020, 10, 5, tzinfo=OFX_UTC))
+    SyncState.objects.create(account=second, window_end=datetime(2020, 10, 1, tzinfo=OFX_UTC))
+
+    executor = MigrationExecutor(connection)
+    executor.migrate(executor.loader.graph.leaf_nodes())
+
+    checking = Account.objects.filter(bank=bank, account_type='CHECKING')
+
+    assert [account.id for account in checking] == [first.id]
+    assert Account.objects.filter(bank=bank).count() == 2
+    assert Transaction.objects.get(transaction_id='t1').account_id == first.id
+    assert SyncState.objects.get(account=first).window_end == datetime(2020, 10, 1, tzinfo=OFX_UTC)
@@ -0,0 +1,121 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from cash import transfers
+from cash.models import Account, IngestionJob, Transaction, Transfer
+from cash.tasks import process_file
+from cash.transfers import detect_transfers, pair_transfers
+
+from .test_ingestion import CHASE_HEADER, CITIZENS_HEADER, write_csv
+
+
+def test_pair_transfers():
+    day = datetime(2020, 10, 1)
+    window = timedelta(days=3)
+
+    transactions = [
+        ('out', 1, -500.0, day),
+        ('same-account', 1, 500.0, day),
+        ('coffee', 1, -3.5, day + timedelta(days=1)),
+        ('in', 2, 500.0, day + timedelta(days=1)),
+        ('too-late', 2, 3.5, day + timedelta(days=5)),
+        ('late-out', 3, -3.5, day + timedelta(days=6)),
+    ]
+
+    assert list(pair_transfers(transactions, window)) == [('out', 'in'), ('late-out', 'too-late')]
+
+    # Closest one wins
+    transactions = [
+        ('early', 1, -20.0, day),
+        ('later', 1, -20.0, day + timedelta(days=2)),
+        ('in', 2, 20.0, day + timedelta(days=3)),
+    ]
+
+    assert list(pair_transfers(transactions, window)) == [('later', 'in')]
+
+
+@pytest.mark.django_db
+def test_transfers_detected_on_ingest(client, account, tmp_path):
+    savings = Account.objects.create(bank=account.bank, account_type='SAVINGS', account_number='000044446666')
+    savings.upload_parser = 'citizens'
+    savings.save()
+
+    checking = write_csv(tmp_path / 'checking.csv', CHASE_HEADER, [
+        ['DEBIT', '10/01/2020', 'ONLINE TRANSFER TO SAVINGS', '-500.00', 'ACCT_XFER', '100.00', ''],
+        ['DEBIT', '10/02/2020', 'CORNER STORE', '-12.50', 'DEBIT_CARD', '87.50', ''],
+        ['CREDIT', '10/03/2020', 'CORNER STORE REFUND', '12.50', 'ACH_CREDIT', '100.00', ''],
+    ])
+    deposits = write_csv(tmp_path / 'savings.csv', CITIZENS_HEADER, [
+        ['10/02/2020', 'ONLINE TRANSFER FROM CHECKING', '500.00', '500.00'],
+        ['10/20/2020', 'ONLINE TRANSFER FROM CHECKING', '12.50', '512.50'],
+    ])
+
+    assert process_file(account.id, checking)['transfers'] == 0
+    assert process_file(savings.id, deposits)['transfers'] == 1
+
+    transfer = Transfer.objects.get()
+    assert transfer.reason == 'Detected automatically'
+    assert transfer.transaction_from.amount == -500.0
+    assert transfer.transaction_from.account == account
+    assert transfer.transaction_to.account == savings
+
+    response = client.get('/incoming-transactions/')
+    assert {t.memo for t in response.context['transactions']} == \
+           {'CORNER STORE', 'CORNER STORE REFUND', 'ONLINE TRANSFER FROM CHECKING'}
+    assert Transaction.unreconciled().count() == 3
+
+    # Importing the same file again doesn't find anything new
+    assert process_file(savings.id, deposits)['transfers'] == 0
+    assert Transfer.objects.count() == 1
+
+
+@pytest.mark.django_db
+def test_transfer_found_by_another_import(account):
+    savings = Account.objects.create(bank=account.bank, account_type='SAVINGS', account_number='000044446666')
+    day = datetime(2020, 10, 1, tzinfo=timezone.utc)
+
+    out = Transaction.objects.create(transaction_id='out', account=account, amount=-500, date_posted=day,
+                                     transaction_type='DEBIT', name='TRANSFER TO SAVINGS', memo='')
+    deposit = Transaction.objects.create(transaction_id='in', account=savings, amount=500, date_posted=day,
+                                         transaction_type='CREDIT', name='TRANSFER FROM CHECKING', memo='')
+
+    # Another import got there first but hasn't marked them reconciled yet
+    Transfer.objects.create(transaction_from=out, transaction_to=deposit)
+    Transaction.objects.update(reconciled=False)
+
+    # This one was already paired with something else, so pairing it again
+    # doesn't stick and isn't counted
+    bills = Transaction.objects.create(transaction_id='bills', account=account, amount=-75, date_posted=day,
+                                       transaction_type='DEBIT', name='TRANSFER TO BILLS', memo='')
+    Transaction.objects.create(transaction_id='bills-in', account=savings, amount=75, date_posted=day,
+                               transaction_type='CREDIT', name='TRANSFER FROM CHECKING', memo='')
+    Transfer.objects.create(transaction_from=bills, transaction_to=Transaction.objects.create(
+        transaction_id='elsewhere', account=savings, amount=75, date_posted=day - timedelta(days=30),
+        transaction_type='CREDIT', name='TRANSFER FROM CHECKING', memo=''))
+    Transaction.objects.filter(transaction_id='bills').update(reconciled=False)
+
+    assert detect_transfers(day.date(), day.date()) == 1
+
+    assert Transfer.objects.count() == 2
+    assert Transaction.objects.get(transaction_id='out').reconciled
+    assert not Transaction.objects.get(transaction_id='bills-in').reconciled
+
+
+@pytest.mark.django_db
+def test_transfer_failure_reported_on_job(monkeypatch, account, tmp_path):
+    def broken(since, until):
+        raise RuntimeError('lock timeout')
+
+    monkeypatch.setattr(transfers, 'detect_transfers', broken)
+    checking = write_csv(tmp_path / 'checking.csv', CHASE_HEADER, [
+        ['DEBIT', '10/01/2020', 'ONLINE TRANSFER TO SAVINGS', '-500.00', 'ACCT_XFER', '100.00', ''],
+    ])
+
+    with pytest.raises(RuntimeError):
+        process_file(account.id, checking)
+
+    job = IngestionJob.objects.get(account=account)
+
+    assert job.status == 'failed'
+    assert 'lock timeout' in job.error
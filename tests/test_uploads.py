@@ -0,0 +1,267 @@
+import csv
+import io
+import zipfile
+from datetime import date
+
+import pytest
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.urls import reverse
+
+from cash import parsers, uploads
+from cash.jobs import JobProgress
+from cash.models import IngestionJob, StagedRow, Transaction, Upload
+from cash.tasks import process_file, process_upload
+from cream.celery import app
+
+
+HEADER = ['Date', 'Description', 'Amount', 'Balance']
+
+
+def export(start, end, month=10):
+    f = io.StringIO()
+    writer = csv.writer(f)
+    writer.writerow(HEADER)
+
+    for day in range(start, end + 1):
+        writer.writerow(['{:02d}/{:02d}/2020'.format(month, day), 'COFFEE {}/{}'.format(month, day), '-3.50', '100.00'])
+
+    return f.getvalue().encode()
+
+
+@pytest.fixture
+def enqueued(monkeypatch):
+    calls = []
+
+    def delay(*args, **kwargs):
+        calls.append(args)
+        return process_upload(*args, **kwargs)
+
+    monkeypatch.setattr(process_upload, 'delay', delay)
+    return calls
+
+
+@pytest.mark.django_db
+def test_duplicate_upload_short_circuits(client, account, enqueued):
+    data = {'account-name': account.id, 'csv': SimpleUploadedFile('october.csv', export(1, 31))}
+    response = client.post(reverse('upload-csv'), data)
+
+    assert 'Upload successful!' in response.content.decode()
+    assert len(enqueued) == 1
+    assert Transaction.objects.count() == 31
+
+    upload = Upload.objects.get()
+    assert upload.ingested_at is not None
+    assert (upload.first_posted, upload.last_posted, upload.rows) == (date(2020, 10, 1), date(2020, 10, 31), 31)
+
+    # Same bytes under another name
+    data = {'account-name': account.id, 'csv': SimpleUploadedFile('october (1).csv', export(1, 31))}
+    response = client.post(reverse('upload-csv'), data)
+
+    assert 'already imported' in response.content.decode()
+    assert len(enqueued) == 1
+    assert Upload.objects.count() == 1
+
+
+@pytest.mark.django_db
+def test_overlapping_upload_skips_seen_days(account):
+    first, _ = uploads.store(account.id, SimpleUploadedFile('october.csv', export(1, 31)))
+    process_upload(first.id)
+
+    # Lose the last day so we can tell the edge is looked at again
+    Transaction.objects.filter(name='COFFEE 10/31').delete()
+
+    second, pending = uploads.store(account.id, SimpleUploadedFile('late-october.csv', export(15, 31)))
+    assert pending
+
+    result = process_upload(second.id)
+
+    assert result['skipped'] == 16
+    assert result['rows'] == 1
+    assert result['inserted'] == 1
+    assert Transaction.objects.count() == 31
+
+    # Nothing has been imported for November, so none of it is skipped
+    third, _ = uploads.store(account.id, SimpleUploadedFile('november.csv', export(1, 5, month=11)))
+    result = process_upload(third.id)
+
+    assert result['skipped'] == 0
+    assert Transaction.objects.count() == 36
+
+
+@pytest.mark.django_db
+def test_upload_is_read_back_from_chunks(settings, account, tmp_path, monkeypatch):
+    settings.UPLOAD_CHUNK_SIZE = 100
+    contents = export(1, 31)
+
+    upload, _ = uploads.store(account.id, SimpleUploadedFile('october.csv', contents))
+
+    assert upload.chunks.count() == len(contents) // 100 + 1
+    assert all(len(chunk.data) <= 100 for chunk in upload.chunks.all())
+
+    with uploads.open_upload(upload) as f:
+        assert f.read() == contents.decode()
+
+    # Nothing about the upload was left on this machine's disk
+    monkeypatch.chdir(tmp_path)
+    result = process_upload(upload.id)
+
+    assert result['rows'] == 31
+    assert list(tmp_path.iterdir()) == []
+
+
+@pytest.mark.django_db
+def test_upload_job_progress(client, account, enqueued):
+    contents = export(1, 10) + b'10/32/2020,BAD DATE,-1.00,0.00\r\n' + '10/11/2020,CAFÉ,-3.50,100.00\r\n'.encode()
+    data = {'account-name': account.id, 'csv': SimpleUploadedFile('october.csv', contents)}
+    response = client.post(reverse('upload-csv'), data)
+
+    job = response.context['job']
+    status = client.get(reverse('ingestion-job', args=[job.id])).json()
+
+    assert status['kind'] == 'csv'
+    assert status['status'] == 'done'
+    assert status['upload'] == job.upload_id
+    assert status['rows_read'] == 12
+    assert status['inserted'] == 11
+    assert status['errors'] == 1
+    # Bytes, not characters
+    assert status['bytes_read'] == len(contents)
+    assert 'Line 12' in status['error']
+    assert Transaction.objects.count() == 11
+
+    # Everything that's already there shows up as a duplicate
+    job = IngestionJob.objects.create(kind='csv', account=account)
+    process_upload(Upload.objects.get().id, job_id=job.id)
+    job.refresh_from_db()
+
+    assert (job.rows_read, job.inserted, job.duplicates) == (12, 0, 11)
+
+
+@pytest.mark.django_db
+def test_bulk_upload_merges_files(client, account, eager_tasks):
+    archive = io.BytesIO()
+
+    with zipfile.ZipFile(archive, 'w') as z:
+        z.writestr('2020/october.csv', export(1, 31))
+        z.writestr('2020/late-october.csv', export(20, 31))
+        z.writestr('2020/README.txt', 'not a statement')
+
+    files = [SimpleUploadedFile('history.zip', archive.getvalue()),
+             SimpleUploadedFile('november.csv', export(1, 30, month=11))]
+    response = client.post(reverse('upload-csv'), {'account-name': account.id, 'csv': files})
+
+    job = response.context['job']
+    job.refresh_from_db()
+
+    assert Upload.objects.count() == 3
+    assert Upload.objects.filter(ingested_at=None).count() == 0
+    assert Transaction.objects.count() == 61
+
+    # The late October rows were all in the first file too
+    assert job.upload is None
+    assert job.status == 'done'
+    assert (job.rows_read, job.inserted, job.duplicates) == (73, 61, 12)
+
+    # The merge cleans up after itself
+    assert not StagedRow.objects.exists()
+
+    files = [SimpleUploadedFile('november.csv', export(1, 30, month=11))]
+    response = client.post(reverse('upload-csv'), {'account-name': account.id, 'csv': files})
+
+    assert 'november.csv was already imported.' in response.content.decode()
+    assert 'job' not in response.context
+
+
+@pytest.mark.django_db
+def test_upload_with_newline_in_quotes(settings, account):
+    settings.UPLOAD_CHUNK_SIZE = 100
+    contents = export(1, 5) + b'10/06/2020,"CORNER STORE\r\nAISLE 5",-3.50,100.00\r\n'
+
+    upload, _ = uploads.store(account.id, SimpleUploadedFile('october.csv', contents))
+
+    assert process_upload(upload.id)['rows'] == 6
+    assert Transaction.objects.filter(name='CORNER STORE\r\nAISLE 5').exists()
+
+
+
+@pytest.mark.django_db
+def test_bulk_upload_with_bad_file(client, account, eager_tasks, monkeypatch):
+    # Keeps the parse error itself rather than Celery's rebuilt copy of it
+    monkeypatch.setattr(app.conf, 'task_eager_propagates', True)
+    archive = io.BytesIO()
+
+    with zipfile.ZipFile(archive, 'w') as z:
+        z.writestr('october.csv', export(1, 31))
+        z.writestr('budget.csv', 'Category,Planned\r\nGroceries,400\r\n')
+
+    response = client.post(reverse('upload-csv'), {'account-name': account.id,
+                                                    'csv': [SimpleUploadedFile('history.zip', archive.getvalue())]})
+
+    job = response.context['job']
+    job.refresh_from_db()
+
+    assert job.status == 'failed'
+    assert 'No upload format matches the columns Category, Planned' in job.error
+    assert not StagedRow.objects.exists()
+    assert Transaction.objects.count() == 0
+
+
+@pytest.mark.django_db
+def test_known_rows_dropped_before_sql(account, tmp_path):
+    path = tmp_path / 'october.csv'
+    path.write_bytes(export(1, 31))
+
+    assert process_file(account.id, str(path))['inserted'] == 31
+
+    # A new day shows up at the end of the same export
+    path.write_bytes(export(1, 31) + b'11/01/2020,COFFEE 11/1,-3.50,100.00\r\n')
+
+    with CaptureQueriesContext(connection) as queries:
+        result = process_file(account.id, str(path))
+
+    assert result['duplicates'] == 31
+    assert result['rows'] == 1
+    assert result['inserted'] == 1
+
+    # One lookup for October and one for November, and only the new row is
+    # sent to the database. Looking for transfers afterwards is a query of
+    # its own.
+    lookups = [q for q in queries if 'FROM "cash_transaction"' in q['sql'] and '"reconciled"' not in q['sql']]
+    assert len(lookups) == 2
+    assert sum('COPY cash_transaction_staging' in q['sql'] for q in queries) == 1
+
+
+
+@pytest.mark.django_db
+def test_seen_ids_stay_bounded(account, tmp_path, settings):
+    settings.UPLOAD_SEEN_MONTHS = 3
+    path = tmp_path / '2020.csv'
+    path.write_bytes(export(1, 28, month=1) +
+                     b''.join(export(1, 28, month=month).split(b'\r\n', 1)[1] for month in range(2, 13)))
+
+    assert process_file(account.id, str(path))['inserted'] == 12 * 28
+
+    # Re-importing the whole year only ever holds a few months of ids
+    seen = uploads.SeenIds(account.id)
+    held = []
+    stats = {}
+
+    def records(reader):
+        for record in reader:
+            held.append(len(seen))
+            yield record
+
+    with open(path) as f:
+        reader = csv.DictReader(f)
+        rows = uploads.new_rows(parsers.sniff(reader.fieldnames), records(reader), account.id, [], stats,
+                                JobProgress(None), seen=seen)
+
+        assert list(rows) == []
+
+    assert stats['duplicates'] == 12 * 28
+    assert len(seen.months) == 3
+    assert max(held) == 3 * 28
@@ -1,8 +1,118 @@
+from datetime import datetime, timedelta, timezone
+from urllib.parse import quote
+
 import pytest
 
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from cash.models import Expense, Income, Transaction
+
 
 @pytest.mark.django_db
 def test_index(client, income_series):
     response = client.get('/')
 
     assert response.status_code == 200
+
+
+@pytest.mark.django_db
+def test_index_with_ledger(client, expense_series):
+    somewhere_in_the_middle = Income.objects.order_by('budgeted_date')[8]
+    somewhere_in_the_middle._carry_over = 500.0
+    somewhere_in_the_middle.save()
+
+    response = client.get('/')
+
+    assert response.status_code == 200
+
+    for row in response.context['income']:
+        income = Income.objects.get(id=row.id)
+        assert row.actual_income == income.income
+        assert row.actual_expenses == income.total_expenses
+        assert row.running_carry_over == pytest.approx(income.carry_over)
+
+
+@pytest.mark.django_db
+def test_index_query_count(client, income_series):
+    with CaptureQueriesContext(connection) as queries:
+        client.get('/')
+
+    Income.objects.create(budgeted=1000.0,
+                          budgeted_date=Income.objects.order_by('-budgeted_date').first().budgeted_date + timedelta(days=14))
+
+    with CaptureQueriesContext(connection) as more_queries:
+        client.get('/')
+
+    assert len(more_queries) == len(queries)
+
+
+def make_transactions(account, count, start=None, prefix='txn'):
+    start = start or datetime(2020, 1, 1, tzinfo=timezone.utc)
+
+    Transaction.objects.bulk_create([Transaction(transaction_id='{}-{:04d}'.format(prefix, index),
+                                                 name='STORE',
+                                                 memo='STORE {}'.format(index),
+                                                 amount=-10.0,
+                                                 account=account,
+                                                 transaction_type='DEBIT',
+                                                 # Two a day so pages split days
+                                                 date_posted=start + timedelta(days=index // 2))
+                                     for index in range(count)])
+
+
+@pytest.mark.django_db
+def test_reconcile_pages(settings, client, account):
+    settings.RECONCILE_PAGE_SIZE = 5
+    make_transactions(account, 12)
+
+    seen = []
+    url = '/incoming-transactions/'
+
+    while url:
+        response = client.get(url)
+        seen.extend(t.transaction_id for t in response.context['transactions'])
+        before = response.context.get('before')
+        url = '/incoming-transactions/?before={}'.format(quote(before)) if before else None
+
+    assert seen == ['txn-{:04d}'.format(index) for index in reversed(range(12))]
+
+
+@pytest.mark.django_db
+def test_reconcile_query_count(settings, client, account):
+    settings.RECONCILE_PAGE_SIZE = 10
+    make_transactions(account, 5)
+
+    with CaptureQueriesContext(connection) as queries:
+        client.get('/incoming-transactions/')
+
+    make_transactions(account, 40, start=datetime(2021, 1, 1, tzinfo=timezone.utc), prefix='more')
+
+    with CaptureQueriesContext(connection) as more_queries:
+        response = client.get('/incoming-transactions/')
+
+    assert len(response.context['transactions']) == 10
+    assert len(more_queries) == len(queries)
+
+
+@pytest.mark.django_db
+def test_reconciled_flag(account, paycheck, income_series):
+    assert list(Transaction.unreconciled()) == [paycheck]
+
+    expense = Expense.objects.create(budgeted_amount=10.0,
+                                     description='coffee',
+                                     income=income_series.first(),
+                                     transaction=paycheck)
+    assert not Transaction.unreconciled().exists()
+
+    expense.transaction = None
+    expense.save()
+    assert list(Transaction.unreconciled()) == [paycheck]
+
+    income = income_series.order_by('-budgeted_date').first()
+    income.transaction = paycheck
+    income.save()
+    assert not Transaction.unreconciled().exists()
+
+    income.delete()
+    assert list(Transaction.unreconciled()) == [paycheck]